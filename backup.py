@@ -0,0 +1,217 @@
+import gzip
+import os
+import shutil
+import sqlite3
+from datetime import datetime
+
+# Pages copied per sqlite3 backup step (progress is reported after each step)
+BACKUP_PAGES_PER_STEP = 256
+# Seconds to sleep between steps, so the worker thread does not hog the disk
+BACKUP_STEP_SLEEP = 0.002
+
+# Scheduled snapshots: interval, how many to keep, and where they go (next to the database)
+SNAPSHOT_INTERVAL_MINUTES = 60
+SNAPSHOT_KEEP = 24
+SNAPSHOT_DIR_NAME = 'backups'
+SNAPSHOT_TIME_FORMAT = '%Y%m%d_%H%M%S'
+
+
+def _remove_quietly(path):
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+    except OSError as e:
+        print(f"Could not remove temporary file {path}: {e}")
+
+
+def backup_database(src_conn, dest_path, compress=False, pages_per_step=BACKUP_PAGES_PER_STEP, progress=None):
+    """
+    Copies a live database into dest_path with the SQLite online backup API.
+
+    The copy is taken from one read snapshot of src_conn, so it is consistent
+    even while other connections keep inserting sales (in WAL mode they are
+    not blocked by the backup). The copy is written to a temporary file next
+    to dest_path and only renamed into place once complete and checked, so a
+    failed or cancelled backup never leaves a half-written file behind.
+
+    :param src_conn: connection to the database to back up (should not be used elsewhere meanwhile)
+    :param dest_path: output file; an existing file is replaced
+    :param compress: gzip the output (dest_path should then end in .gz)
+    :param progress: optional callable(fraction, message) called after each step
+    :raises: sqlite3.Error on backup errors, OSError on file errors
+    """
+    raw_tmp_path = dest_path + '.part'
+    gz_tmp_path = dest_path + '.gz.part'
+    _remove_quietly(raw_tmp_path)
+    # Compression is the last ~10% of the progress bar
+    copy_share = 0.9 if compress else 1.0
+
+    def on_step(status, remaining, total):
+        if progress and total:
+            done = total - remaining
+            progress(copy_share * done / total, f"已备份 {done} / {total} 页")
+
+    dest_conn = None
+    try:
+        # Pin one read snapshot for the whole backup. Without it, every commit
+        # made by the app between two steps would restart the copy from page 0.
+        src_conn.execute("BEGIN")
+        src_conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        try:
+            dest_conn = sqlite3.connect(raw_tmp_path)
+            src_conn.backup(dest_conn, pages=pages_per_step, progress=on_step, sleep=BACKUP_STEP_SLEEP)
+        finally:
+            src_conn.rollback() # Release the read snapshot
+
+        # The copy inherits WAL mode from the source; switch it back so the
+        # backup is one self-contained file without -wal/-shm companions
+        dest_conn.execute("PRAGMA journal_mode = DELETE").fetchone()
+        check = dest_conn.execute("PRAGMA quick_check").fetchone()[0]
+        if check != 'ok':
+            raise sqlite3.DatabaseError(f"备份文件校验失败: {check}")
+        dest_conn.close()
+        dest_conn = None
+
+        if compress:
+            if progress:
+                progress(copy_share, "正在压缩备份文件...")
+            with open(raw_tmp_path, 'rb') as src_file, gzip.open(gz_tmp_path, 'wb') as gz_file:
+                shutil.copyfileobj(src_file, gz_file, 1024 * 1024)
+            os.replace(gz_tmp_path, dest_path)
+            os.remove(raw_tmp_path)
+        else:
+            os.replace(raw_tmp_path, dest_path)
+        if progress:
+            progress(1.0, "备份完成")
+        print(f"Database backed up to: {dest_path}")
+    finally:
+        if dest_conn is not None:
+            dest_conn.close()
+        _remove_quietly(raw_tmp_path)
+        _remove_quietly(gz_tmp_path)
+
+
+def snapshot_dir(db_path):
+    """Directory that holds the scheduled snapshots of db_path."""
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), SNAPSHOT_DIR_NAME)
+
+
+def _snapshot_prefix(db_path):
+    return os.path.splitext(os.path.basename(db_path))[0] + '_'
+
+
+def snapshot_path(db_path, now=None):
+    """Timestamped (sortable) snapshot file name, e.g. backups/diesel_sales_20250101_120000.db.gz"""
+    now = now or datetime.now()
+    return os.path.join(snapshot_dir(db_path), f"{_snapshot_prefix(db_path)}{now.strftime(SNAPSHOT_TIME_FORMAT)}.db.gz")
+
+
+def list_snapshots(db_path):
+    """Existing snapshots of db_path, oldest first."""
+    directory = snapshot_dir(db_path)
+    if not os.path.isdir(directory):
+        return []
+    prefix = _snapshot_prefix(db_path)
+    names = [name for name in os.listdir(directory) if name.startswith(prefix) and name.endswith('.db.gz')]
+    return [os.path.join(directory, name) for name in sorted(names)]
+
+
+def rotate_snapshots(db_path, keep=SNAPSHOT_KEEP):
+    """
+    Deletes all but the newest `keep` snapshots of db_path.
+
+    :return: list of deleted paths
+    """
+    snapshots = list_snapshots(db_path)
+    deleted = []
+    for path in snapshots[:max(len(snapshots) - keep, 0)]:
+        try:
+            os.remove(path)
+            deleted.append(path)
+        except OSError as e:
+            print(f"Could not delete old snapshot {path}: {e}")
+    return deleted
+
+
+def create_snapshot(src_conn, db_path, keep=SNAPSHOT_KEEP, progress=None):
+    """
+    Writes a compressed, timestamped snapshot of the database and drops the oldest ones.
+
+    :return: path of the new snapshot
+    """
+    os.makedirs(snapshot_dir(db_path), exist_ok=True)
+    path = snapshot_path(db_path)
+    backup_database(src_conn, path, compress=True, progress=progress)
+    rotate_snapshots(db_path, keep)
+    return path
+
+
+class SnapshotScheduler:
+    """
+    Takes a rotating snapshot of the current database every `interval_minutes`
+    on the JobExecutor's worker thread, so the UI keeps taking sales meanwhile.
+
+    :param root: Tk root (for root.after)
+    :param jobs: JobExecutor
+    :param get_db_path: callable() -> path of the database currently open
+    """
+
+    def __init__(self, root, jobs, get_db_path, interval_minutes=SNAPSHOT_INTERVAL_MINUTES, keep=SNAPSHOT_KEEP):
+        self.root = root
+        self.jobs = jobs
+        self.get_db_path = get_db_path
+        self.interval_minutes = interval_minutes
+        self.keep = keep
+        self._after_id = None
+        self._job = None
+
+    @property
+    def running(self):
+        return self._after_id is not None
+
+    def start(self):
+        if self._after_id is None:
+            self._after_id = self.root.after(self.interval_minutes * 60 * 1000, self._on_timer)
+
+    def stop(self):
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
+
+    def snapshot_now(self, on_success=None, on_error=None):
+        """
+        Queues a snapshot job; skipped (returns None) if the previous one is still running.
+
+        :param on_success: callable(snapshot_path), run on the UI thread
+        :param on_error: callable(exception), run on the UI thread
+        """
+        if self._job is not None:
+            print("Previous snapshot still running, skipping.")
+            return None
+        db_path = self.get_db_path()
+
+        def work(job):
+            return create_snapshot(job.conn, db_path, self.keep)
+
+        def done_success(path):
+            self._job = None
+            if on_success:
+                on_success(path)
+
+        def done_error(e):
+            self._job = None
+            print(f"Scheduled snapshot failed: {e}")
+            if on_error:
+                on_error(e)
+
+        def done_cancelled():
+            self._job = None
+
+        self._job = self.jobs.submit(work, db_path=db_path, on_success=done_success,
+                                     on_error=done_error, on_cancelled=done_cancelled)
+        return self._job
+
+    def _on_timer(self):
+        self._after_id = None
+        self.snapshot_now()
+        self.start() # Schedule the next one
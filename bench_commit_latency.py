@@ -0,0 +1,67 @@
+"""
+Commit latency benchmark for the connection profiles in database.py.
+
+Inserts single sales rows, each in its own `with conn:` transaction (as the
+app does for every ticket), once with SQLite's default rollback journal /
+synchronous=FULL and once with the app's WAL profile, and prints the latency
+distribution of each.
+
+Usage: python bench_commit_latency.py [commits] [directory]
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import database
+
+
+def run_profile(name, profile, commits, directory):
+    db_file = os.path.join(directory, f"bench_{name}.db")
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(db_file + suffix):
+            os.remove(db_file + suffix)
+
+    conn = database.create_connection(db_file, profile)
+    database.initialize_database(conn)
+    with conn:
+        conn.execute("INSERT INTO customers (name) VALUES ('基准客户')")
+        conn.execute("""INSERT INTO inventory (entry_date, order_number, price_per_ton, quantity_ton, density, total_liters)
+                        VALUES ('2024-01-01', 'BENCH-IN', 7000, 1000000, 0.84, 1190476190.0)""")
+
+    latencies = []
+    for i in range(commits):
+        started = time.perf_counter()
+        with conn:
+            conn.execute("""INSERT INTO sales (customer_id, sale_date, order_number, price_per_liter, quantity_liter, total_price)
+                            VALUES (1, '2024-01-02', ?, 8.0, 100.0, 800.0)""", (f"BENCH-{i}",))
+        latencies.append((time.perf_counter() - started) * 1000)
+    conn.close()
+
+    latencies.sort()
+    return {
+        'mean': statistics.mean(latencies),
+        'p50': latencies[len(latencies) // 2],
+        'p95': latencies[int(len(latencies) * 0.95) - 1],
+        'max': latencies[-1],
+    }
+
+
+def main():
+    commits = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    directory = sys.argv[2] if len(sys.argv) > 2 else tempfile.mkdtemp(prefix="diesel_bench_")
+    results = {
+        'rollback/FULL': run_profile('legacy', database.LEGACY_CONNECTION_PROFILE, commits, directory),
+        'WAL/NORMAL': run_profile('wal', database.DEFAULT_CONNECTION_PROFILE, commits, directory),
+    }
+    print(f"\n{commits} single-row commits in {directory} (latency in ms)")
+    print(f"{'profile':<15}{'mean':>10}{'p50':>10}{'p95':>10}{'max':>10}")
+    for name, result in results.items():
+        print(f"{name:<15}{result['mean']:>10.3f}{result['p50']:>10.3f}{result['p95']:>10.3f}{result['max']:>10.3f}")
+    speedup = results['rollback/FULL']['mean'] / results['WAL/NORMAL']['mean']
+    print(f"\nWAL/NORMAL mean commit is {speedup:.1f}x faster")
+
+
+if __name__ == '__main__':
+    main()
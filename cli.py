@@ -0,0 +1,159 @@
+"""
+Command line entry point for headless use (cron exports, stock reports).
+
+    python cli.py [--db FILE] export OUT.xlsx|DIR [--start YYYY-MM-DD] [--end YYYY-MM-DD] [--method fifo|average]
+    python cli.py [--db FILE] export OUT.xlsx --incremental [--method fifo|average]
+    python cli.py [--db FILE] export-columnar OUT_DIR [--format parquet|arrow] [--method fifo|average]
+    python cli.py [--db FILE] stats [--start ...] [--end ...] [--customer NAME] [--method fifo|average]
+    python cli.py [--db FILE] stock [--verify]
+    python cli.py [--db FILE] import FILE.xlsx|FILE.csv
+
+Uses the same service functions as the GUI and never imports tkinter.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+
+import cogs
+import columnar_export
+import services
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DB_PATH = os.path.join(APP_DIR, 'diesel_sales.db') # Same file the GUI opens
+
+
+def _dates(args):
+    return (services.validate_date(args.start, "开始日期"),
+            services.validate_date(args.end, "结束日期"))
+
+
+def cmd_export(conn, args):
+    start_date, end_date = _dates(args)
+    save_path = args.output
+    if args.incremental:
+        # A running workbook of all dates: only what changed since its last export is written
+        if start_date or end_date:
+            raise ValueError("增量导出包含所有日期，不能与 --start/--end 同时使用")
+        if os.path.isdir(save_path):
+            save_path = os.path.join(save_path, services.export_filename())
+        mode, applied = services.export_excel_incremental(conn, save_path, args.method)
+        if mode == 'full':
+            print(f"数据已完整导出到: {save_path}")
+        else:
+            print(f"已将 {applied} 条变更追加到: {save_path}")
+        return 0
+    if os.path.isdir(save_path):
+        save_path = os.path.join(save_path, services.export_filename(start_date, end_date))
+    services.export_excel(conn, save_path, start_date, end_date, args.method)
+    print(f"数据已成功导出到: {save_path}")
+    return 0
+
+
+def cmd_export_columnar(conn, args):
+    results = services.export_columnar(conn, args.output, args.format, args.method)
+    for name, (rows, months) in results.items():
+        print(f"{name}: {rows} 行, {months} 个月份分区")
+    print(f"数据已成功导出到: {args.output}")
+    return 0
+
+
+def cmd_stats(conn, args):
+    start_date, end_date = _dates(args)
+    customer_id = None
+    if args.customer:
+        customer_id = services.find_customer_id(conn, args.customer)
+        if customer_id is None:
+            print(f"错误: 未找到客户 '{args.customer}'", file=sys.stderr)
+            return 1
+    report = services.statistics_report(conn, start_date, end_date, customer_id, args.method)
+    print("\n".join(services.format_statistics_report(report)))
+    return 0
+
+
+def cmd_stock(conn, args):
+    remaining, is_consistent, stored, ledger = services.stock_report(conn)
+    print(f"当前库存余量 (升): {remaining:.2f}")
+    if args.verify:
+        if is_consistent:
+            print("校验通过: 库存余额与出入库记录一致。")
+        else:
+            stored_text = f"{stored:.2f}" if stored is not None else "无"
+            print(f"校验不一致: 记录余额 {stored_text} 升，实际余额 {ledger:.2f} 升", file=sys.stderr)
+            return 1
+    return 0
+
+
+def cmd_import(conn, args):
+    report, report_path = services.import_file(conn, args.file)
+    print(report.summary())
+    if report_path:
+        print(f"错误明细已保存到: {report_path}")
+    return 1 if report.errors else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="柴油库存管理系统 - 命令行")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help=f"数据库文件 (默认: {DEFAULT_DB_PATH})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    methods = list(cogs.METHOD_LABELS)
+
+    export_parser = subparsers.add_parser("export", help="导出到 Excel")
+    export_parser.add_argument("output", help="输出 .xlsx 文件，或目录（使用默认文件名）")
+    export_parser.add_argument("--start", help="开始日期 YYYY-MM-DD")
+    export_parser.add_argument("--end", help="结束日期 YYYY-MM-DD")
+    export_parser.add_argument("--method", choices=methods, default=cogs.DEFAULT_METHOD, help="成本计算方法")
+    export_parser.add_argument("--incremental", action="store_true", help="增量导出: 只把上次导出后新增/修改/删除的记录写入同一文件")
+    export_parser.set_defaults(func=cmd_export)
+
+    columnar_parser = subparsers.add_parser("export-columnar", help="导出为按月分区的 Parquet/Arrow 数据集（需要 pyarrow）")
+    columnar_parser.add_argument("output", help="输出目录")
+    columnar_parser.add_argument("--format", choices=list(columnar_export.FORMATS), default=columnar_export.PARQUET, help="文件格式")
+    columnar_parser.add_argument("--method", choices=methods, default=cogs.DEFAULT_METHOD, help="成本计算方法")
+    columnar_parser.set_defaults(func=cmd_export_columnar)
+
+    stats_parser = subparsers.add_parser("stats", help="打印统计数据")
+    stats_parser.add_argument("--start", help="开始日期 YYYY-MM-DD（默认: 最早销售日期）")
+    stats_parser.add_argument("--end", help="结束日期 YYYY-MM-DD（默认: 不限）")
+    stats_parser.add_argument("--customer", help="客户名称（默认: 所有客户）")
+    stats_parser.add_argument("--method", choices=methods, default=cogs.DEFAULT_METHOD, help="成本计算方法")
+    stats_parser.set_defaults(func=cmd_stats)
+
+    stock_parser = subparsers.add_parser("stock", help="打印当前库存余量")
+    stock_parser.add_argument("--verify", action="store_true", help="同时校验库存余额与出入库记录")
+    stock_parser.set_defaults(func=cmd_stock)
+
+    import_parser = subparsers.add_parser("import", help="从 Excel/CSV 批量导入（格式同 模版.xlsx）")
+    import_parser.add_argument("file", help=".xlsx 或 .csv 文件")
+    import_parser.set_defaults(func=cmd_import)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        conn = services.open_database(args.db)
+    except sqlite3.Error as e:
+        print(f"数据库错误: 无法连接或初始化数据库 '{args.db}': {e}", file=sys.stderr)
+        return 1
+    try:
+        return args.func(conn, args)
+    except ValueError as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 1
+    except ImportError as e:
+        if e.name and e.name.startswith('pyarrow'):
+            print("缺少库: 导出 Parquet/Arrow 需要 'pyarrow' 库。请确保它已安装: pip install pyarrow", file=sys.stderr)
+        else:
+            print("缺少库: 读写 Excel 需要 'openpyxl' 库。请确保它已安装: pip install openpyxl", file=sys.stderr)
+        return 1
+    except sqlite3.Error as e:
+        print(f"数据库错误: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
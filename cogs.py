@@ -0,0 +1,193 @@
+from collections import deque
+
+# Costing methods (rows of cogs_state)
+FIFO = 'fifo'
+AVERAGE = 'average'
+DEFAULT_METHOD = FIFO
+METHOD_LABELS = {
+    FIFO: '先进先出 (FIFO)',
+    AVERAGE: '移动加权平均',
+}
+
+# Events fetched from SQLite per round trip, and result rows written per executemany
+REPLAY_CHUNK_SIZE = 2000
+
+# Liters below this count as an empty lot / empty tank
+_EPSILON = 1e-6
+
+# Receipts and sales from a date on, in replay order: by date, receipts before
+# sales on the same day, then by id. Receipts carry (liters, cost in 元).
+_EVENTS_SQL = """
+    SELECT entry_date, 0, id, total_liters, price_per_ton * quantity_ton FROM inventory WHERE entry_date >= ?
+    UNION ALL
+    SELECT sale_date, 1, id, quantity_liter, NULL FROM sales WHERE sale_date >= ?
+    ORDER BY 1, 2, 3
+"""
+
+
+def _cost_per_liter(liters, cost):
+    return cost / liters if liters > 0 else 0.0
+
+
+class _FifoLedger:
+    """Open inventory lots, oldest first; each sale draws down the oldest lots."""
+
+    def __init__(self, cursor, from_date):
+        self.lots = deque() # [inventory_id, remaining_liters, cost_per_liter]
+        self.last_cost = 0.0 # Cost per liter of the latest lot, for sales beyond the recorded stock
+        # Lot balances just before from_date: delivered liters minus what the kept sales drew
+        cursor.execute("""
+            SELECT i.id, i.total_liters, i.price_per_ton * i.quantity_ton, COALESCE(c.used, 0.0)
+            FROM inventory i
+            LEFT JOIN (SELECT inventory_id, SUM(liters) AS used FROM fifo_lot_consumption
+                       WHERE inventory_id IS NOT NULL GROUP BY inventory_id) c ON c.inventory_id = i.id
+            WHERE i.entry_date < ?
+            ORDER BY i.entry_date, i.id
+        """, (from_date,))
+        for inventory_id, liters, cost, used in cursor.fetchall():
+            self.last_cost = _cost_per_liter(liters, cost)
+            if liters - used > _EPSILON:
+                self.lots.append([inventory_id, liters - used, self.last_cost])
+
+    def receive(self, inventory_id, liters, cost):
+        self.last_cost = _cost_per_liter(liters, cost)
+        self.lots.append([inventory_id, liters, self.last_cost])
+
+    def sell(self, sale_id, sale_date, liters, consumption):
+        """Returns the cost of the sale; appends the lots it drew from to consumption."""
+        need = liters
+        total_cost = 0.0
+        while need > _EPSILON and self.lots:
+            lot = self.lots[0]
+            take = min(need, lot[1])
+            cost = take * lot[2]
+            consumption.append((sale_id, sale_date, lot[0], take, cost))
+            total_cost += cost
+            lot[1] -= take
+            need -= take
+            if lot[1] <= _EPSILON:
+                self.lots.popleft()
+        if need > _EPSILON:
+            # Sold more than was delivered up to this date
+            cost = need * self.last_cost
+            consumption.append((sale_id, sale_date, None, need, cost))
+            total_cost += cost
+        return total_cost
+
+
+class _AverageLedger:
+    """Moving weighted average: one pool whose cost per liter is re-averaged on every receipt."""
+
+    def __init__(self, cursor, from_date):
+        # Pool just before from_date: receipts in, minus what the kept sales took out at their cost
+        cursor.execute("SELECT COALESCE(SUM(total_liters), 0.0), COALESCE(SUM(price_per_ton * quantity_ton), 0.0) FROM inventory WHERE entry_date < ?",
+                       (from_date,))
+        liters_in, value_in = cursor.fetchone()
+        cursor.execute("SELECT COALESCE(SUM(liters), 0.0), COALESCE(SUM(cost), 0.0) FROM sale_cogs WHERE method = ? AND sale_date < ?",
+                       (AVERAGE, from_date))
+        liters_out, value_out = cursor.fetchone()
+        self.liters = liters_in - liters_out
+        self.value = value_in - value_out
+        cursor.execute("SELECT total_liters, price_per_ton * quantity_ton FROM inventory WHERE entry_date < ? ORDER BY entry_date DESC, id DESC LIMIT 1",
+                       (from_date,))
+        row = cursor.fetchone()
+        self.last_cost = _cost_per_liter(*row) if row else 0.0
+
+    def receive(self, inventory_id, liters, cost):
+        self.liters += liters
+        self.value += cost
+        self.last_cost = _cost_per_liter(liters, cost)
+
+    def sell(self, sale_id, sale_date, liters, consumption):
+        # An empty (or oversold) pool has no average; use the latest receipt price
+        unit_cost = self.value / self.liters if self.liters > _EPSILON else self.last_cost
+        cost = liters * unit_cost
+        self.liters -= liters
+        self.value -= cost
+        return cost
+
+
+_LEDGERS = {FIFO: _FifoLedger, AVERAGE: _AverageLedger}
+
+
+def update_cogs(conn, method=DEFAULT_METHOD, progress=None):
+    """
+    Brings sale_cogs for one costing method up to date.
+
+    Only events on or after cogs_state.dirty_from (the earliest date touched by
+    any write since the last update) are replayed: their stored results are
+    deleted, the ledger is restored to its state just before that date from
+    the persisted results, and the events are replayed in date order. An
+    up-to-date database costs a single SELECT.
+
+    Runs in one BEGIN IMMEDIATE transaction, so a concurrent write cannot slip
+    in between reading dirty_from and clearing it.
+
+    :param method: FIFO or AVERAGE
+    :param progress: optional callable(None, message) called after each chunk
+    :return: number of sales (re)costed
+    :raises: ValueError for an unknown method, sqlite3.Error on database errors
+    """
+    if method not in _LEDGERS:
+        raise ValueError(f"未知的成本计算方法: {method}")
+    cursor = conn.cursor()
+    cursor.execute("SELECT dirty_from FROM cogs_state WHERE method = ?", (method,))
+    row = cursor.fetchone()
+    if row is not None and row[0] is None:
+        return 0 # Up to date
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("SELECT dirty_from FROM cogs_state WHERE method = ?", (method,))
+        row = cursor.fetchone()
+        dirty_from = '' if row is None else row[0] # No state row: cost everything
+        if dirty_from is None: # Another connection finished the update meanwhile
+            conn.rollback()
+            return 0
+
+        # Rewind: drop results from the dirty date on
+        cursor.execute("DELETE FROM sale_cogs WHERE method = ? AND sale_date >= ?", (method, dirty_from))
+        if method == FIFO:
+            cursor.execute("DELETE FROM fifo_lot_consumption WHERE sale_date >= ?", (dirty_from,))
+        ledger = _LEDGERS[method](cursor, dirty_from)
+
+        # Replay
+        events = conn.cursor()
+        events.execute(_EVENTS_SQL, (dirty_from, dirty_from))
+        sale_count = 0
+        sale_rows = []
+        consumption = []
+        chunk = events.fetchmany(REPLAY_CHUNK_SIZE)
+        while chunk:
+            for event_date, is_sale, event_id, liters, cost in chunk:
+                if is_sale:
+                    sale_cost = ledger.sell(event_id, event_date, liters, consumption)
+                    sale_rows.append((method, event_id, event_date, liters, sale_cost))
+                else:
+                    ledger.receive(event_id, liters, cost)
+            cursor.executemany("INSERT INTO sale_cogs (method, sale_id, sale_date, liters, cost) VALUES (?, ?, ?, ?, ?)", sale_rows)
+            if consumption:
+                cursor.executemany("INSERT INTO fifo_lot_consumption (sale_id, sale_date, inventory_id, liters, cost) VALUES (?, ?, ?, ?, ?)", consumption)
+            sale_count += len(sale_rows)
+            sale_rows.clear()
+            consumption.clear()
+            if progress:
+                progress(None, f"成本计算: 已处理 {sale_count} 笔销售")
+            chunk = events.fetchmany(REPLAY_CHUNK_SIZE)
+
+        cursor.execute("INSERT OR REPLACE INTO cogs_state (method, dirty_from) VALUES (?, NULL)", (method,))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    print(f"COGS ({method}) updated from '{dirty_from or 'start'}': {sale_count} sales costed")
+    return sale_count
+
+
+def rebuild_cogs(conn, method=None, progress=None):
+    """Marks one method (or all) fully dirty and recomputes it from scratch."""
+    methods = [method] if method else list(_LEDGERS)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO cogs_state (method, dirty_from) VALUES (?, '')", [(m,) for m in methods])
+    for m in methods:
+        update_cogs(conn, m, progress=progress)
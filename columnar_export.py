@@ -0,0 +1,218 @@
+"""
+Columnar export of inventory, sales and the monthly sales summary for BI
+tools: Parquet (default) or Arrow IPC files, partitioned by month.
+
+    OUT_DIR/inventory/month=2024-01/part-0.parquet
+    OUT_DIR/sales/month=2024-01/part-0.parquet
+    OUT_DIR/sales_summary/month=2024-01/part-0.parquet
+
+The month=YYYY-MM directories are hive partitions, so e.g.
+pyarrow.dataset.dataset(OUT_DIR + '/sales', partitioning='hive') or
+pandas.read_parquet(OUT_DIR + '/sales') loads them with a month column, and
+filters on it only read the matching files. pyarrow is optional: it is only
+imported when exporting.
+"""
+import os
+import shutil
+from datetime import date
+
+import cogs
+
+PARQUET = 'parquet'
+ARROW = 'arrow'
+FORMATS = {PARQUET: '.parquet', ARROW: '.arrow'}
+
+# Rows fetched from SQLite per record batch
+BATCH_SIZE = 10000
+
+# (name, arrow type name) per column, in query order; the month partition column is not stored in the files
+INVENTORY_COLUMNS = [
+    ('id', 'int64'), ('entry_date', 'date32'), ('order_number', 'string'), ('price_per_ton', 'float64'),
+    ('quantity_ton', 'float64'), ('density', 'float64'), ('total_liters', 'float64'),
+]
+SALES_COLUMNS = [
+    ('id', 'int64'), ('customer_id', 'int64'), ('customer_name', 'string'), ('sale_date', 'date32'),
+    ('order_number', 'string'), ('price_per_liter', 'float64'), ('quantity_liter', 'float64'),
+    ('total_price', 'float64'), ('cost', 'float64'), ('profit', 'float64'),
+]
+SUMMARY_COLUMNS = [
+    ('customer_id', 'int64'), ('customer_name', 'string'), ('sale_count', 'int64'), ('total_liters', 'float64'),
+    ('total_revenue', 'float64'), ('avg_price_per_liter', 'float64'), ('cost', 'float64'), ('profit', 'float64'),
+]
+
+# Every query returns the YYYY-MM month first, then the columns above, ordered by month
+_INVENTORY_SQL = """
+    SELECT substr(entry_date, 1, 7), id, entry_date, order_number, price_per_ton, quantity_ton, density, total_liters
+    FROM inventory
+    ORDER BY entry_date, id
+"""
+_SALES_SQL = """
+    SELECT substr(s.sale_date, 1, 7), s.id, s.customer_id, c.name, s.sale_date, s.order_number,
+           s.price_per_liter, s.quantity_liter, s.total_price, sc.cost, s.total_price - sc.cost
+    FROM sales s
+    LEFT JOIN customers c ON s.customer_id = c.id
+    LEFT JOIN sale_cogs sc ON sc.method = ? AND sc.sale_id = s.id
+    ORDER BY s.sale_date, s.id
+"""
+# Totals come from the trigger-maintained monthly rollup, costs from sale_cogs
+_SUMMARY_SQL = """
+    SELECT r.sale_month, r.customer_id, c.name, r.sale_count, r.total_liters, r.total_revenue,
+           r.sum_price_per_liter / r.sale_count, mc.cost, r.total_revenue - mc.cost
+    FROM sales_monthly_rollup r
+    LEFT JOIN customers c ON r.customer_id = c.id
+    LEFT JOIN (
+        SELECT substr(sc.sale_date, 1, 7) AS sale_month, s.customer_id, SUM(sc.cost) AS cost
+        FROM sale_cogs sc
+        JOIN sales s ON s.id = sc.sale_id
+        WHERE sc.method = ?
+        GROUP BY 1, 2
+    ) mc ON mc.sale_month = r.sale_month AND mc.customer_id = r.customer_id
+    WHERE r.sale_count > 0
+    ORDER BY r.sale_month, c.name, r.customer_id
+"""
+
+
+def _schema(pa, columns):
+    return pa.schema([(name, getattr(pa, type_name)()) for name, type_name in columns])
+
+
+def _to_date(value):
+    """YYYY-MM-DD text (as stored) to a date; None if empty or not a valid date."""
+    try:
+        return date.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _record_batch(pa, schema, rows):
+    """Column-wise RecordBatch of rows (without their month) typed by schema."""
+    arrays = []
+    for position, field in enumerate(schema):
+        values = [row[position] for row in rows]
+        if pa.types.is_date32(field.type):
+            values = [_to_date(value) for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class _PartitionWriter:
+    """Writes record batches to one file per month partition, opened as the (month-ordered) stream reaches it."""
+
+    def __init__(self, pa, directory, schema, file_format):
+        self.pa = pa
+        self.directory = directory
+        self.schema = schema
+        self.file_format = file_format
+        self.month = None
+        self.writer = None
+        self.months = 0
+
+    def write(self, month, rows):
+        if month != self.month:
+            self.close()
+            self.month = month
+            partition = os.path.join(self.directory, f"month={month or 'unknown'}")
+            os.makedirs(partition, exist_ok=True)
+            path = os.path.join(partition, 'part-0' + FORMATS[self.file_format])
+            if self.file_format == PARQUET:
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(path, self.schema, compression='zstd')
+            else:
+                self.writer = self.pa.ipc.new_file(path, self.schema)
+            self.months += 1
+        self.writer.write_batch(_record_batch(self.pa, self.schema, rows))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def write_dataset(pa, cursor, directory, columns, file_format, batch_size=BATCH_SIZE, on_batch=None):
+    """
+    Streams an executed cursor of (month, *columns) rows, ordered by month,
+    into month partitions under directory.
+
+    :param on_batch: callable(row_count) called after each batch is written
+    :return: (rows written, month partitions written)
+    """
+    schema = _schema(pa, columns)
+    writer = _PartitionWriter(pa, directory, schema, file_format)
+    row_count = 0
+    try:
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            # Split the fetched rows at month boundaries
+            start = 0
+            for end in range(1, len(rows) + 1):
+                if end == len(rows) or rows[end][0] != rows[start][0]:
+                    writer.write(rows[start][0], [row[1:] for row in rows[start:end]])
+                    start = end
+            row_count += len(rows)
+            if on_batch:
+                on_batch(len(rows))
+            rows = cursor.fetchmany(batch_size)
+    finally:
+        writer.close()
+    return row_count, writer.months
+
+
+def export_dataset(conn, out_dir, file_format=PARQUET, cogs_method=cogs.DEFAULT_METHOD, batch_size=BATCH_SIZE, progress=None):
+    """
+    Writes the inventory, sales and sales_summary datasets under out_dir.
+
+    Each dataset is written to a temporary directory next to it and swapped
+    in when complete, so readers never see a half-written dataset and months
+    that no longer have data disappear. Other files in out_dir are left alone.
+
+    :param file_format: PARQUET or ARROW (Arrow IPC file format)
+    :param cogs_method: costing method for the cost/profit columns
+    :param progress: optional callable(fraction, message) called after each batch
+    :return: {dataset name: (rows, month partitions)}
+    :raises: ValueError for an unknown format, sqlite3.Error on query errors,
+             ImportError if pyarrow is missing
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f"未知的导出格式: {file_format}")
+    import pyarrow as pa
+
+    cursor = conn.cursor()
+    cogs.update_cogs(conn, cogs_method, progress=progress) # Cost columns are read from sale_cogs
+
+    on_batch = None
+    if progress:
+        cursor.execute("SELECT (SELECT COUNT(*) FROM inventory) + (SELECT COUNT(*) FROM sales)")
+        total_rows = max(cursor.fetchone()[0], 1)
+        written = [0]
+
+        def on_batch(row_count):
+            written[0] += row_count
+            progress(min(written[0] / total_rows, 1.0), f"已导出 {written[0]} / {total_rows} 行")
+        progress(0.0, "正在导出...")
+
+    datasets = [
+        ('inventory', _INVENTORY_SQL, (), INVENTORY_COLUMNS, on_batch),
+        ('sales', _SALES_SQL, (cogs_method,), SALES_COLUMNS, on_batch),
+        ('sales_summary', _SUMMARY_SQL, (cogs_method,), SUMMARY_COLUMNS, None),
+    ]
+    os.makedirs(out_dir, exist_ok=True)
+    results = {}
+    for name, sql, params, columns, callback in datasets:
+        target = os.path.join(out_dir, name)
+        temp_dir = target + '.tmp'
+        shutil.rmtree(temp_dir, ignore_errors=True) # Left over from an interrupted export
+        try:
+            cursor.execute(sql, params)
+            results[name] = write_dataset(pa, cursor, temp_dir, columns, file_format, batch_size, callback)
+            os.makedirs(temp_dir, exist_ok=True) # An empty table is an empty dataset
+            # Swap in the new dataset
+            old_dir = target + '.old'
+            shutil.rmtree(old_dir, ignore_errors=True)
+            if os.path.exists(target):
+                os.replace(target, old_dir)
+            os.replace(temp_dir, target)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        print(f"Columnar export: {name} -> {results[name][0]} rows in {results[name][1]} months")
+    return results
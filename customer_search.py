@@ -0,0 +1,122 @@
+from bisect import bisect_right
+from collections import defaultdict
+
+# pypinyin is optional: with it, full pinyin and exact initials (including
+# rare characters) are searchable; without it, initials come from the GB2312
+# code table below, which covers the 3755 common (level-1) characters.
+try:
+    from pypinyin import Style, lazy_pinyin
+except ImportError:
+    lazy_pinyin = None
+
+# Delay before a search-box keystroke filters the combobox (ms); typing faster
+# than this filters once, for the final text
+SEARCH_DEBOUNCE_MS = 150
+
+# Level-1 GB2312 characters are ordered by pinyin: (first code of the letter, letter).
+# There are no readings starting with i, u or v.
+_GB2312_INITIALS = [
+    (0xB0A1, 'a'), (0xB0C5, 'b'), (0xB2C1, 'c'), (0xB4EE, 'd'), (0xB6EA, 'e'),
+    (0xB7A2, 'f'), (0xB8C1, 'g'), (0xB9FE, 'h'), (0xBBF7, 'j'), (0xBFA6, 'k'),
+    (0xC0AC, 'l'), (0xC2E8, 'm'), (0xC4C3, 'n'), (0xC5B6, 'o'), (0xC5BE, 'p'),
+    (0xC6DA, 'q'), (0xC8BB, 'r'), (0xC8F6, 's'), (0xCBFA, 't'), (0xCDDA, 'w'),
+    (0xCEF4, 'x'), (0xD1B9, 'y'), (0xD4D1, 'z'),
+]
+_GB2312_LEVEL1_END = 0xD7F9
+_GB2312_STARTS = [start for start, _ in _GB2312_INITIALS]
+
+
+def _gb2312_initial(char):
+    """Pinyin initial of a common Chinese character, or None."""
+    try:
+        encoded = char.encode('gb2312')
+    except UnicodeEncodeError:
+        return None
+    if len(encoded) != 2:
+        return None
+    code = (encoded[0] << 8) | encoded[1]
+    if not _GB2312_INITIALS[0][0] <= code <= _GB2312_LEVEL1_END:
+        return None # Symbol or level-2 character (ordered by radical, not by reading)
+    return _GB2312_INITIALS[bisect_right(_GB2312_STARTS, code) - 1][1]
+
+
+def search_keys(name):
+    """
+    Lowercase strings a search term is matched against (as a substring):
+    the name itself, its pinyin initials ("中石化" -> "zsh") and, with
+    pypinyin installed, its full pinyin ("zhongshihua").
+    """
+    lowered = name.lower()
+    keys = [lowered]
+    if lazy_pinyin is not None:
+        # Non-Chinese runs are kept as they are
+        initials = ''.join(lazy_pinyin(lowered, style=Style.FIRST_LETTER)).lower()
+        full = ''.join(lazy_pinyin(lowered)).lower()
+        candidates = [initials, full]
+    else:
+        chars = []
+        for char in lowered:
+            if char.isascii():
+                if char.isalnum():
+                    chars.append(char)
+            else:
+                chars.append(_gb2312_initial(char) or char)
+        candidates = [''.join(chars)]
+    for key in candidates:
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+
+def _grams(text):
+    """Single characters and bigrams of text (the index terms)."""
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+class CustomerSearchIndex:
+    """
+    Substring search over customer names by name, pinyin initials or pinyin.
+
+    Built once per refresh_customer_names: every search key is split into
+    characters and bigrams, each mapped to the names containing it. A search
+    intersects the posting sets of the term's bigrams and only checks those
+    candidates. A term that extends the previous one (the user kept typing)
+    is only checked against the previous hits.
+    """
+
+    def __init__(self, names):
+        self.names = list(names) # Display order; results keep it
+        self._keys = [search_keys(name) for name in self.names]
+        self._postings = defaultdict(set) # gram -> positions in self.names
+        for position, keys in enumerate(self._keys):
+            for key in keys:
+                for gram in _grams(key):
+                    self._postings[gram].add(position)
+        self._last_term = None
+        self._last_hits = None
+
+    def search(self, term):
+        """Names whose name or pinyin contains term (case-insensitive), in display order."""
+        term = term.lower()
+        if not term:
+            self._last_term = None
+            return list(self.names)
+        if self._last_term is not None and self._last_term in term:
+            # Anything matching the longer term matched the shorter one too
+            candidates = self._last_hits
+        else:
+            candidates = self._candidates(term)
+        hits = [position for position in candidates
+                if any(term in key for key in self._keys[position])]
+        self._last_term = term
+        self._last_hits = hits
+        return [self.names[position] for position in hits]
+
+    def _candidates(self, term):
+        grams = [term] if len(term) == 1 else [term[i:i + 2] for i in range(len(term) - 1)]
+        postings = sorted((self._postings.get(gram, set()) for gram in set(grams)), key=len)
+        if not postings[0]:
+            return []
+        return sorted(postings[0].intersection(*postings[1:]))
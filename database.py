@@ -1,162 +1,926 @@
 import sqlite3
+import time
+from datetime import datetime, timedelta
 from sqlite3 import Error, Connection # Import Connection for type hinting
 
-def create_connection(db_file: str) -> Connection:
+# --- Connection profile ---
+# PRAGMAs applied to every connection the app opens (main window, background
+# jobs, opened archive files). WAL with synchronous=NORMAL needs one fsync per
+# checkpoint instead of two per commit, and lets readers run during writes.
+DEFAULT_CONNECTION_PROFILE = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,      # Negative = KiB, i.e. ~16 MB page cache
+    'mmap_size': 268435456,    # 256 MB memory-mapped I/O
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',
+    'busy_timeout': 5000,      # ms to wait for a lock held by another connection
+}
+
+# SQLite's own defaults (rollback journal, synchronous=FULL), kept for comparison benchmarks
+LEGACY_CONNECTION_PROFILE = {
+    'journal_mode': 'DELETE',
+    'synchronous': 'FULL',
+    'foreign_keys': 'OFF',
+}
+
+def apply_connection_profile(conn: Connection, profile: dict | None = None):
+    """ Applies the PRAGMAs of a connection profile (DEFAULT_CONNECTION_PROFILE if None) """
+    profile = DEFAULT_CONNECTION_PROFILE if profile is None else profile
+    cursor = conn.cursor()
+    for pragma, value in profile.items():
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+        if pragma == 'journal_mode':
+            mode = cursor.fetchone()[0]
+            if str(mode).lower() != str(value).lower():
+                # e.g. in-memory databases or read-only media cannot use WAL
+                print(f"Note: journal_mode is '{mode}' (requested '{value}')")
+
+def create_connection(db_file: str, profile: dict | None = None) -> Connection:
     """ create a database connection to the SQLite database specified by db_file
     :param db_file: database file path
+    :param profile: PRAGMA profile to apply (DEFAULT_CONNECTION_PROFILE if None)
     :return: Connection object
     :raises: sqlite3.Error if connection fails
     """
     conn = None
     try:
         conn = sqlite3.connect(db_file)
+        apply_connection_profile(conn, profile)
         print(f"Connected to database: {db_file}")
         return conn # Return the connection object on success
     except Error as e:
         print(f"Error connecting to database {db_file}: {e}")
+        if conn is not None:
+            conn.close()
         raise e # Re-raise the exception on failure
 
 def initialize_database(conn: Connection): # Accept connection object as parameter with type hint
-    """ Initialize database tables using the provided connection """
-    # Removed the 'if conn is None:' check as create_connection now raises an error
+    """ Brings the database schema up to date using the provided connection
+
+    PRAGMA user_version holds the number of the last applied migration, so an
+    up-to-date database costs a single pragma read. Otherwise each pending
+    step of MIGRATIONS runs once, in its own transaction, and is recorded in
+    the schema_migrations table.
+    :raises: sqlite3.Error if a migration fails (that step is rolled back)
+    """
+    current_version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if current_version >= SCHEMA_VERSION:
+        if current_version > SCHEMA_VERSION:
+            print(f"Warning: database schema version {current_version} is newer than this program ({SCHEMA_VERSION}).")
+        return
 
-    # Added try...except block for database operations
     try:
-        with conn: # Use the provided connection
-            cursor = conn.cursor()
-            # 库存表
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS inventory (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                entry_date TEXT NOT NULL,      -- 入库日期
-                order_number TEXT NOT NULL UNIQUE, -- Make order_number unique
-                price_per_ton REAL NOT NULL,    -- 单价（吨/元）
-                quantity_ton REAL NOT NULL,     -- 数量（吨）
-                density REAL NOT NULL,          -- 密度（吨/立方米）
-                total_liters REAL NOT NULL     -- 总升数（自动计算）
-            )
-        ''')
-            # 客户表
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS customers (
+        _apply_migrations(conn, current_version)
+        print("Database initialized/verified successfully.")
+    except sqlite3.Error as e:
+        print(f"An error occurred during database initialization: {e}")
+        raise
+
+def _create_base_schema(cursor):
+    """ Core tables plus the upgrades older versions of the program did on every start """
+    # 库存表
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS inventory (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        entry_date TEXT NOT NULL,      -- 入库日期
+        order_number TEXT NOT NULL UNIQUE, -- Make order_number unique
+        price_per_ton REAL NOT NULL,    -- 单价（吨/元）
+        quantity_ton REAL NOT NULL,     -- 数量（吨）
+        density REAL NOT NULL,          -- 密度（吨/立方米）
+        total_liters REAL NOT NULL     -- 总升数（自动计算）
+    )
+    ''')
+    # 客户表
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS customers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE -- Make customer name unique
+    )
+    ''')
+    # 销售表
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sales (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_id INTEGER NOT NULL, -- Make customer_id NOT NULL
+        sale_date TEXT NOT NULL,
+        order_number TEXT NOT NULL UNIQUE, -- Make sales order_number unique
+        price_per_liter REAL NOT NULL,
+        quantity_liter REAL NOT NULL,
+        total_price REAL NOT NULL,
+        FOREIGN KEY(customer_id) REFERENCES customers(id)
+    )
+    ''')
+
+    # --- Add missing columns robustly ---
+    # Check sales table
+    cursor.execute("PRAGMA table_info(sales)")
+    sales_columns = {info[1]: info[2] for info in cursor.fetchall()} # Store name: type
+
+    sales_columns_to_add = {
+        # 'customer_id': "INTEGER NOT NULL DEFAULT 0", # Ensure NOT NULL if adding later
+        'order_number': "TEXT NOT NULL DEFAULT ''",
+        'price_per_liter': "REAL NOT NULL DEFAULT 0.0",
+        'quantity_liter': "REAL NOT NULL DEFAULT 0.0",
+        'total_price': "REAL NOT NULL DEFAULT 0.0"
+    }
+
+    for col_name, col_definition in sales_columns_to_add.items():
+        if col_name not in sales_columns:
+            try:
+                cursor.execute(f"ALTER TABLE sales ADD COLUMN {col_name} {col_definition}")
+                print(f"Added missing '{col_name}' column to 'sales' table.")
+            except sqlite3.Error as e:
+                print(f"Error adding '{col_name}' column to sales: {e}")
+
+    # Add UNIQUE constraint to inventory order_number if missing
+    cursor.execute("PRAGMA index_list(inventory)")
+    inv_indices = [idx[1] for idx in cursor.fetchall()]
+    if 'idx_inventory_order_number' not in inv_indices:
+         try:
+             cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_inventory_order_number ON inventory(order_number)")
+             print("Added UNIQUE index to inventory.order_number.")
+         except sqlite3.Error as e:
+             print(f"Could not add UNIQUE index to inventory.order_number: {e}")
+
+    # Add UNIQUE constraint to customer name if missing
+    cursor.execute("PRAGMA index_list(customers)")
+    cust_indices = [idx[1] for idx in cursor.fetchall()]
+    if 'idx_customers_name' not in cust_indices:
+         try:
+             cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_customers_name ON customers(name)")
+             print("Added UNIQUE index to customers.name.")
+         except sqlite3.Error as e:
+             print(f"Could not add UNIQUE index to customers.name: {e}")
+
+    # Add UNIQUE constraint to sales order_number if missing
+    cursor.execute("PRAGMA index_list(sales)")
+    sales_indices = [idx[1] for idx in cursor.fetchall()]
+    if 'idx_sales_order_number' not in sales_indices:
+         try:
+             cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sales_order_number ON sales(order_number)")
+             print("Added UNIQUE index to sales.order_number.")
+         except sqlite3.Error as e:
+             print(f"Could not add UNIQUE index to sales.order_number: {e}")
+
+    # --- Remove remaining_liters from inventory table robustly (if exists) ---
+    cursor.execute("PRAGMA table_info(inventory)")
+    inventory_columns_info = {info[1]: info for info in cursor.fetchall()} # Get full column info
+    if 'remaining_liters' in inventory_columns_info:
+        # Runs inside the migration's transaction: an error rolls back the whole step
+        print("Found 'remaining_liters' column in 'inventory'. Recreating table...")
+        # 1. Create new table without the column, preserving constraints
+        cursor.execute('''
+            CREATE TABLE inventory_new (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE -- Make customer name unique
+                entry_date TEXT NOT NULL,
+                order_number TEXT NOT NULL UNIQUE, -- Keep UNIQUE
+                price_per_ton REAL NOT NULL,
+                quantity_ton REAL NOT NULL,
+                density REAL NOT NULL,
+                total_liters REAL NOT NULL
             )
         ''')
-            # 销售表
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sales (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                customer_id INTEGER NOT NULL, -- Make customer_id NOT NULL
-                sale_date TEXT NOT NULL,
-                order_number TEXT NOT NULL UNIQUE, -- Make sales order_number unique
-                price_per_liter REAL NOT NULL,
-                quantity_liter REAL NOT NULL,
-                total_price REAL NOT NULL,
-                FOREIGN KEY(customer_id) REFERENCES customers(id)
-            )
+        # 2. Copy data from old table to new table
+        cursor.execute('''
+            INSERT INTO inventory_new (id, entry_date, order_number, price_per_ton, quantity_ton, density, total_liters)
+            SELECT id, entry_date, order_number, price_per_ton, quantity_ton, density, total_liters
+            FROM inventory
         ''')
+        # 3. Drop the old table
+        cursor.execute("DROP TABLE inventory")
+        # 4. Rename the new table
+        cursor.execute("ALTER TABLE inventory_new RENAME TO inventory")
+        print("Successfully removed 'remaining_liters' column and recreated 'inventory' table.")
+    # --- End remove remaining_liters ---
 
-            # --- Add missing columns robustly ---
-            # Check sales table
-            cursor.execute("PRAGMA table_info(sales)")
-            sales_columns = {info[1]: info[2] for info in cursor.fetchall()} # Store name: type
-
-            sales_columns_to_add = {
-                # 'customer_id': "INTEGER NOT NULL DEFAULT 0", # Ensure NOT NULL if adding later
-                'order_number': "TEXT NOT NULL DEFAULT ''",
-                'price_per_liter': "REAL NOT NULL DEFAULT 0.0",
-                'quantity_liter': "REAL NOT NULL DEFAULT 0.0",
-                'total_price': "REAL NOT NULL DEFAULT 0.0"
-            }
-
-            for col_name, col_definition in sales_columns_to_add.items():
-                if col_name not in sales_columns:
-                    try:
-                        cursor.execute(f"ALTER TABLE sales ADD COLUMN {col_name} {col_definition}")
-                        print(f"Added missing '{col_name}' column to 'sales' table.")
-                    except sqlite3.Error as e:
-                        print(f"Error adding '{col_name}' column to sales: {e}")
-
-            # Add UNIQUE constraint to inventory order_number if missing
-            cursor.execute("PRAGMA index_list(inventory)")
-            inv_indices = [idx[1] for idx in cursor.fetchall()]
-            if 'idx_inventory_order_number' not in inv_indices:
-                 try:
-                     cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_inventory_order_number ON inventory(order_number)")
-                     print("Added UNIQUE index to inventory.order_number.")
-                 except sqlite3.Error as e:
-                     print(f"Could not add UNIQUE index to inventory.order_number: {e}")
-
-            # Add UNIQUE constraint to customer name if missing
-            cursor.execute("PRAGMA index_list(customers)")
-            cust_indices = [idx[1] for idx in cursor.fetchall()]
-            if 'idx_customers_name' not in cust_indices:
-                 try:
-                     cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_customers_name ON customers(name)")
-                     print("Added UNIQUE index to customers.name.")
-                 except sqlite3.Error as e:
-                     print(f"Could not add UNIQUE index to customers.name: {e}")
-
-            # Add UNIQUE constraint to sales order_number if missing
-            cursor.execute("PRAGMA index_list(sales)")
-            sales_indices = [idx[1] for idx in cursor.fetchall()]
-            if 'idx_sales_order_number' not in sales_indices:
-                 try:
-                     cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sales_order_number ON sales(order_number)")
-                     print("Added UNIQUE index to sales.order_number.")
-                 except sqlite3.Error as e:
-                     print(f"Could not add UNIQUE index to sales.order_number: {e}")
-
-
-            # --- Remove remaining_liters from inventory table robustly (if exists) ---
-            cursor.execute("PRAGMA table_info(inventory)")
-            inventory_columns_info = {info[1]: info for info in cursor.fetchall()} # Get full column info
-            if 'remaining_liters' in inventory_columns_info:
-                try:
-                    print("Found 'remaining_liters' column in 'inventory'. Recreating table...")
-                    # 1. Begin transaction
-                    cursor.execute("BEGIN TRANSACTION;")
-                    # 2. Create new table without the column, preserving constraints
-                    cursor.execute('''
-                        CREATE TABLE inventory_new (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            entry_date TEXT NOT NULL,
-                            order_number TEXT NOT NULL UNIQUE, -- Keep UNIQUE
-                            price_per_ton REAL NOT NULL,
-                            quantity_ton REAL NOT NULL,
-                            density REAL NOT NULL,
-                            total_liters REAL NOT NULL
-                        )
-                    ''')
-                    # 3. Copy data from old table to new table
-                    cursor.execute('''
-                        INSERT INTO inventory_new (id, entry_date, order_number, price_per_ton, quantity_ton, density, total_liters)
-                        SELECT id, entry_date, order_number, price_per_ton, quantity_ton, density, total_liters
-                        FROM inventory
-                    ''')
-                    # 4. Drop the old table
-                    cursor.execute("DROP TABLE inventory")
-                    # 5. Rename the new table
-                    cursor.execute("ALTER TABLE inventory_new RENAME TO inventory")
-                    # 6. Commit transaction
-                    cursor.execute("COMMIT;")
-                    print("Successfully removed 'remaining_liters' column and recreated 'inventory' table.")
-                except sqlite3.Error as e:
-                    cursor.execute("ROLLBACK;") # Rollback on error
-                    print(f"Error removing 'remaining_liters' column: {e}. Rolled back changes.")
-            # --- End remove remaining_liters ---
 
-        print("Database initialized/verified successfully.")
 
-    except sqlite3.Error as e:
-        print(f"An error occurred during database initialization: {e}")
-        # Optionally re-raise or handle differently
-    # 'with conn:' handles commit/rollback on success/error and closing cursor implicitly.
-    # Connection closing is handled by the caller (main.py).
+# --- Stock balance ---
+# The remaining liters (SUM(inventory.total_liters) - SUM(sales.quantity_liter))
+# are kept in a single-row table that triggers update on every write, so the
+# lookup is an O(1) read instead of two full-table scans.
+
+STOCK_BALANCE_TRIGGERS = {
+    'trg_stock_inventory_insert': """
+        CREATE TRIGGER IF NOT EXISTS trg_stock_inventory_insert AFTER INSERT ON inventory
+        BEGIN
+            UPDATE stock_balance SET total_in_liters = total_in_liters + NEW.total_liters WHERE id = 1;
+        END""",
+    'trg_stock_inventory_update': """
+        CREATE TRIGGER IF NOT EXISTS trg_stock_inventory_update AFTER UPDATE OF total_liters ON inventory
+        BEGIN
+            UPDATE stock_balance SET total_in_liters = total_in_liters - OLD.total_liters + NEW.total_liters WHERE id = 1;
+        END""",
+    'trg_stock_inventory_delete': """
+        CREATE TRIGGER IF NOT EXISTS trg_stock_inventory_delete AFTER DELETE ON inventory
+        BEGIN
+            UPDATE stock_balance SET total_in_liters = total_in_liters - OLD.total_liters WHERE id = 1;
+        END""",
+    'trg_stock_sales_insert': """
+        CREATE TRIGGER IF NOT EXISTS trg_stock_sales_insert AFTER INSERT ON sales
+        BEGIN
+            UPDATE stock_balance SET total_out_liters = total_out_liters + NEW.quantity_liter WHERE id = 1;
+        END""",
+    'trg_stock_sales_update': """
+        CREATE TRIGGER IF NOT EXISTS trg_stock_sales_update AFTER UPDATE OF quantity_liter ON sales
+        BEGIN
+            UPDATE stock_balance SET total_out_liters = total_out_liters - OLD.quantity_liter + NEW.quantity_liter WHERE id = 1;
+        END""",
+    'trg_stock_sales_delete': """
+        CREATE TRIGGER IF NOT EXISTS trg_stock_sales_delete AFTER DELETE ON sales
+        BEGIN
+            UPDATE stock_balance SET total_out_liters = total_out_liters - OLD.quantity_liter WHERE id = 1;
+        END""",
+}
+
+# Running sums of REAL values drift by rounding; differences below this are not reported
+STOCK_BALANCE_TOLERANCE = 0.01 # Liters
+
+def _ensure_stock_balance(cursor):
+    """ Creates the stock_balance table and its triggers, seeding it from the ledger if new """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_balance (
+            id INTEGER PRIMARY KEY CHECK (id = 1), -- Single row
+            total_in_liters REAL NOT NULL DEFAULT 0.0,  -- SUM(inventory.total_liters)
+            total_out_liters REAL NOT NULL DEFAULT 0.0  -- SUM(sales.quantity_liter)
+        )
+    ''')
+    for trigger_sql in STOCK_BALANCE_TRIGGERS.values():
+        cursor.execute(trigger_sql)
+
+    cursor.execute("SELECT 1 FROM stock_balance WHERE id = 1")
+    if cursor.fetchone() is None:
+        total_in, total_out = _ledger_totals(cursor)
+        cursor.execute("INSERT INTO stock_balance (id, total_in_liters, total_out_liters) VALUES (1, ?, ?)",
+                       (total_in, total_out))
+        print("Created stock_balance from inventory and sales ledger.")
+
+def _ledger_totals(cursor):
+    """ Full-scan totals (liters in, liters out) straight from inventory and sales """
+    cursor.execute("SELECT COALESCE(SUM(total_liters), 0.0) FROM inventory")
+    total_in = cursor.fetchone()[0]
+    cursor.execute("SELECT COALESCE(SUM(quantity_liter), 0.0) FROM sales")
+    total_out = cursor.fetchone()[0]
+    return total_in, total_out
+
+def get_remaining_liters(conn: Connection) -> float:
+    """ Remaining stock in liters, read from the maintained stock_balance row
+    :raises: sqlite3.Error on database errors
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT total_in_liters - total_out_liters FROM stock_balance WHERE id = 1")
+    row = cursor.fetchone()
+    if row is None: # Table not seeded (should not happen after initialize_database)
+        total_in, total_out = _ledger_totals(cursor)
+        return total_in - total_out
+    return row[0]
+
+def verify_stock_balance(conn: Connection) -> tuple:
+    """ Compares the stock_balance row against the inventory/sales ledger
+    :return: (is_consistent, stored_remaining, ledger_remaining)
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT total_in_liters, total_out_liters FROM stock_balance WHERE id = 1")
+    row = cursor.fetchone()
+    total_in, total_out = _ledger_totals(cursor)
+    ledger_remaining = total_in - total_out
+    if row is None:
+        return False, None, ledger_remaining
+    stored_in, stored_out = row
+    is_consistent = (abs(stored_in - total_in) <= STOCK_BALANCE_TOLERANCE and
+                     abs(stored_out - total_out) <= STOCK_BALANCE_TOLERANCE)
+    return is_consistent, stored_in - stored_out, ledger_remaining
+
+def rebuild_stock_balance(conn: Connection) -> float:
+    """ Recomputes stock_balance from the ledger (also restores missing triggers)
+    :return: the rebuilt remaining liters
+    """
+    with conn:
+        cursor = conn.cursor()
+        _ensure_stock_balance(cursor)
+        total_in, total_out = _ledger_totals(cursor)
+        cursor.execute("UPDATE stock_balance SET total_in_liters = ?, total_out_liters = ? WHERE id = 1",
+                       (total_in, total_out))
+    print(f"Rebuilt stock_balance: in={total_in:.2f}, out={total_out:.2f}")
+    return total_in - total_out
+
+# --- Sales rollups ---
+# Per-day and per-month totals for each customer, maintained incrementally by
+# triggers on sales. Statistics read these instead of grouping every ticket.
+
+# Month key of a sale; malformed dates fall back to their first 7 characters
+_SALE_MONTH_SQL = "COALESCE(strftime('%Y-%m', {date}), substr({date}, 1, 7))"
+
+def _rollup_trigger_sql(name, event, steps, removes_old=False):
+    """ :param removes_old: also drop OLD's rollup rows if they are now empty (UPDATE/DELETE);
+    only those two keys are touched, so a write never scans the rollup tables """
+    cleanup = ""
+    if removes_old:
+        month = _SALE_MONTH_SQL.format(date="OLD.sale_date")
+        cleanup = f"""
+            DELETE FROM sales_daily_rollup
+            WHERE sale_date = OLD.sale_date AND customer_id = OLD.customer_id AND sale_count = 0;
+            DELETE FROM sales_monthly_rollup
+            WHERE sale_month = {month} AND customer_id = OLD.customer_id AND sale_count = 0;"""
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON sales
+        BEGIN
+            {steps}{cleanup}
+        END"""
+
+def _rollup_add_sql(row, sign):
+    """ Upserts row (NEW or OLD) into both rollup tables, adding (sign=+) or subtracting (sign=-) it """
+    values = f"{sign}1, {sign}{row}.quantity_liter, {sign}{row}.total_price, {sign}{row}.price_per_liter"
+    update = """
+                sale_count = sale_count + excluded.sale_count,
+                total_liters = total_liters + excluded.total_liters,
+                total_revenue = total_revenue + excluded.total_revenue,
+                sum_price_per_liter = sum_price_per_liter + excluded.sum_price_per_liter;"""
+    month = _SALE_MONTH_SQL.format(date=f"{row}.sale_date")
+    return f"""
+            INSERT INTO sales_daily_rollup (sale_date, customer_id, sale_count, total_liters, total_revenue, sum_price_per_liter)
+            VALUES ({row}.sale_date, {row}.customer_id, {values})
+            ON CONFLICT(sale_date, customer_id) DO UPDATE SET {update}
+            INSERT INTO sales_monthly_rollup (sale_month, customer_id, sale_count, total_liters, total_revenue, sum_price_per_liter)
+            VALUES ({month}, {row}.customer_id, {values})
+            ON CONFLICT(sale_month, customer_id) DO UPDATE SET {update}"""
+
+SALES_ROLLUP_TRIGGERS = {
+    'trg_rollup_sales_insert': _rollup_trigger_sql('trg_rollup_sales_insert', 'INSERT', _rollup_add_sql('NEW', '+')),
+    'trg_rollup_sales_update': _rollup_trigger_sql(
+        'trg_rollup_sales_update',
+        'UPDATE OF customer_id, sale_date, price_per_liter, quantity_liter, total_price',
+        _rollup_add_sql('OLD', '-') + _rollup_add_sql('NEW', '+'), removes_old=True),
+    'trg_rollup_sales_delete': _rollup_trigger_sql('trg_rollup_sales_delete', 'DELETE', _rollup_add_sql('OLD', '-'),
+                                                   removes_old=True),
+}
+
+def _recreate_sales_rollup_triggers(cursor):
+    """ Replaces rollup triggers created before their cleanup was limited to the OLD row's keys """
+    for name, trigger_sql in SALES_ROLLUP_TRIGGERS.items():
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute(trigger_sql)
+
+def _ensure_sales_rollups(cursor):
+    """ Creates the rollup tables and their triggers, filling them from sales if new """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('sales_daily_rollup', 'sales_monthly_rollup')")
+    existing = {row[0] for row in cursor.fetchall()}
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sales_daily_rollup (
+            sale_date TEXT NOT NULL,
+            customer_id INTEGER NOT NULL,
+            sale_count INTEGER NOT NULL DEFAULT 0,
+            total_liters REAL NOT NULL DEFAULT 0.0,
+            total_revenue REAL NOT NULL DEFAULT 0.0,
+            sum_price_per_liter REAL NOT NULL DEFAULT 0.0, -- For AVG(price_per_liter)
+            PRIMARY KEY (sale_date, customer_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sales_monthly_rollup (
+            sale_month TEXT NOT NULL, -- YYYY-MM
+            customer_id INTEGER NOT NULL,
+            sale_count INTEGER NOT NULL DEFAULT 0,
+            total_liters REAL NOT NULL DEFAULT 0.0,
+            total_revenue REAL NOT NULL DEFAULT 0.0,
+            sum_price_per_liter REAL NOT NULL DEFAULT 0.0,
+            PRIMARY KEY (sale_month, customer_id)
+        )
+    ''')
+    for trigger_sql in SALES_ROLLUP_TRIGGERS.values():
+        cursor.execute(trigger_sql)
+    if existing != {'sales_daily_rollup', 'sales_monthly_rollup'}:
+        _fill_sales_rollups(cursor)
+        print("Created sales rollup tables from sales ledger.")
+
+def _fill_sales_rollups(cursor):
+    cursor.execute("DELETE FROM sales_daily_rollup")
+    cursor.execute("DELETE FROM sales_monthly_rollup")
+    cursor.execute('''
+        INSERT INTO sales_daily_rollup (sale_date, customer_id, sale_count, total_liters, total_revenue, sum_price_per_liter)
+        SELECT sale_date, customer_id, COUNT(*), SUM(quantity_liter), SUM(total_price), SUM(price_per_liter)
+        FROM sales
+        GROUP BY sale_date, customer_id
+    ''')
+    cursor.execute(f'''
+        INSERT INTO sales_monthly_rollup (sale_month, customer_id, sale_count, total_liters, total_revenue, sum_price_per_liter)
+        SELECT {_SALE_MONTH_SQL.format(date='sale_date')} AS sale_month, customer_id,
+               COUNT(*), SUM(quantity_liter), SUM(total_price), SUM(price_per_liter)
+        FROM sales
+        GROUP BY sale_month, customer_id
+    ''')
+
+def rebuild_sales_rollups(conn: Connection):
+    """ Recomputes both rollup tables from the sales ledger (also restores missing triggers) """
+    with conn:
+        cursor = conn.cursor()
+        _ensure_sales_rollups(cursor)
+        _fill_sales_rollups(cursor)
+    print("Rebuilt sales rollup tables.")
+
+# --- Sales row count ---
+# COUNT(*) over sales is a full index scan; the sales list only needs the total
+# to number its newest page, so a single-row counter is kept by triggers instead.
+
+SALES_COUNT_TRIGGERS = {
+    'trg_sales_count_insert': """
+        CREATE TRIGGER IF NOT EXISTS trg_sales_count_insert AFTER INSERT ON sales
+        BEGIN
+            UPDATE sales_count SET row_count = row_count + 1 WHERE id = 1;
+        END""",
+    'trg_sales_count_delete': """
+        CREATE TRIGGER IF NOT EXISTS trg_sales_count_delete AFTER DELETE ON sales
+        BEGIN
+            UPDATE sales_count SET row_count = row_count - 1 WHERE id = 1;
+        END""",
+}
+
+def _ensure_sales_count(cursor):
+    """ Creates the sales_count row and its triggers, seeding it with one COUNT(*) if new """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sales_count (
+            id INTEGER PRIMARY KEY CHECK (id = 1), -- Single row
+            row_count INTEGER NOT NULL DEFAULT 0   -- COUNT(*) of sales
+        )
+    ''')
+    for trigger_sql in SALES_COUNT_TRIGGERS.values():
+        cursor.execute(trigger_sql)
+    cursor.execute("SELECT 1 FROM sales_count WHERE id = 1")
+    if cursor.fetchone() is None:
+        cursor.execute("INSERT INTO sales_count (id, row_count) SELECT 1, COUNT(*) FROM sales")
+
+def get_sales_count(conn: Connection) -> int:
+    """ Number of sales, read from the maintained sales_count row
+    :raises: sqlite3.Error on database errors
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT row_count FROM sales_count WHERE id = 1")
+    row = cursor.fetchone()
+    if row is None: # Table not seeded (should not happen after initialize_database)
+        cursor.execute("SELECT COUNT(*) FROM sales")
+        row = cursor.fetchone()
+    return row[0]
+
+def _month_bounds(start_date, end_date):
+    """ First and last month fully covered by [start_date, end_date] (None = unbounded).
+    Returns (first_full_month, last_full_month) as YYYY-MM strings or None.
+    """
+    first_full = last_full = None
+    if start_date:
+        year, month, day = (int(part) for part in start_date.split('-'))
+        if day != 1: # Partial first month: start with the next one
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        first_full = f"{year:04d}-{month:02d}"
+    if end_date:
+        year, month, day = (int(part) for part in end_date.split('-'))
+        next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+        last_day = (datetime(next_year, next_month, 1) - timedelta(days=1)).day
+        if day != last_day: # Partial last month: end with the previous one
+            year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+        last_full = f"{year:04d}-{month:02d}"
+    return first_full, last_full
+
+def _next_month_start(month_key):
+    year, month = (int(part) for part in month_key.split('-'))
+    year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return f"{year:04d}-{month:02d}-01"
+
+def query_sales_rollup(conn: Connection, start_date=None, end_date=None, customer_id=None):
+    """ Sales totals and monthly breakdown for a date range, read from the rollups.
+
+    Whole months inside the range come from sales_monthly_rollup and only the
+    partial months at either edge from sales_daily_rollup, so the cost grows
+    with the number of months rather than the number of tickets.
+
+    :param start_date: YYYY-MM-DD lower bound (inclusive) or None
+    :param end_date: YYYY-MM-DD upper bound (inclusive) or None
+    :param customer_id: restrict to one customer, or None for all
+    :return: ((count, avg_price_per_liter, liters, revenue), [(month, revenue, liters), ...])
+    """
+    cursor = conn.cursor()
+    first_full, last_full = _month_bounds(start_date, end_date)
+    customer_sql = " AND customer_id = ?" if customer_id is not None else ""
+    customer_params = [customer_id] if customer_id is not None else []
+    columns = "SUM(sale_count), SUM(sum_price_per_liter), SUM(total_liters), SUM(total_revenue)"
+    parts = [] # (sql, params) of queries returning (month, count, sum_price, liters, revenue)
+
+    if first_full is None or last_full is None or first_full <= last_full:
+        # Whole months
+        clauses, params = [], []
+        if first_full is not None:
+            clauses.append("sale_month >= ?")
+            params.append(first_full)
+        if last_full is not None:
+            clauses.append("sale_month <= ?")
+            params.append(last_full)
+        where_sql = " AND ".join(clauses) if clauses else "1=1"
+        parts.append((f"SELECT sale_month, {columns} FROM sales_monthly_rollup WHERE {where_sql}{customer_sql} GROUP BY sale_month",
+                      params + customer_params))
+        day_month = _SALE_MONTH_SQL.format(date='sale_date')
+        # Partial first month (days before the first whole month)
+        if start_date and first_full is not None and start_date < f"{first_full}-01":
+            parts.append((f"SELECT {day_month} AS sale_month, {columns} FROM sales_daily_rollup"
+                          f" WHERE sale_date >= ? AND sale_date < ?{customer_sql} GROUP BY sale_month",
+                          [start_date, f"{first_full}-01"] + customer_params))
+        # Partial last month (days after the last whole month)
+        if end_date and last_full is not None and end_date >= _next_month_start(last_full):
+            parts.append((f"SELECT {day_month} AS sale_month, {columns} FROM sales_daily_rollup"
+                          f" WHERE sale_date >= ? AND sale_date <= ?{customer_sql} GROUP BY sale_month",
+                          [_next_month_start(last_full), end_date] + customer_params))
+    else:
+        # Range lies within a single month: days only
+        day_month = _SALE_MONTH_SQL.format(date='sale_date')
+        parts.append((f"SELECT {day_month} AS sale_month, {columns} FROM sales_daily_rollup"
+                      f" WHERE sale_date >= ? AND sale_date <= ?{customer_sql} GROUP BY sale_month",
+                      [start_date, end_date] + customer_params))
+
+    monthly = {} # month -> [count, sum_price, liters, revenue]
+    for sql, params in parts:
+        cursor.execute(sql, params)
+        for month, count, sum_price, liters, revenue in cursor.fetchall():
+            if not count:
+                continue
+            totals = monthly.setdefault(month, [0, 0.0, 0.0, 0.0])
+            totals[0] += count
+            totals[1] += sum_price or 0.0
+            totals[2] += liters or 0.0
+            totals[3] += revenue or 0.0
+
+    sales_count = sum(totals[0] for totals in monthly.values())
+    sum_price = sum(totals[1] for totals in monthly.values())
+    sales_liters = sum(totals[2] for totals in monthly.values())
+    sales_revenue = sum(totals[3] for totals in monthly.values())
+    sales_avg_price = sum_price / sales_count if sales_count else 0.0
+    monthly_rows = [(month, totals[3], totals[2]) for month, totals in sorted(monthly.items(), key=lambda item: item[0] or '')]
+    return (sales_count, sales_avg_price, sales_liters, sales_revenue), monthly_rows
+
+# --- Cost of goods sold ---
+# cogs.py matches sales against inventory lots and stores the cost of every
+# sale in sale_cogs (plus, for FIFO, which lots it drew from). Triggers record
+# the earliest date touched by any write in cogs_state.dirty_from, so the next
+# update only replays events from that date on. '' means "from the start".
+
+COGS_METHODS = ('fifo', 'average')
+
+def _cogs_dirty_sql(date_expr):
+    return f"UPDATE cogs_state SET dirty_from = MIN(COALESCE(dirty_from, {date_expr}), {date_expr});"
+
+def _cogs_trigger_sql(name, event, table, date_column):
+    if event.startswith('UPDATE'):
+        steps = _cogs_dirty_sql(f"OLD.{date_column}") + "\n            " + _cogs_dirty_sql(f"NEW.{date_column}")
+    else:
+        steps = _cogs_dirty_sql(f"{'NEW' if event == 'INSERT' else 'OLD'}.{date_column}")
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table}
+        BEGIN
+            {steps}
+        END"""
+
+COGS_TRIGGERS = {
+    'trg_cogs_inventory_insert': _cogs_trigger_sql('trg_cogs_inventory_insert', 'INSERT', 'inventory', 'entry_date'),
+    'trg_cogs_inventory_update': _cogs_trigger_sql(
+        'trg_cogs_inventory_update', 'UPDATE OF entry_date, price_per_ton, quantity_ton, density, total_liters',
+        'inventory', 'entry_date'),
+    'trg_cogs_inventory_delete': _cogs_trigger_sql('trg_cogs_inventory_delete', 'DELETE', 'inventory', 'entry_date'),
+    'trg_cogs_sales_insert': _cogs_trigger_sql('trg_cogs_sales_insert', 'INSERT', 'sales', 'sale_date'),
+    # Price and customer do not change the cost of a sale
+    'trg_cogs_sales_update': _cogs_trigger_sql('trg_cogs_sales_update', 'UPDATE OF sale_date, quantity_liter', 'sales', 'sale_date'),
+    'trg_cogs_sales_delete': _cogs_trigger_sql('trg_cogs_sales_delete', 'DELETE', 'sales', 'sale_date'),
+}
+
+def _ensure_cogs_tables(cursor):
+    """ Creates the COGS tables and dirty-tracking triggers (a new database starts fully dirty) """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cogs_state (
+            method TEXT PRIMARY KEY,  -- 'fifo' or 'average'
+            dirty_from TEXT           -- Replay events from this date on; NULL = up to date
+        )
+    ''')
+    cursor.executemany("INSERT OR IGNORE INTO cogs_state (method, dirty_from) VALUES (?, '')",
+                       [(method,) for method in COGS_METHODS])
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sale_cogs (
+            method TEXT NOT NULL,
+            sale_id INTEGER NOT NULL,
+            sale_date TEXT NOT NULL,   -- Copy of sales.sale_date, so rows of deleted sales can be rewound
+            liters REAL NOT NULL,
+            cost REAL NOT NULL,        -- 元
+            PRIMARY KEY (method, sale_id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sale_cogs_method_date ON sale_cogs(method, sale_date)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fifo_lot_consumption (
+            sale_id INTEGER NOT NULL,
+            sale_date TEXT NOT NULL,
+            inventory_id INTEGER,      -- NULL: sold beyond the recorded stock, costed at the latest lot price
+            liters REAL NOT NULL,
+            cost REAL NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fifo_lot_consumption_date ON fifo_lot_consumption(sale_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fifo_lot_consumption_lot ON fifo_lot_consumption(inventory_id)")
+    for trigger_sql in COGS_TRIGGERS.values():
+        cursor.execute(trigger_sql)
+
+def query_cogs(conn: Connection, method, start_date=None, end_date=None, customer_id=None):
+    """ Cost of goods sold for a date range, read from sale_cogs (run cogs.update_cogs first)
+    :return: (total_cost, {month: cost}) with the same month keys as query_sales_rollup
+    """
+    clauses, params = ["sc.method = ?"], [method]
+    if start_date:
+        clauses.append("sc.sale_date >= ?")
+        params.append(start_date)
+    if end_date:
+        clauses.append("sc.sale_date <= ?")
+        params.append(end_date)
+    join_sql = ""
+    if customer_id is not None:
+        join_sql = "JOIN sales s ON s.id = sc.sale_id"
+        clauses.append("s.customer_id = ?")
+        params.append(customer_id)
+    month = _SALE_MONTH_SQL.format(date='sc.sale_date')
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT {month} AS sale_month, SUM(sc.cost)
+        FROM sale_cogs sc {join_sql}
+        WHERE {" AND ".join(clauses)}
+        GROUP BY sale_month
+    """, params)
+    monthly = {month_key: cost or 0.0 for month_key, cost in cursor.fetchall()}
+    return sum(monthly.values()), monthly
+
+# --- Change log ---
+# Append-only journal of writes to inventory, sales and customers, filled by
+# triggers, so consumers (tree views, statistics cache, exports) can catch up
+# on what changed since their last run instead of rescanning whole tables.
+# seq is AUTOINCREMENT: strictly increasing and never reused, also after
+# pruning. Persistent consumers keep their last processed seq in
+# change_cursors; change_log_state.pruned_through is the highest seq already
+# deleted, so a consumer behind it knows it has to rescan.
+
+CHANGE_LOG_TABLES = ('inventory', 'sales', 'customers')
+CHANGE_LOG_KEEP = 50000 # Entries kept by prune_change_log
+_CHANGE_LOG_OPS = {'INSERT': ('I', 'NEW'), 'UPDATE': ('U', 'NEW'), 'DELETE': ('D', 'OLD')}
+
+def _change_log_trigger_sql(table, event):
+    op, row = _CHANGE_LOG_OPS[event]
+    name = f"trg_change_log_{table}_{event.lower()}"
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table}
+        BEGIN
+            INSERT INTO change_log (table_name, row_id, op) VALUES ('{table}', {row}.id, '{op}');
+        END"""
+
+CHANGE_LOG_TRIGGERS = [_change_log_trigger_sql(table, event)
+                       for table in CHANGE_LOG_TABLES for event in _CHANGE_LOG_OPS]
+
+def _ensure_change_log(cursor):
+    """ Creates the change log, its consumer cursors and the triggers that fill it """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,   -- 'inventory', 'sales' or 'customers'
+            row_id INTEGER NOT NULL,    -- id of the changed row
+            op TEXT NOT NULL,           -- 'I'nsert, 'U'pdate or 'D'elete
+            changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            pruned_through INTEGER NOT NULL  -- Entries with seq <= this were deleted
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO change_log_state (id, pruned_through) VALUES (1, 0)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_cursors (
+            consumer TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL         -- Last change_log.seq the consumer has processed
+        )
+    ''')
+    for trigger_sql in CHANGE_LOG_TRIGGERS:
+        cursor.execute(trigger_sql)
+
+def latest_change_seq(conn: Connection) -> int:
+    """ seq of the newest change_log entry (0 if none was ever written) """
+    cursor = conn.cursor()
+    # sqlite_sequence also remembers the last seq after everything was pruned
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def changes_since(conn: Connection, after_seq, through_seq=None, tables=None):
+    """ Changes with after_seq < seq <= through_seq, one entry per changed row
+    :param tables: iterable of table names to include (all if None)
+    :return: {table: {row_id: op}} where op is the row's net change: 'I' for a
+             row inserted in the range (even if updated afterwards), 'D' if it
+             was deleted, else 'U'; or None if entries after after_seq were
+             already pruned (the consumer has to rescan)
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT pruned_through FROM change_log_state WHERE id = 1")
+    row = cursor.fetchone()
+    if row and after_seq < row[0]:
+        return None
+    sql = "SELECT table_name, row_id, op FROM change_log WHERE seq > ?"
+    params = [after_seq]
+    if through_seq is not None:
+        sql += " AND seq <= ?"
+        params.append(through_seq)
+    if tables is not None:
+        tables = list(tables)
+        sql += f" AND table_name IN ({','.join('?' * len(tables))})"
+        params.extend(tables)
+    cursor.execute(sql + " ORDER BY seq", params)
+    changes = {}
+    for table, row_id, op in cursor.fetchall():
+        rows = changes.setdefault(table, {})
+        if op == 'U' and rows.get(row_id) == 'I':
+            continue # Still new to the consumer
+        rows[row_id] = op
+    return changes
+
+def get_change_cursor(conn: Connection, consumer) -> int | None:
+    """ Last seq processed by a persistent consumer, or None if it never ran """
+    cursor = conn.cursor()
+    cursor.execute("SELECT seq FROM change_cursors WHERE consumer = ?", (consumer,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def set_change_cursor(conn: Connection, consumer, seq):
+    """ Stores a consumer's position (call inside the transaction that applies its changes) """
+    conn.execute("INSERT OR REPLACE INTO change_cursors (consumer, seq) VALUES (?, ?)", (consumer, seq))
+
+def prune_change_log(conn: Connection, keep=CHANGE_LOG_KEEP) -> int:
+    """ Deletes all but the newest `keep` change_log entries
+    :return: number of entries deleted
+    """
+    through = latest_change_seq(conn) - keep
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pruned_through FROM change_log_state WHERE id = 1")
+        row = cursor.fetchone()
+        if through <= (row[0] if row else 0):
+            return 0
+        cursor.execute("DELETE FROM change_log WHERE seq <= ?", (through,))
+        deleted = cursor.rowcount
+        cursor.execute("INSERT OR REPLACE INTO change_log_state (id, pruned_through) VALUES (1, ?)", (through,))
+    if deleted:
+        print(f"Pruned {deleted} change log entries (through seq {through}).")
+    return deleted
+
+# --- Schema migrations ---
+# Each step runs once, in order, inside its own transaction; PRAGMA user_version
+# records the last applied step and schema_migrations keeps the history.
+# Steps must be idempotent: databases created before versioning went through
+# (parts of) them already.
+
+# Secondary indexes for the hot query paths
+SECONDARY_INDEXES = [
+    # Next order number: WHERE customer_id = ? ORDER BY id DESC LIMIT 1 (also the delete-customer check)
+    "CREATE INDEX IF NOT EXISTS idx_sales_customer_id_id ON sales(customer_id, id)",
+    # Statistics/export date ranges, optionally per customer
+    "CREATE INDEX IF NOT EXISTS idx_sales_sale_date_customer ON sales(sale_date, customer_id)",
+    # Export inventory date range
+    "CREATE INDEX IF NOT EXISTS idx_inventory_entry_date ON inventory(entry_date)",
+]
+
+def _migration_base_schema(cursor):
+    _create_base_schema(cursor)
+    # Materialized stock balance (after any inventory table rebuild, which drops its triggers)
+    _ensure_stock_balance(cursor)
+    # Daily/monthly sales rollups for statistics
+    _ensure_sales_rollups(cursor)
+    for statement in SECONDARY_INDEXES:
+        cursor.execute(statement)
+
+MIGRATIONS = [
+    # Version 1 was the secondary index migration; it now also covers the base
+    # schema, which is already in place on every database that reached it
+    (1, "base schema, stock balance, sales rollups and secondary indexes", _migration_base_schema),
+    # Per-sale cost of goods (computed by cogs.py) and its change tracking
+    (2, "cost of goods sold tables", _ensure_cogs_tables),
+    # Change data capture for incremental consumers
+    (3, "change log of inventory, sales and customers", _ensure_change_log),
+    # Rollup triggers no longer scan both rollup tables on every sale write
+    (4, "key-scoped sales rollup cleanup", _recreate_sales_rollup_triggers),
+    # Sales row count for numbering the paged sales list without COUNT(*)
+    (5, "maintained sales row count", _ensure_sales_count),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def _apply_migrations(conn: Connection, current_version):
+    cursor = conn.cursor()
+    for version, description, migrate in MIGRATIONS:
+        if version <= current_version:
+            continue
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have migrated while we waited for the lock
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TEXT NOT NULL,  -- Local time, YYYY-MM-DD HH:MM:SS
+                    duration_ms REAL NOT NULL
+                )
+            ''')
+            migrate(cursor)
+            cursor.execute("INSERT OR REPLACE INTO schema_migrations (version, description, applied_at, duration_ms) VALUES (?, ?, ?, ?)",
+                           (version, description, datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            (time.perf_counter() - started) * 1000))
+            cursor.execute(f"PRAGMA user_version = {int(version)}") # Part of the transaction
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        print(f"Applied migration {version}: {description}")
+
+# --- Query plan regression check ---
+# Every query the app issues on a potentially large table, with the index (or
+# rowid access) EXPLAIN QUERY PLAN is expected to mention. A missing index or a
+# query rewritten into a full scan shows up as a failure here.
+QUERY_PLAN_CHECKS = [
+    ("next sales order number",
+     "SELECT order_number FROM sales WHERE customer_id = ? ORDER BY id DESC LIMIT 1", (1,),
+     "idx_sales_customer_id_id"),
+    ("last order number per customer",
+     "SELECT customer_id, MAX(id) FROM sales GROUP BY customer_id", (),
+     "COVERING INDEX idx_sales_customer_id_id"),
+    ("customer has sales",
+     "SELECT 1 FROM sales WHERE customer_id = ?", (1,),
+     "idx_sales_customer_id_id"),
+    ("sales order number duplicate check",
+     "SELECT id FROM sales WHERE order_number = ? AND id != ?", ('01', 1),
+     "(order_number=?)"),
+    ("inventory order number duplicate check",
+     "SELECT id FROM inventory WHERE order_number = ? AND id != ?", ('01', 1),
+     "(order_number=?)"),
+    ("sales list next page",
+     "SELECT s.id, c.name FROM sales s LEFT JOIN customers c ON s.customer_id = c.id WHERE s.id > ? ORDER BY s.id ASC LIMIT ?", (0, 200),
+     "USING INTEGER PRIMARY KEY"),
+    ("sales list previous page",
+     "SELECT s.id, c.name FROM sales s LEFT JOIN customers c ON s.customer_id = c.id WHERE s.id < ? ORDER BY s.id DESC LIMIT ?", (0, 200),
+     "USING INTEGER PRIMARY KEY"),
+    ("earliest sale date",
+     "SELECT MIN(sale_date) FROM sales", (),
+     "idx_sales_sale_date_customer"),
+    ("export inventory by date",
+     "SELECT id, entry_date FROM inventory WHERE entry_date >= ? AND entry_date <= ? ORDER BY id ASC", ('2024-01-01', '2024-12-31'),
+     "idx_inventory_entry_date"),
+    ("export sales by date",
+     "SELECT s.id, c.name FROM sales s LEFT JOIN customers c ON s.customer_id = c.id"
+     " WHERE s.sale_date >= ? AND s.sale_date <= ? ORDER BY s.id ASC", ('2024-01-01', '2024-12-31'),
+     "idx_sales_sale_date_customer"),
+    ("export customer sales by date",
+     "SELECT s.id FROM sales s WHERE s.customer_id = ? AND (s.sale_date >= ? AND s.sale_date <= ?) ORDER BY s.id ASC", (1, '2024-01-01', '2024-12-31'),
+     "idx_sales_"),
+    ("export summary by date",
+     "SELECT c.name, COUNT(s.id) FROM sales s LEFT JOIN customers c ON s.customer_id = c.id"
+     " WHERE s.sale_date >= ? AND s.sale_date <= ? GROUP BY c.id, c.name", ('2024-01-01', '2024-12-31'),
+     "idx_sales_sale_date_customer"),
+    ("daily rollup range",
+     "SELECT sale_date, SUM(sale_count) FROM sales_daily_rollup WHERE sale_date >= ? AND sale_date < ? GROUP BY sale_date", ('2024-01-15', '2024-02-01'),
+     "sqlite_autoindex_sales_daily_rollup_1"),
+    ("monthly rollup range",
+     "SELECT sale_month, SUM(sale_count) FROM sales_monthly_rollup WHERE sale_month >= ? AND sale_month <= ? GROUP BY sale_month", ('2024-02', '2024-11'),
+     "sqlite_autoindex_sales_monthly_rollup_1"),
+]
+
+def check_query_plans(conn: Connection) -> list:
+    """ Runs EXPLAIN QUERY PLAN for every entry in QUERY_PLAN_CHECKS
+    :return: list of (name, ok, plan_text) tuples
+    """
+    results = []
+    cursor = conn.cursor()
+    for name, sql, params, expected in QUERY_PLAN_CHECKS:
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        plan_text = "; ".join(row[3] for row in cursor.fetchall())
+        results.append((name, expected in plan_text, plan_text))
+    return results
 
 # Example usage (optional, for testing this module directly)
 if __name__ == '__main__':
+    import sys
+    if len(sys.argv) >= 2 and sys.argv[1] == '--check-plans':
+        # python database.py --check-plans [db_file]
+        db_file = sys.argv[2] if len(sys.argv) > 2 else 'diesel_sales.db'
+        conn = create_connection(db_file)
+        initialize_database(conn)
+        failures = 0
+        for name, ok, plan_text in check_query_plans(conn):
+            print(f"[{'OK' if ok else 'FAIL'}] {name}: {plan_text}")
+            failures += 0 if ok else 1
+        conn.close()
+        sys.exit(1 if failures else 0)
+
     db_file = 'test_diesel_sales.db'
     conn = create_connection(db_file)
     if conn:
@@ -0,0 +1,480 @@
+import os
+import re
+
+import cogs
+import database
+
+# Rows fetched from SQLite and appended to a sheet per round trip
+EXPORT_CHUNK_SIZE = 1000
+
+# Sheet headers (same columns and order as the 模版.xlsx template)
+INVENTORY_HEADERS = ['序号', '入库日期', '入库单号', '单价(吨/元)', '数量(吨)', '密度', '总升数']
+SALES_HEADERS = ['序号', '客户名称', '销售日期', '销售单号', '单价(元/升)', '数量(升)', '总价(元)', '成本(元)', '毛利(元)']
+CUSTOMER_SALES_HEADERS = ['序号', '销售日期', '销售单号', '单价(元/升)', '数量(升)', '总价(元)']
+SUMMARY_HEADERS = ['客户名称', '总交易次数', '总销售数量(升)', '总销售金额(元)']
+
+# Hidden sheet of workbooks kept up to date by export_workbook_incremental:
+# which database and costing method it was written from, and the sheet of each customer
+STATE_SHEET = '_导出状态'
+FIXED_SHEETS = {'入库记录', '销售记录', '销售汇总', STATE_SHEET}
+
+
+def build_date_filters(start_date_str, end_date_str):
+    """
+    Returns (inv_where_sql, inv_params, sales_where_sql, sales_params) for the
+    given (already validated) YYYY-MM-DD bounds; None means unbounded.
+    """
+    inv_where_clauses = []
+    inv_params = []
+    sales_where_clauses = []
+    sales_params = []
+    if start_date_str:
+        inv_where_clauses.append("entry_date >= ?")
+        inv_params.append(start_date_str)
+        sales_where_clauses.append("s.sale_date >= ?")
+        sales_params.append(start_date_str)
+    if end_date_str:
+        inv_where_clauses.append("entry_date <= ?")
+        inv_params.append(end_date_str)
+        sales_where_clauses.append("s.sale_date <= ?")
+        sales_params.append(end_date_str)
+    inv_where_sql = " AND ".join(inv_where_clauses) if inv_where_clauses else "1=1"
+    sales_where_sql = " AND ".join(sales_where_clauses) if sales_where_clauses else "1=1"
+    return inv_where_sql, inv_params, sales_where_sql, sales_params
+
+
+def sanitize_sheet_name(customer_name, customer_id, used_names):
+    """Makes a valid, unique (<= 31 chars, no []:*?/\\) sheet name for a customer."""
+    invalid_chars = r'[\\/?*\[\]:]'
+    sanitized_name = re.sub(invalid_chars, '', customer_name or '')
+    sanitized_name = sanitized_name[:31]
+
+    if not sanitized_name:
+        sanitized_name = f"客户_{customer_id}"
+
+    sheet_suffix = 1
+    original_sanitized_name = sanitized_name
+    while sanitized_name in used_names:
+        sheet_suffix += 1
+        max_base_len = 31 - len(str(sheet_suffix)) - 1
+        truncated_base = original_sanitized_name[:max_base_len]
+        sanitized_name = f"{truncated_base}_{sheet_suffix}"
+        if len(sanitized_name) > 31:
+             sanitized_name = sanitized_name[:31]
+    return sanitized_name
+
+
+def _header_row(worksheet, headers):
+    """Header cells styled like pandas' to_excel output (bold, thin border, centered)."""
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Border, Font, Side
+
+    thin = Side(style="thin")
+    cells = []
+    for title in headers:
+        cell = WriteOnlyCell(worksheet, value=title)
+        cell.font = Font(bold=True)
+        cell.border = Border(left=thin, right=thin, top=thin, bottom=thin)
+        cell.alignment = Alignment(horizontal="center", vertical="top")
+        cells.append(cell)
+    return cells
+
+
+def write_sheet(workbook, sheet_name, headers, cursor, first_rows=None, chunk_size=EXPORT_CHUNK_SIZE, on_chunk=None):
+    """
+    Streams the remaining rows of an executed cursor into a new write-only sheet.
+
+    :param first_rows: rows already fetched from the cursor (written first)
+    :param on_chunk: callable(row_count) called after each chunk is written
+    :return: number of data rows written
+    """
+    worksheet = workbook.create_sheet(title=sheet_name)
+    worksheet.append(_header_row(worksheet, headers))
+    row_count = 0
+    rows = first_rows if first_rows is not None else cursor.fetchmany(chunk_size)
+    while rows:
+        for row in rows:
+            worksheet.append(row)
+        row_count += len(rows)
+        if on_chunk:
+            on_chunk(len(rows))
+        rows = cursor.fetchmany(chunk_size)
+    return row_count
+
+
+def write_customer_sheets(workbook, cursor, used_names, chunk_size=EXPORT_CHUNK_SIZE, on_chunk=None, sheet_map=None):
+    """
+    Splits an executed cursor of (customer_id, customer_name, *sale columns)
+    rows, ordered by customer, into one write-only sheet per customer.
+
+    Only customers that have rows get a sheet; names are sanitized and
+    de-duplicated against used_names (which is updated) as the stream goes by.
+
+    :param sheet_map: optional dict filled with {customer_id: (customer_name, sheet_name)}
+    :return: number of customer sheets written
+    """
+    worksheet = None
+    current_customer_id = None
+    sheet_count = 0
+    rows = cursor.fetchmany(chunk_size)
+    while rows:
+        for customer_id, customer_name, *sale_row in rows:
+            if worksheet is None or customer_id != current_customer_id:
+                # Next customer in the stream: start its sheet
+                current_customer_id = customer_id
+                sheet_name = sanitize_sheet_name(customer_name, customer_id, used_names)
+                used_names.add(sheet_name)
+                worksheet = workbook.create_sheet(title=sheet_name)
+                worksheet.append(_header_row(worksheet, CUSTOMER_SALES_HEADERS))
+                sheet_count += 1
+                if sheet_map is not None:
+                    sheet_map[customer_id] = (customer_name, sheet_name)
+            worksheet.append(sale_row)
+        if on_chunk:
+            on_chunk(len(rows))
+        rows = cursor.fetchmany(chunk_size)
+    return sheet_count
+
+
+def export_workbook(conn, save_path, start_date_str=None, end_date_str=None, chunk_size=EXPORT_CHUNK_SIZE, progress=None,
+                    cogs_method=cogs.DEFAULT_METHOD, track_changes=False):
+    """
+    Writes inventory, sales, per-customer sales and the sales summary to an
+    .xlsx file, filtered by the given date bounds.
+
+    Rows are streamed from SQLite in chunks into openpyxl write-only sheets, so
+    memory use stays flat regardless of the size of the history. The file is
+    only written at the very end, so an exception raised by progress (e.g. a
+    cancelled job) leaves no partial file behind.
+
+    :param progress: optional callable(fraction, message) called after each chunk
+    :param cogs_method: costing method for the 成本/毛利 columns of the sales sheet
+    :param track_changes: also write the hidden state sheet export_workbook_incremental needs
+    :raises: sqlite3.Error on query errors, ImportError if openpyxl is missing
+    """
+    from openpyxl import Workbook
+
+    inv_where_sql, inv_params, sales_where_sql, sales_params = build_date_filters(start_date_str, end_date_str)
+    workbook = Workbook(write_only=True)
+    cursor = conn.cursor()
+    # Per-sale cost for the sales sheet (replays only what changed since the last update)
+    cogs.update_cogs(conn, cogs_method, progress=progress)
+
+    # --- Progress tracking (inventory rows once, sales rows twice: sales sheet + customer sheets) ---
+    on_chunk = None
+    if progress:
+        cursor.execute(f"SELECT COUNT(*) FROM inventory WHERE {inv_where_sql}", inv_params)
+        inv_total = cursor.fetchone()[0]
+        cursor.execute(f"SELECT COUNT(*) FROM sales s WHERE {sales_where_sql}", sales_params)
+        sales_total = cursor.fetchone()[0]
+        total_rows = max(inv_total + 2 * sales_total, 1)
+        written = [0]
+
+        def on_chunk(row_count):
+            written[0] += row_count
+            progress(min(written[0] / total_rows, 1.0), f"已导出 {written[0]} / {total_rows} 行")
+        progress(0.0, "正在导出...")
+
+    # Inventory sheet
+    cursor.execute(f"SELECT id, entry_date, order_number, price_per_ton, quantity_ton, density, total_liters FROM inventory WHERE {inv_where_sql} ORDER BY id ASC", inv_params)
+    write_sheet(workbook, '入库记录', INVENTORY_HEADERS, cursor, chunk_size=chunk_size, on_chunk=on_chunk)
+
+    # Sales sheet with customer names
+    cursor.execute(f"""
+        SELECT s.id, c.name, s.sale_date, s.order_number, s.price_per_liter, s.quantity_liter, s.total_price,
+               sc.cost, s.total_price - sc.cost
+        FROM sales s
+        LEFT JOIN customers c ON s.customer_id = c.id
+        LEFT JOIN sale_cogs sc ON sc.method = ? AND sc.sale_id = s.id
+        WHERE {sales_where_sql} -- Apply date filter
+        ORDER BY s.id ASC
+    """, [cogs_method] + sales_params)
+    write_sheet(workbook, '销售记录', SALES_HEADERS, cursor, chunk_size=chunk_size, on_chunk=on_chunk)
+
+    # --- Add per-customer sheets ---
+    # One query over the filtered sales, ordered by customer, split into sheets in a single pass
+    cursor.execute(f"""
+        SELECT c.id, c.name, s.id, s.sale_date, s.order_number, s.price_per_liter, s.quantity_liter, s.total_price
+        FROM sales s
+        JOIN customers c ON s.customer_id = c.id
+        WHERE {sales_where_sql} -- Apply date filter
+        ORDER BY c.name ASC, c.id ASC, s.id ASC
+    """, sales_params)
+    customer_sheets = {}
+    write_customer_sheets(workbook, cursor, set(FIXED_SHEETS), chunk_size=chunk_size, on_chunk=on_chunk, sheet_map=customer_sheets)
+    # --- End add per-customer sheets ---
+
+    # --- Add Sales Summary Sheet ---
+    cursor.execute(f"""
+        SELECT
+            c.name AS customer_name,
+            COUNT(s.id) AS transaction_count,
+            SUM(s.quantity_liter) AS total_quantity,
+            SUM(s.total_price) AS total_amount
+        FROM sales s
+        LEFT JOIN customers c ON s.customer_id = c.id
+        WHERE {sales_where_sql} -- Apply the same date filters
+        GROUP BY c.id, c.name
+        ORDER BY c.name ASC
+    """, sales_params)
+    write_sheet(workbook, '销售汇总', SUMMARY_HEADERS, cursor, chunk_size=chunk_size)
+    # --- End Sales Summary Sheet ---
+
+    if track_changes:
+        _write_state_sheet(workbook.create_sheet(title=STATE_SHEET), conn, cogs_method, customer_sheets)
+
+    if progress:
+        progress(1.0, "正在保存文件...")
+    workbook.save(save_path)
+
+
+# --- Incremental export ---
+# A running workbook that is brought up to date with only what changed since
+# it was last written, read from the change log (database.changes_since). Its
+# position is kept per target file in change_cursors; the workbook itself is
+# the state for everything else (exported rows and summary totals).
+
+# Columns (1-based) of the sheets written above
+_INVENTORY_DATE_COL = 2
+_SALES_NAME_COL, _SALES_DATE_COL, _SALES_QTY_COL, _SALES_TOTAL_COL, _SALES_COST_COL, _SALES_PROFIT_COL = 2, 3, 6, 7, 8, 9
+
+
+def incremental_consumer(save_path):
+    """change_cursors key of an incrementally exported workbook."""
+    return 'excel:' + os.path.normcase(os.path.abspath(save_path))
+
+
+def _database_file(conn):
+    for _, name, file_name in conn.execute("PRAGMA database_list"):
+        if name == 'main':
+            return os.path.normcase(os.path.abspath(file_name)) if file_name else ''
+    return ''
+
+
+def _write_state_sheet(worksheet, conn, cogs_method, customer_sheets):
+    worksheet.sheet_state = 'hidden'
+    worksheet.append(['database', _database_file(conn)])
+    worksheet.append(['cogs_method', cogs_method])
+    for customer_id, (customer_name, sheet_name) in customer_sheets.items():
+        worksheet.append(['customer_sheet', customer_id, customer_name, sheet_name])
+
+
+def _read_state_sheet(workbook):
+    """:return: (database file, cogs method, {customer_name: (customer_id, sheet_name)}) or None"""
+    if STATE_SHEET not in workbook.sheetnames:
+        return None
+    database_file = cogs_method = None
+    customer_sheets = {}
+    for key, *values in workbook[STATE_SHEET].iter_rows(values_only=True):
+        if key == 'database':
+            database_file = values[0] or ''
+        elif key == 'cogs_method':
+            cogs_method = values[0]
+        elif key == 'customer_sheet':
+            customer_sheets[values[1]] = (values[0], values[2])
+    return database_file, cogs_method, customer_sheets
+
+
+def _row_index(worksheet):
+    """{id in column A: row number} of a sheet with a header row."""
+    return {row[0]: index for index, row in enumerate(worksheet.iter_rows(min_row=2, max_col=1, values_only=True), start=2)
+            if row[0] is not None}
+
+
+def _set_row(worksheet, index, values):
+    for column, value in enumerate(values, start=1):
+        worksheet.cell(row=index, column=column, value=value)
+
+
+def _fetch_by_ids(cursor, sql, ids):
+    """Runs sql (with an `IN ({ids})` placeholder) over ids in chunks, yielding rows."""
+    ids = sorted(ids)
+    for start in range(0, len(ids), EXPORT_CHUNK_SIZE):
+        chunk = ids[start:start + EXPORT_CHUNK_SIZE]
+        cursor.execute(sql.format(ids=','.join('?' * len(chunk))), chunk)
+        yield from cursor.fetchall()
+
+
+def _save_replacing(workbook, save_path):
+    """Saves next to save_path first, so a failed save leaves the old workbook intact."""
+    temp_path = save_path + '.tmp'
+    try:
+        workbook.save(temp_path)
+        os.replace(temp_path, save_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def export_workbook_incremental(conn, save_path, cogs_method=cogs.DEFAULT_METHOD, progress=None):
+    """
+    Brings a running workbook (all dates, no filter) up to date with the database.
+
+    The first run, or any run the change log cannot serve (workbook missing,
+    written from another database or costing method, log pruned past its
+    position, a customer renamed), writes the whole workbook like
+    export_workbook. Later runs only apply the inventory and sales rows
+    inserted, edited or deleted since the previous run: rows are updated in
+    place, appended or removed, 销售汇总 totals are adjusted by the
+    difference between each changed row's exported and current values, and
+    the 成本/毛利 cells are refreshed only from the earliest changed date on.
+    History is not queried again.
+
+    Applying the same changes twice is harmless, so the position is stored
+    (after the file was saved) as the seq read before any data.
+
+    :param progress: optional callable(fraction, message)
+    :return: ('full' or 'incremental', number of changed rows applied)
+    :raises: sqlite3.Error on query errors, ImportError if openpyxl is missing
+    """
+    from openpyxl import load_workbook
+
+    consumer = incremental_consumer(save_path)
+    latest = database.latest_change_seq(conn)
+    since = database.get_change_cursor(conn, consumer)
+    changes = workbook = None
+    if since is not None and os.path.exists(save_path):
+        changes = database.changes_since(conn, since, latest)
+    if changes is not None and 'U' not in changes.get('customers', {}).values():
+        if progress:
+            progress(None, "正在读取工作簿...")
+        workbook = load_workbook(save_path)
+        state = _read_state_sheet(workbook)
+        if state is None or state[0] != _database_file(conn) or state[1] != cogs_method:
+            workbook = None
+
+    if workbook is None:
+        # Start (or restart) the running workbook from scratch
+        export_workbook(conn, save_path, chunk_size=EXPORT_CHUNK_SIZE, progress=progress,
+                        cogs_method=cogs_method, track_changes=True)
+        mode, applied = 'full', None
+    else:
+        applied = _apply_changes(conn, workbook, state[2], changes, cogs_method, progress)
+        if progress:
+            progress(1.0, "正在保存文件...")
+        _save_replacing(workbook, save_path)
+        mode = 'incremental'
+    with conn:
+        database.set_change_cursor(conn, consumer, latest)
+    print(f"Excel export ({mode}) of '{save_path}' is at change {latest}")
+    return mode, applied
+
+
+def _apply_changes(conn, workbook, customer_sheets, changes, cogs_method, progress):
+    """Applies inventory and sales changes to a loaded running workbook; returns the number of rows changed."""
+    cursor = conn.cursor()
+    inventory_changes = changes.get('inventory', {})
+    sales_changes = changes.get('sales', {})
+    inventory_sheet, sales_sheet = workbook['入库记录'], workbook['销售记录']
+    inventory_rows, sales_rows = _row_index(inventory_sheet), _row_index(sales_sheet)
+    deletions = [] # (sheet, row number), removed last so row numbers stay valid
+    changed_dates = []
+
+    # --- Inventory ---
+    for inventory_id, op in inventory_changes.items():
+        if inventory_id in inventory_rows:
+            changed_dates.append(inventory_sheet.cell(row=inventory_rows[inventory_id], column=_INVENTORY_DATE_COL).value)
+            if op == 'D':
+                deletions.append((inventory_sheet, inventory_rows[inventory_id]))
+    live = [inventory_id for inventory_id, op in inventory_changes.items() if op != 'D']
+    for row in _fetch_by_ids(cursor, "SELECT id, entry_date, order_number, price_per_ton, quantity_ton, density, total_liters FROM inventory WHERE id IN ({ids}) ORDER BY id", live):
+        changed_dates.append(row[1])
+        if row[0] in inventory_rows:
+            _set_row(inventory_sheet, inventory_rows[row[0]], row)
+        else:
+            inventory_sheet.append(row)
+
+    # --- Sales: take out what was exported, from the summary and the customer sheets ---
+    summary = {} # customer name -> [transaction count, quantity, amount]
+    for name, count, quantity, amount in workbook['销售汇总'].iter_rows(min_row=2, values_only=True):
+        summary[name] = [count or 0, quantity or 0.0, amount or 0.0]
+    customer_rows = {} # sheet name -> {sale id: row number}, read on first use
+
+    def customer_sheet_rows(sheet_name):
+        if sheet_name not in customer_rows:
+            customer_rows[sheet_name] = _row_index(workbook[sheet_name])
+        return customer_rows[sheet_name]
+
+    for sale_id, op in sales_changes.items():
+        if sale_id not in sales_rows:
+            continue
+        index = sales_rows[sale_id]
+        name, sale_date, quantity, amount = (sales_sheet.cell(row=index, column=column).value for column in
+                                             (_SALES_NAME_COL, _SALES_DATE_COL, _SALES_QTY_COL, _SALES_TOTAL_COL))
+        changed_dates.append(sale_date)
+        totals = summary.get(name)
+        if totals is not None:
+            totals[0] -= 1
+            totals[1] -= quantity or 0.0
+            totals[2] -= amount or 0.0
+        sheet_name = customer_sheets.get(name, (None, None))[1]
+        if sheet_name in workbook.sheetnames and sale_id in customer_sheet_rows(sheet_name):
+            deletions.append((workbook[sheet_name], customer_sheet_rows(sheet_name).pop(sale_id)))
+        if op == 'D':
+            deletions.append((sales_sheet, index))
+
+    # --- Sales: put back the current rows ---
+    live = [sale_id for sale_id, op in sales_changes.items() if op != 'D']
+    rows = _fetch_by_ids(cursor, """
+        SELECT s.id, c.name, s.sale_date, s.order_number, s.price_per_liter, s.quantity_liter, s.total_price, c.id
+        FROM sales s
+        LEFT JOIN customers c ON s.customer_id = c.id
+        WHERE s.id IN ({ids})
+        ORDER BY s.id ASC
+    """, live)
+    used_names = set(workbook.sheetnames)
+    for *row, customer_id in rows:
+        sale_id, name, sale_date, _, _, quantity, amount = row
+        changed_dates.append(sale_date)
+        row += [None, None] # 成本/毛利, filled in below
+        if sale_id in sales_rows:
+            _set_row(sales_sheet, sales_rows[sale_id], row)
+        else:
+            sales_sheet.append(row)
+            sales_rows[sale_id] = sales_sheet.max_row
+        totals = summary.setdefault(name, [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += quantity or 0.0
+        totals[2] += amount or 0.0
+        if customer_id is None:
+            continue
+        if name not in customer_sheets:
+            # First exported sale of this customer
+            sheet_name = sanitize_sheet_name(name, customer_id, used_names)
+            used_names.add(sheet_name)
+            worksheet = workbook.create_sheet(title=sheet_name)
+            worksheet.append(_header_row(worksheet, CUSTOMER_SALES_HEADERS)) # Styled like the full export
+            customer_sheets[name] = (customer_id, sheet_name)
+        # Edited sales were taken out above: append in sale order (the sheet is not re-sorted)
+        workbook[customer_sheets[name][1]].append([row[0]] + row[2:7])
+
+    # --- Costs: a change on some date re-costs every sale on or after it ---
+    changed_dates = [changed_date for changed_date in changed_dates if changed_date]
+    if changed_dates:
+        if progress:
+            progress(None, "正在更新成本...")
+        cogs.update_cogs(conn, cogs_method, progress=progress)
+        cursor.execute("SELECT sale_id, cost FROM sale_cogs WHERE method = ? AND sale_date >= ?",
+                       (cogs_method, min(changed_dates)))
+        for sale_id, cost in cursor.fetchall():
+            index = sales_rows.get(sale_id)
+            if index is None or sales_changes.get(sale_id) == 'D':
+                continue
+            amount = sales_sheet.cell(row=index, column=_SALES_TOTAL_COL).value
+            sales_sheet.cell(row=index, column=_SALES_COST_COL, value=cost)
+            sales_sheet.cell(row=index, column=_SALES_PROFIT_COL, value=None if cost is None or amount is None else amount - cost)
+
+    for worksheet, index in sorted(deletions, key=lambda deletion: deletion[1], reverse=True):
+        worksheet.delete_rows(index)
+
+    # --- Summary: rewritten from the adjusted totals (one row per customer) ---
+    summary_sheet = workbook['销售汇总']
+    summary_sheet.delete_rows(2, summary_sheet.max_row)
+    for name in sorted((name for name, totals in summary.items() if totals[0] > 0), key=lambda name: name or ''):
+        summary_sheet.append([name] + summary[name])
+
+    state_sheet = workbook[STATE_SHEET]
+    state_sheet.delete_rows(3, state_sheet.max_row)
+    for name, (customer_id, sheet_name) in customer_sheets.items():
+        state_sheet.append(['customer_sheet', customer_id, name, sheet_name])
+    return len(inventory_changes) + len(sales_changes)
@@ -0,0 +1,285 @@
+import csv
+import os
+from datetime import date, datetime
+
+import database
+
+# Rows validated and inserted per executemany call
+IMPORT_BATCH_SIZE = 5000
+
+# Same rule as the 新入库记录 form
+DENSITY_MIN = 0.7
+DENSITY_MAX = 1.3
+
+INVENTORY_SHEET = '入库记录'
+SALES_SHEET = '销售记录'
+
+# Columns that must be present; 序号 and the computed 总升数 / 总价(元) are ignored
+# (they are recomputed the same way the entry forms do)
+INVENTORY_REQUIRED = ['入库日期', '入库单号', '单价(吨/元)', '数量(吨)', '密度']
+SALES_REQUIRED = ['客户名称', '销售日期', '销售单号', '单价(元/升)', '数量(升)']
+
+REPORT_HEADERS = ['工作表', '行号', '单号', '错误']
+
+
+class ImportReport:
+    """Outcome of an import: inserted row counts plus one entry per rejected row."""
+
+    def __init__(self):
+        self.inventory_count = 0
+        self.sales_count = 0
+        self.customers_created = 0
+        self.errors = [] # (sheet, row_number, order_number, message)
+
+    def add_error(self, sheet, row_number, order_number, message):
+        self.errors.append((sheet, row_number, order_number or '', message))
+
+    def write_csv(self, path):
+        """Writes the per-row error report (UTF-8 with BOM so Excel opens it correctly)."""
+        with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(REPORT_HEADERS)
+            writer.writerows(self.errors)
+
+    def summary(self):
+        return (f"入库记录: {self.inventory_count} 条\n"
+                f"销售记录: {self.sales_count} 条\n"
+                f"新建客户: {self.customers_created} 个\n"
+                f"错误行: {len(self.errors)} 条")
+
+
+# --- Reading ---
+
+def _iter_xlsx_sheets(path):
+    """Yields (sheet_name, header_row, row_iterator, approx_row_count) for the sheets we import."""
+    from openpyxl import load_workbook
+
+    # read_only streams rows instead of loading the whole workbook into memory
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        # Inventory first, so sales in the same file can draw on the imported stock
+        for sheet_name in (INVENTORY_SHEET, SALES_SHEET):
+            if sheet_name not in workbook.sheetnames:
+                continue
+            worksheet = workbook[sheet_name]
+            rows = worksheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                continue
+            yield sheet_name, header, rows, max((worksheet.max_row or 1) - 1, 0)
+    finally:
+        workbook.close()
+
+
+def _iter_csv_sheets(path):
+    """A CSV file holds one table; which one is decided from its header."""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        rows = csv.reader(f)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = [h.strip() for h in header]
+        if all(column in header for column in SALES_REQUIRED):
+            sheet_name = SALES_SHEET
+        elif all(column in header for column in INVENTORY_REQUIRED):
+            sheet_name = INVENTORY_SHEET
+        else:
+            raise ValueError(f"无法识别 CSV 表头，应与模版中的 '{INVENTORY_SHEET}' 或 '{SALES_SHEET}' 一致:\n{', '.join(header)}")
+        yield sheet_name, header, rows, None
+
+
+def _column_indexes(sheet_name, header, required):
+    names = [str(h).strip() if h is not None else '' for h in header]
+    missing = [column for column in required if column not in names]
+    if missing:
+        raise ValueError(f"工作表 '{sheet_name}' 缺少列: {', '.join(missing)}")
+    return [names.index(column) for column in required]
+
+
+# --- Cell parsing (raise ValueError with a message for the report) ---
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value) # Order numbers typed as numbers come back as e.g. 1001.0
+    return str(value).strip()
+
+
+def _date(value, label):
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, date):
+        return value.isoformat()
+    text = _text(value)
+    if not text:
+        raise ValueError(f"{label}不能为空")
+    try:
+        return datetime.strptime(text, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"{label} '{text}' 格式无效，请使用 YYYY-MM-DD")
+
+
+def _positive(value, label):
+    text = _text(value)
+    if not text:
+        raise ValueError(f"{label}不能为空")
+    try:
+        number = float(text)
+    except ValueError:
+        raise ValueError(f"{label} '{text}' 不是有效的数值")
+    if number <= 0:
+        raise ValueError(f"{label}必须大于0")
+    return number
+
+
+def _validate_inventory_row(values, seen_orders):
+    entry_date, order_number, price, quantity, density = values
+    order_number = _text(order_number)
+    if not order_number:
+        raise ValueError("入库单号不能为空")
+    entry_date = _date(entry_date, "入库日期")
+    price = _positive(price, "单价")
+    quantity = _positive(quantity, "数量")
+    density = _positive(density, "密度")
+    if not (DENSITY_MIN <= density <= DENSITY_MAX):
+        raise ValueError(f"密度应在 {DENSITY_MIN} 到 {DENSITY_MAX} 之间")
+    if order_number in seen_orders:
+        raise ValueError(f"入库单号 '{order_number}' 已存在")
+    total_liters = (quantity / density) * 1000
+    return (entry_date, order_number, price, quantity, density, total_liters)
+
+
+def _validate_sales_row(values, seen_orders):
+    customer_name, sale_date, order_number, price, quantity = values
+    order_number = _text(order_number)
+    if not order_number:
+        raise ValueError("销售单号不能为空")
+    customer_name = _text(customer_name)
+    if not customer_name:
+        raise ValueError("客户名称不能为空")
+    sale_date = _date(sale_date, "销售日期")
+    price = _positive(price, "单价")
+    quantity = _positive(quantity, "数量")
+    if order_number in seen_orders:
+        raise ValueError(f"销售单号 '{order_number}' 已存在")
+    return (customer_name, sale_date, order_number, price, quantity, price * quantity)
+
+
+# --- Import ---
+
+def import_file(conn, path, progress=None):
+    """
+    Imports inventory and sales rows from an .xlsx file laid out like 模版.xlsx
+    (sheets 入库记录 / 销售记录) or from a CSV file with one of those headers.
+
+    Rows are streamed and validated in batches of IMPORT_BATCH_SIZE (date
+    format, positive numbers, density range, order numbers unique against the
+    database and the rest of the file via in-memory sets), and the valid ones
+    go in with executemany. Invalid rows are skipped and listed in the report.
+    Unknown customer names are created.
+
+    Everything runs in one BEGIN IMMEDIATE transaction: nothing else can write
+    in between the duplicate check and the inserts, and a failure or cancel
+    (an exception raised by progress) rolls the whole import back. The import
+    is also rolled back if it would leave the remaining stock negative.
+
+    :param progress: optional callable(fraction or None, message) called after each batch
+    :return: ImportReport
+    :raises: ValueError on an unusable file layout or negative resulting stock,
+             sqlite3.Error on database errors, ImportError if openpyxl is missing
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        sheets = _iter_csv_sheets(path)
+    elif extension in ('.xlsx', '.xlsm'):
+        sheets = _iter_xlsx_sheets(path)
+    else:
+        raise ValueError(f"不支持的文件类型: {extension}（仅支持 .xlsx 和 .csv）")
+
+    report = ImportReport()
+    cursor = conn.cursor()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        remaining_before = database.get_remaining_liters(conn)
+        # One query per table instead of a duplicate-check SELECT per row
+        cursor.execute("SELECT order_number FROM inventory")
+        inventory_orders = {row[0] for row in cursor}
+        cursor.execute("SELECT order_number FROM sales")
+        sales_orders = {row[0] for row in cursor}
+        cursor.execute("SELECT name, id FROM customers")
+        customer_ids = dict(cursor.fetchall())
+
+        for sheet_name, header, rows, row_total in sheets:
+            is_sales = sheet_name == SALES_SHEET
+            indexes = _column_indexes(sheet_name, header, SALES_REQUIRED if is_sales else INVENTORY_REQUIRED)
+            seen_orders = sales_orders if is_sales else inventory_orders
+            batch = []
+            read_count = 0
+
+            def flush():
+                if is_sales:
+                    _insert_sales(cursor, batch, customer_ids, report)
+                else:
+                    cursor.executemany('''
+                        INSERT INTO inventory (entry_date, order_number, price_per_ton, quantity_ton, density, total_liters)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', batch)
+                    report.inventory_count += len(batch)
+                batch.clear()
+                if progress:
+                    fraction = min(read_count / row_total, 1.0) if row_total else None
+                    progress(fraction, f"{sheet_name}: 已读取 {read_count} 行")
+
+            # Row numbers as shown in Excel (header is row 1)
+            for row_number, row in enumerate(rows, start=2):
+                if row is None or all(_text(cell) == '' for cell in row):
+                    continue # Blank line
+                read_count += 1
+                values = [row[i] if i < len(row) else None for i in indexes]
+                try:
+                    if is_sales:
+                        valid_row = _validate_sales_row(values, seen_orders)
+                        order_number = valid_row[2]
+                    else:
+                        valid_row = _validate_inventory_row(values, seen_orders)
+                        order_number = valid_row[1]
+                except ValueError as e:
+                    report.add_error(sheet_name, row_number, _text(values[2 if is_sales else 1]), str(e))
+                    continue
+                seen_orders.add(order_number)
+                batch.append(valid_row)
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    flush()
+            flush()
+
+        remaining_after = database.get_remaining_liters(conn)
+        if remaining_after < -database.STOCK_BALANCE_TOLERANCE and remaining_after < remaining_before:
+            raise ValueError(f"导入后剩余库存为 {remaining_after:.2f} 升（为负数），已取消导入。\n请先导入对应的入库记录。")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    print(f"Imported {report.inventory_count} inventory rows, {report.sales_count} sales rows "
+          f"({len(report.errors)} rejected) from {path}")
+    return report
+
+
+def _insert_sales(cursor, batch, customer_ids, report):
+    """Inserts validated sales rows, creating missing customers first."""
+    new_names = sorted({row[0] for row in batch if row[0] not in customer_ids})
+    for name in new_names: # Few per batch; lastrowid gives the id without a lookup
+        cursor.execute("INSERT INTO customers (name) VALUES (?)", (name,))
+        customer_ids[name] = cursor.lastrowid
+        report.customers_created += 1
+    cursor.executemany('''
+        INSERT INTO sales (customer_id, sale_date, order_number, price_per_liter, quantity_liter, total_price)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(customer_ids[name], *rest) for name, *rest in batch])
+    report.sales_count += len(batch)
+
+
+def error_report_path(import_path):
+    """Where the error report for import_path is written (next to it)."""
+    stem = os.path.splitext(import_path)[0]
+    return f"{stem}_导入错误.csv"
@@ -0,0 +1,197 @@
+import queue
+import threading
+import traceback
+import tkinter as tk
+from tkinter import ttk
+
+import database
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when the user pressed cancel."""
+
+
+class Job:
+    """
+    Handle passed to a job's work function (runs on the worker thread).
+
+    :ivar conn: the job's own SQLite connection (None if the job has no db_path)
+    """
+
+    def __init__(self, executor, work, db_path, on_success, on_error, on_progress, on_cancelled):
+        self.executor = executor
+        self.work = work
+        self.db_path = db_path
+        self.on_success = on_success
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.on_cancelled = on_cancelled
+        self.conn = None
+        self._cancel_event = threading.Event()
+
+    # --- Called from the UI thread ---
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    # --- Called from the worker thread ---
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def check_cancelled(self):
+        """Raises JobCancelled if cancel() was called; call this between units of work."""
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+    def progress(self, fraction, message=""):
+        """Reports progress (0.0-1.0, or None if unknown) to the UI and checks for cancellation."""
+        self.executor._results.put(('progress', self, (fraction, message)))
+        self.check_cancelled()
+
+
+class JobExecutor:
+    """
+    Runs heavy work (exports, statistics queries, opening a database) off the
+    Tk main thread.
+
+    Jobs run one at a time on a single worker thread, each with its own
+    SQLite connection opened on that thread. Results, errors and progress are
+    queued and handed to the callbacks on the UI thread via root.after.
+    """
+
+    POLL_INTERVAL_MS = 50
+
+    def __init__(self, root):
+        self.root = root
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._pending = 0
+        self._polling = False
+        self._worker = threading.Thread(target=self._run, name="job-worker", daemon=True)
+        self._worker.start()
+
+    def submit(self, work, db_path=None, on_success=None, on_error=None, on_progress=None, on_cancelled=None):
+        """
+        Queues work(job) for the worker thread.
+
+        :param work: callable(job) -> result; use job.conn, job.progress() and job.check_cancelled()
+        :param db_path: database file to open a dedicated connection for (job.conn)
+        :param on_success: callable(result), run on the UI thread
+        :param on_error: callable(exception), run on the UI thread
+        :param on_progress: callable(fraction, message), run on the UI thread
+        :param on_cancelled: callable(), run on the UI thread
+        :return: the Job (call job.cancel() to request cancellation)
+        """
+        job = Job(self, work, db_path, on_success, on_error, on_progress, on_cancelled)
+        self._pending += 1
+        self._jobs.put(job)
+        if not self._polling:
+            self._polling = True
+            self.root.after(self.POLL_INTERVAL_MS, self._poll)
+        return job
+
+    # --- Worker thread ---
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                job.check_cancelled() # Cancelled while still queued
+                if job.db_path:
+                    job.conn = database.create_connection(job.db_path)
+                result = job.work(job)
+                self._results.put(('success', job, result))
+            except JobCancelled:
+                self._results.put(('cancelled', job, None))
+            except Exception as e:
+                traceback.print_exc()
+                self._results.put(('error', job, e))
+            finally:
+                if job.conn is not None:
+                    try:
+                        job.conn.close()
+                    except Exception as e:
+                        print(f"Error closing job connection: {e}")
+                    job.conn = None
+
+    # --- UI thread ---
+
+    def _poll(self):
+        while True:
+            try:
+                kind, job, payload = self._results.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if kind == 'progress':
+                    if job.on_progress:
+                        job.on_progress(*payload)
+                    continue
+                self._pending -= 1
+                if kind == 'success' and job.on_success:
+                    job.on_success(payload)
+                elif kind == 'error' and job.on_error:
+                    job.on_error(payload)
+                elif kind == 'cancelled' and job.on_cancelled:
+                    job.on_cancelled()
+            except Exception as e:
+                # Never let a callback error stop the polling loop
+                traceback.print_exc()
+                print(f"Error in job callback: {e}")
+
+        if self._pending > 0:
+            self.root.after(self.POLL_INTERVAL_MS, self._poll)
+        else:
+            self._polling = False
+
+
+class ProgressDialog:
+    """Modal progress window with a progress bar and a cancel button for one Job."""
+
+    def __init__(self, root, title, message=""):
+        self.job = None
+        self.window = tk.Toplevel(root)
+        self.window.title(title)
+        self.window.geometry("360x120")
+        self.window.resizable(False, False)
+        self.window.transient(root)
+        self.window.protocol("WM_DELETE_WINDOW", self.cancel) # Closing the window cancels
+
+        frame = ttk.Frame(self.window, padding="10")
+        frame.pack(fill="both", expand=True)
+        self.message_label = ttk.Label(frame, text=message)
+        self.message_label.pack(fill="x", pady=5)
+        self.progressbar = ttk.Progressbar(frame, mode="indeterminate", maximum=100)
+        self.progressbar.pack(fill="x", pady=5)
+        self.progressbar.start(10)
+        self.cancel_button = ttk.Button(frame, text="取消", command=self.cancel)
+        self.cancel_button.pack(pady=5)
+        self.window.grab_set()
+
+    def attach(self, job):
+        self.job = job
+
+    def update(self, fraction, message=""):
+        if fraction is not None:
+            if str(self.progressbar.cget("mode")) != "determinate":
+                self.progressbar.stop()
+                self.progressbar.config(mode="determinate")
+            self.progressbar['value'] = max(0.0, min(fraction, 1.0)) * 100
+        if message:
+            self.message_label.config(text=message)
+
+    def cancel(self):
+        if self.job is not None:
+            self.job.cancel()
+        self.cancel_button.config(state="disabled")
+        self.message_label.config(text="正在取消...")
+
+    def close(self):
+        try:
+            self.progressbar.stop()
+            self.window.grab_release()
+            self.window.destroy()
+        except tk.TclError:
+            pass # Already closed
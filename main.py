@@ -1,21 +1,42 @@
+import time
+_STARTUP_T0 = time.perf_counter() # Origin of the --startup-timeline output (before any other import)
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog # Added filedialog
+from startup_timeline import StartupTimeline, timeline_requested
+STARTUP_TIMELINE = StartupTimeline(_STARTUP_T0, enabled=timeline_requested())
+STARTUP_TIMELINE.mark("import tkinter")
 from datetime import datetime
 import database
+from tree_views import IncrementalTreeView, PagedTreeView
+from stats_cache import StatisticsCache
+from jobs import JobExecutor, ProgressDialog
+from refresh import RefreshCoordinator
+from customer_search import CustomerSearchIndex, SEARCH_DEBOUNCE_MS
+from order_numbers import OrderNumberCache, DEFAULT_ORDER_NUMBER
+from sync_client import SyncClient, SyncError, server_url_requested
+import backup
+import cogs
+import services
 import sqlite3
 import traceback # Import traceback for detailed error printing
-import shutil # Added for file copying (Save As)
-import pandas as pd # Added for Excel export
 import os # Added for path manipulation
-import re # Added for sanitizing sheet names
 import sys
 from sqlite3 import Connection # Import Connection for type hinting
+# openpyxl is only imported inside the export/import functions, on first use
+STARTUP_TIMELINE.mark("import app modules")
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 
 class DieselInventoryApp:
-    def __init__(self, root):
+    def __init__(self, root, timeline=None, server_url=None):
         self.root = root
+        self.timeline = timeline or StartupTimeline() # Disabled unless passed in
+        # Client mode: sales are written by the sync server (sync_server.py), which
+        # checks stock and order numbers atomically for all terminals; the views
+        # keep reading the shared database file directly
+        self.sync = SyncClient(server_url) if server_url else None
+        if self.sync:
+            print(f"Client mode: sales are written through {self.sync.base_url}")
         self.root.title("柴油库存管理系统")
         # Increased default size slightly
         self.root.geometry("1366x768")
@@ -26,32 +47,91 @@ class DieselInventoryApp:
         # --- Menu Bar ---
         self.create_menu()
 
+        # Aggregates for the statistics tab, invalidated per written table
+        self.stats_cache = StatisticsCache()
+        # Background worker for exports, statistics and opening databases
+        self.jobs = JobExecutor(self.root)
+        self._stats_job = None
+        # Views are refreshed through this: callers mark them dirty and each dirty
+        # view reloads once on the next idle cycle (handlers registered after the tabs exist)
+        self.refresh = RefreshCoordinator(self.root)
+
         # Initialize database
         self.conn: Connection | None = None # Initialize with None and add type hint
         self.db_path = os.path.join(APP_DIR, 'diesel_sales.db') # Always use project directory
         try:
             self.conn = database.create_connection(self.db_path) # Assign Connection object here
+            self.timeline.mark("database connect")
             # Ensure database and tables are created using the definition in database.py
             database.initialize_database(self.conn) # Pass the connection object
+            self.timeline.mark("initialize_database")
+            database.prune_change_log(self.conn)
+            # Change log position this window has consumed (see process_changes)
+            self._change_seq = database.latest_change_seq(self.conn)
         except sqlite3.Error as e:
             messagebox.showerror("数据库错误", f"无法连接或初始化数据库:\n{e}\n请检查文件 '{self.db_path}'。")
             self.root.quit() # Exit if DB connection/initialization fails
             return # Stop further initialization in __init__
 
+        # Client mode: a wrong --server should fail here, not on the first sale
+        self._sync_sale_job = None # Sale being written by the server
+        self._stock_job = None # Stock read from the server
+        self._stock_refresh_again = False
+        if self.sync:
+            try:
+                self.sync.health()
+            except SyncError as e:
+                messagebox.showerror("同步服务器错误", f"无法连接同步服务器:\n{e.message}")
+                self.root.quit()
+                return
+            self.timeline.mark("sync server health check")
+
+        # Rotating compressed snapshots of whichever database is open (backups/ next to it)
+        self.snapshots = backup.SnapshotScheduler(self.root, self.jobs, lambda: self.db_path)
+        if self.auto_snapshot_var.get():
+            self.snapshots.start()
+
         # Create Notebook
         self.notebook = ttk.Notebook(self.root)
         self.notebook.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
 
         # Create tabs
         self.create_inventory_tab()
+        self.timeline.mark("create_inventory_tab")
         self.selected_customer_id = None # Added to store the ID
         self.create_customer_tab()
+        self.timeline.mark("create_customer_tab")
         self.create_sales_tab()
+        self.timeline.mark("create_sales_tab")
         self.create_statistics_tab() # Create the tab structure
+        self.timeline.mark("create_statistics_tab")
         # Initialize customer data needed for stats combobox before refreshing stats
         self.customer_data = {} # Dictionary to store {name: id}
-        self.refresh_customer_names() # Populate combobox and data dict for sales tab first
-        self.refresh_statistics() # Initial data load for stats tab
+        self.customer_index = CustomerSearchIndex([]) # Rebuilt with customer_data
+        self.order_numbers = OrderNumberCache() # Last sales order number per customer
+        self._suggested_order_number = None # Auto-filled into the sales order number entry
+        self._view_change_seqs = {} # Table -> change log seq its tree view reflects (none: full reload)
+        # Registration order is refresh order: customer names feed the sales and
+        # stats comboboxes, and the stats filters read the stats combobox.
+        # Views on a tab are only reloaded while that tab is shown; customer_data
+        # (customer_names) is used by every tab, so it is always kept current.
+        self.refresh.register('inventory', self.refresh_table, tab=self.inventory_tab)
+        self.refresh.register('customers', self.refresh_customer_list, tab=self.customer_tab)
+        self.refresh.register('order_numbers', self.load_order_numbers)
+        self.refresh.register('customer_names', self.refresh_customer_names)
+        self.refresh.register('stats_customers', self.update_stats_customer_combobox, tab=self.statistics_tab)
+        self.refresh.register('sales', self.refresh_sales_list, tab=self.sales_tab)
+        self.refresh.register('stock', self.update_remaining_liters, tab=self.sales_tab)
+        self.refresh.register('statistics', self.refresh_statistics, tab=self.statistics_tab)
+        # Hidden tabs stay stale until selected
+        self.notebook.bind("<<NotebookTabChanged>>", lambda event: self.refresh.set_visible_tab(self.notebook.select()))
+        self.refresh.set_visible_tab(self.notebook.select())
+        # Initial data load: the shown tab's views once, before the window is shown
+        self.refresh.mark_all_dirty()
+        self.refresh.flush()
+        self.timeline.mark("initial refresh (visible tab)")
+        # Picks up writes from other terminals or the sync server
+        self.root.after(self.CHANGE_POLL_MS, self._poll_changes)
 
     def create_menu(self):
         """Creates the main menu bar."""
@@ -65,11 +145,27 @@ class DieselInventoryApp:
         file_menu.add_command(label="打开存档文件...", command=self.open_database_file) # Added Open
         file_menu.add_command(label="另存为...", command=self.save_database_as)
         file_menu.add_command(label="导出到 Excel...", command=self.export_to_excel)
+        file_menu.add_command(label="增量导出到 Excel...", command=self.export_to_excel_incremental)
+        file_menu.add_command(label="导出为 Parquet 数据集...", command=self.export_to_parquet)
+        file_menu.add_command(label="从 Excel/CSV 导入...", command=self.import_from_file)
         file_menu.add_separator()
         file_menu.add_command(label="初始化数据...", command=self.initialize_all_data)
         file_menu.add_separator()
         file_menu.add_command(label="退出", command=self.root.quit)
 
+        # --- Tools Menu ---
+        tools_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="工具", menu=tools_menu)
+
+        tools_menu.add_command(label="校验库存余额...", command=self.verify_stock_balance)
+        tools_menu.add_command(label="重建销售汇总表", command=self.rebuild_sales_rollups)
+        tools_menu.add_command(label="重新计算销售成本", command=self.rebuild_cogs)
+        tools_menu.add_separator()
+        tools_menu.add_command(label="立即创建快照", command=self.create_snapshot_now)
+        # Off unless the user opts in: snapshots write gzip copies into backups/ next to the database
+        self.auto_snapshot_var = tk.BooleanVar(value=False)
+        tools_menu.add_checkbutton(label="定时自动快照", variable=self.auto_snapshot_var, command=self.toggle_auto_snapshot)
+
         # --- Help Menu (Optional) ---
         # help_menu = tk.Menu(menubar, tearoff=0)
         # menubar.add_cascade(label="帮助", menu=help_menu)
@@ -90,63 +186,89 @@ class DieselInventoryApp:
                         # Optional: Reset auto-increment counters if using AUTOINCREMENT (SQLite specific)
                         # cursor.execute("DELETE FROM sqlite_sequence WHERE name IN ('sales', 'inventory', 'customers')")
                     messagebox.showinfo("初始化完成", "所有数据已成功删除。")
-                    # Refresh all UI elements
-                    self.refresh_table()
-                    self.refresh_customer_list()
-                    self.refresh_sales_list()
-                    self.refresh_customer_names() # Clears comboboxes
-                    self.update_stats_customer_combobox() # Clears stats combobox
-                    self.refresh_statistics() # Clears stats display
-                    self.update_remaining_liters() # Resets remaining liters display
+                    # Refresh all UI elements (clears lists, comboboxes, stats and remaining liters)
+                    self.refresh_all_views()
                 except sqlite3.Error as e:
                     messagebox.showerror("数据库错误", f"初始化数据时出错: {e}")
             else:
                 messagebox.showerror("数据库错误", "数据库连接丢失，无法初始化。")
 
     def save_database_as(self):
-        """Saves a copy of the current database file to a new location."""
+        """Saves a copy of the current database to a new location (optionally gzip-compressed)."""
+        if not self.conn:
+            messagebox.showerror("数据库错误", "数据库连接丢失，无法另存为。")
+            return
         initial_dir = os.path.dirname(os.path.abspath(self.db_path)) # Use absolute path's dir
         initial_file = os.path.basename(self.db_path)
         save_path = filedialog.asksaveasfilename(
             initialdir=initial_dir,
             initialfile=f"备份_{initial_file}", # Suggest a backup name
             defaultextension=".db",
-            filetypes=[("SQLite Database", "*.db"), ("All Files", "*.*")]
+            filetypes=[("SQLite Database", "*.db"), ("压缩备份", "*.db.gz"), ("All Files", "*.*")]
         )
-        if save_path:
-            # Ensure the target directory exists
-            target_dir = os.path.dirname(save_path)
-            if not os.path.exists(target_dir):
-                try:
-                    os.makedirs(target_dir)
-                except OSError as e:
-                    messagebox.showerror("创建目录失败", f"无法创建目标目录 '{target_dir}': {e}")
-                    return
+        if not save_path:
+            return
+        if os.path.abspath(save_path) == os.path.abspath(self.db_path):
+            messagebox.showerror("另存为失败", "不能覆盖当前正在使用的数据库文件。")
+            return
 
+        # Ensure the target directory exists
+        target_dir = os.path.dirname(save_path)
+        if not os.path.exists(target_dir):
             try:
-                # Ensure the database connection is closed before copying
-                # A simple approach: copy the file directly. Might fail if locked.
-                # A more robust approach would involve closing and reopening the connection,
-                # but that adds significant complexity to the app's state management.
-                # Let's try the simple copy first.
-                if self.conn:
-                    self.conn.commit() # Ensure data is written to disk
-                    # self.conn.close() # Ideally close, but complicates reopening
-                    # self.conn = None
-                shutil.copy2(self.db_path, save_path) # copy2 preserves metadata
-                messagebox.showinfo("另存为成功", f"数据库已成功另存为:\n{save_path}")
-                # Reopen connection if we closed it
-                # if not self.conn:
-                #    self.conn = database.create_connection(self.db_path)
-                #    if not self.conn:
-                #        messagebox.showerror("数据库错误", "另存为后无法重新连接到原始数据库！应用程序可能需要重启。")
-                #        self.root.quit()
+                os.makedirs(target_dir)
+            except OSError as e:
+                messagebox.showerror("创建目录失败", f"无法创建目标目录 '{target_dir}': {e}")
+                return
 
-            except Exception as e:
-                messagebox.showerror("另存为失败", f"无法复制数据库文件: {e}\n可能是文件被占用，请尝试关闭应用程序后手动复制。")
-                # Attempt to reopen connection if it was closed and failed
-                # if not self.conn:
-                #    self.conn = database.create_connection(self.db_path) # Try reopening original
+        # Copy with the SQLite online backup API on the worker thread (its own
+        # connection and read snapshot), so sales can still be entered meanwhile
+        compress = save_path.lower().endswith('.gz')
+        dialog = ProgressDialog(self.root, "另存为", "正在备份数据库...")
+
+        def work(job):
+            backup.backup_database(job.conn, save_path, compress=compress, progress=job.progress)
+
+        def on_success(result):
+            dialog.close()
+            messagebox.showinfo("另存为成功", f"数据库已成功另存为:\n{save_path}")
+
+        def on_error(e):
+            dialog.close()
+            if isinstance(e, sqlite3.Error):
+                messagebox.showerror("另存为失败", f"备份数据库时出错: {e}")
+            else:
+                messagebox.showerror("另存为失败", f"无法写入备份文件: {e}")
+
+        def on_cancelled():
+            dialog.close()
+            messagebox.showinfo("另存为已取消", "备份已取消，未写入文件。")
+
+        job = self.jobs.submit(work, db_path=self.db_path, on_success=on_success, on_error=on_error,
+                               on_progress=dialog.update, on_cancelled=on_cancelled)
+        dialog.attach(job)
+
+    def create_snapshot_now(self):
+        """Takes a rotating snapshot right away (in the background)."""
+        if not self.conn:
+            messagebox.showerror("数据库错误", "数据库连接丢失，无法创建快照。")
+            return
+
+        def on_success(path):
+            messagebox.showinfo("快照完成", f"快照已保存到:\n{path}")
+
+        def on_error(e):
+            messagebox.showerror("快照失败", f"创建快照时出错: {e}")
+
+        if self.snapshots.snapshot_now(on_success=on_success, on_error=on_error) is None:
+            messagebox.showinfo("快照", "上一个快照仍在进行中，请稍后再试。")
+
+    def toggle_auto_snapshot(self):
+        """Starts or stops the scheduled snapshots from the 工具 menu."""
+        if self.auto_snapshot_var.get():
+            self.snapshots.start()
+        else:
+            self.snapshots.stop()
 
     def export_to_excel(self):
         """Exports inventory, sales, per-customer sales, and summary data to an Excel file, filtered by stats tab dates."""
@@ -158,34 +280,23 @@ class DieselInventoryApp:
             # --- Get and Validate Date Filters for Filename and Query ---
             start_date_str = self.stats_start_date_entry.get().strip()
             end_date_str = self.stats_end_date_entry.get().strip()
-            start_date_obj = None
-            end_date_obj = None
-            filename_prefix = ""
 
             if start_date_str:
                 try:
-                    start_date_obj = datetime.strptime(start_date_str, "%Y-%m-%d")
+                    start_date_str = services.validate_date(start_date_str)
                 except ValueError:
                     messagebox.showwarning("日期格式错误", f"开始日期 '{start_date_str}' 格式无效，将不用于文件名前缀。")
                     start_date_str = None # Invalidate for query logic below
 
             if end_date_str:
                 try:
-                    end_date_obj = datetime.strptime(end_date_str, "%Y-%m-%d")
+                    end_date_str = services.validate_date(end_date_str)
                 except ValueError:
                     messagebox.showwarning("日期格式错误", f"结束日期 '{end_date_str}' 格式无效，将不用于文件名前缀。")
                     end_date_str = None # Invalidate for query logic below
 
-            # Construct filename prefix
-            if start_date_obj and end_date_obj:
-                filename_prefix = f"{start_date_obj.strftime('%Y%m%d')}-{end_date_obj.strftime('%Y%m%d')}_"
-            elif start_date_obj:
-                filename_prefix = f"{start_date_obj.strftime('%Y%m%d')}起_"
-            elif end_date_obj:
-                filename_prefix = f"截至{end_date_obj.strftime('%Y%m%d')}_"
-
             initial_dir = os.path.dirname(os.path.abspath(self.db_path)) # Suggest saving near the database
-            default_filename = f"{filename_prefix}柴油销售数据导出.xlsx"
+            default_filename = services.export_filename(start_date_str, end_date_str) # Date range prefix
 
             save_path = filedialog.asksaveasfilename(
                 initialdir=initial_dir,
@@ -196,156 +307,174 @@ class DieselInventoryApp:
             if not save_path: # User cancelled
                 return
 
-            # --- Prepare SQL Query Filters (using potentially invalidated date strings) ---
-            inv_where_clauses = []
-            inv_params = []
-            sales_where_clauses = []
-            sales_params = []
-
-            if start_date_str: # Check if still valid after filename logic
-                try:
-                    datetime.strptime(start_date_str, "%Y-%m-%d") # Re-validate for query
-                    inv_where_clauses.append("entry_date >= ?")
-                    inv_params.append(start_date_str)
-                    sales_where_clauses.append("s.sale_date >= ?")
-                    sales_params.append(start_date_str)
-                except ValueError:
-                    # This case should ideally not be reached if invalidated above, but as safety
-                    print(f"Query filter ignoring invalid start date: {start_date_str}")
-                    start_date_str = None # Ensure it's None
+        except Exception as e:
+            traceback.print_exc()
+            messagebox.showerror("导出失败", f"导出到 Excel 时发生错误: {e}")
+            return
 
-            if end_date_str: # Check if still valid after filename logic
-                try:
-                    datetime.strptime(end_date_str, "%Y-%m-%d") # Re-validate for query
-                    inv_where_clauses.append("entry_date <= ?")
-                    inv_params.append(end_date_str)
-                    sales_where_clauses.append("s.sale_date <= ?")
-                    sales_params.append(end_date_str)
-                except ValueError:
-                    print(f"Query filter ignoring invalid end date: {end_date_str}")
-                    end_date_str = None # Ensure it's None
-
-            inv_where_sql = " AND ".join(inv_where_clauses) if inv_where_clauses else "1=1"
-            sales_where_sql = " AND ".join(sales_where_clauses) if sales_where_clauses else "1=1"
-            # --- End Date Filters ---
-
-            # Read inventory data (apply filter)
-            inventory_query = f"SELECT id, entry_date, order_number, price_per_ton, quantity_ton, density, total_liters FROM inventory WHERE {inv_where_sql} ORDER BY id ASC"
-            inventory_df = pd.read_sql_query(inventory_query, self.conn, params=inv_params)
-            # Rename columns for clarity in Excel (Already Chinese)
-            inventory_df.rename(columns={
-                'id': '序号', 'entry_date': '入库日期', 'order_number': '入库单号',
-                'price_per_ton': '单价(吨/元)', 'quantity_ton': '数量(吨)',
-                'density': '密度', 'total_liters': '总升数'
-            }, inplace=True)
-
-            # Read sales data with customer names
-            sales_query = f"""
-                SELECT s.id, c.name, s.sale_date, s.order_number, s.price_per_liter, s.quantity_liter, s.total_price
-                FROM sales s
-                LEFT JOIN customers c ON s.customer_id = c.id
-                WHERE {sales_where_sql} -- Apply date filter
-                ORDER BY s.id ASC
-            """
-            sales_df = pd.read_sql_query(sales_query, self.conn, params=sales_params)
-            # Rename columns (Already Chinese)
-            sales_df.rename(columns={
-                'id': '序号', 'name': '客户名称', 'sale_date': '销售日期',
-                'order_number': '销售单号', 'price_per_liter': '单价(元/升)',
-                'quantity_liter': '数量(升)', 'total_price': '总价(元)'
-            }, inplace=True)
-
-            # Write to Excel
-            with pd.ExcelWriter(save_path, engine='openpyxl') as writer:
-                inventory_df.to_excel(writer, sheet_name='入库记录', index=False)
-                sales_df.to_excel(writer, sheet_name='销售记录', index=False)
-
-                # --- Add per-customer sheets ---
-                cursor = self.conn.cursor()
-                cursor.execute("SELECT id, name FROM customers ORDER BY name")
-                customers = cursor.fetchall()
-
-                # Define columns for customer sheets (Corrected keys to match DataFrame columns)
-                customer_sales_cols_rename = {
-                    'id': '序号', 'sale_date': '销售日期', 'order_number': '销售单号',
-                    'price_per_liter': '单价(元/升)', 'quantity_liter': '数量(升)',
-                    'total_price': '总价(元)'
-                }
-                # Define columns to SELECT in the SQL query
-                customer_sales_query_cols = "s.id, s.sale_date, s.order_number, s.price_per_liter, s.quantity_liter, s.total_price"
-
-                for customer_id, customer_name in customers:
-                    # Sanitize customer name for sheet name
-                    invalid_chars = r'[\\/?*\[\]:]'
-                    sanitized_name = re.sub(invalid_chars, '', customer_name)
-                    sanitized_name = sanitized_name[:31]
-
-                    if not sanitized_name:
-                        sanitized_name = f"客户_{customer_id}"
-
-                    sheet_suffix = 1
-                    original_sanitized_name = sanitized_name
-                    while sanitized_name in writer.sheets:
-                        sheet_suffix += 1
-                        max_base_len = 31 - len(str(sheet_suffix)) - 1
-                        truncated_base = original_sanitized_name[:max_base_len]
-                        sanitized_name = f"{truncated_base}_{sheet_suffix}"
-                        if len(sanitized_name) > 31:
-                             sanitized_name = sanitized_name[:31]
-
-                    customer_query = f"""
-                        SELECT {customer_sales_query_cols}
-                        FROM sales s
-                        WHERE s.customer_id = ? AND ({sales_where_sql}) -- Apply date filter
-                        ORDER BY s.id ASC
-                    """
-                    customer_params = [customer_id] + sales_params
-                    customer_sales_df = pd.read_sql_query(customer_query, self.conn, params=customer_params)
-
-                    if not customer_sales_df.empty:
-                        # Rename columns using the corrected dictionary
-                        customer_sales_df.rename(columns=customer_sales_cols_rename, inplace=True)
-                        customer_sales_df.to_excel(writer, sheet_name=sanitized_name, index=False)
-                # --- End add per-customer sheets ---
-
-                # --- Add Sales Summary Sheet ---
-                summary_query = f"""
-                    SELECT
-                        c.name AS customer_name,
-                        COUNT(s.id) AS transaction_count,
-                        SUM(s.quantity_liter) AS total_quantity,
-                        SUM(s.total_price) AS total_amount
-                    FROM sales s
-                    LEFT JOIN customers c ON s.customer_id = c.id
-                    WHERE {sales_where_sql} -- Apply the same date filters
-                    GROUP BY c.id, c.name
-                    ORDER BY c.name ASC
-                """
-                summary_df = pd.read_sql_query(summary_query, self.conn, params=sales_params)
-
-                # Rename summary columns to Chinese
-                summary_df.rename(columns={
-                    'customer_name': '客户名称',
-                    'transaction_count': '总交易次数',
-                    'total_quantity': '总销售数量(升)',
-                    'total_amount': '总销售金额(元)'
-                }, inplace=True)
-
-                # Write the summary sheet
-                summary_df.to_excel(writer, sheet_name='销售汇总', index=False)
-                # --- End Sales Summary Sheet ---
+        # --- Stream the filtered data into the workbook on the worker thread ---
+        # (invalid dates were set to None above)
+        cogs_method = self._selected_cogs_method() # Same costing as the statistics tab
+        dialog = ProgressDialog(self.root, "导出到 Excel", "正在导出...")
 
+        def work(job):
+            services.export_excel(job.conn, save_path, start_date_str, end_date_str, cogs_method, progress=job.progress)
 
+        def on_success(result):
+            dialog.close()
             messagebox.showinfo("导出成功", f"数据已成功导出到:\n{save_path}")
 
-        except sqlite3.Error as e:
-            messagebox.showerror("数据库错误", f"读取数据以供导出时出错: {e}")
-        except ImportError:
-             messagebox.showerror("缺少库", "导出 Excel 需要 'pandas' 和 'openpyxl' 库。\n请确保它们已安装: pip install pandas openpyxl")
-        except Exception as e:
-            traceback.print_exc()
-            messagebox.showerror("导出失败", f"导出到 Excel 时发生错误: {e}")
-        # Removed the final else block as the connection check is now at the beginning
+        def on_error(e):
+            dialog.close()
+            if isinstance(e, sqlite3.Error):
+                messagebox.showerror("数据库错误", f"读取数据以供导出时出错: {e}")
+            elif isinstance(e, ImportError):
+                messagebox.showerror("缺少库", "导出 Excel 需要 'openpyxl' 库。\n请确保它已安装: pip install openpyxl")
+            else:
+                messagebox.showerror("导出失败", f"导出到 Excel 时发生错误: {e}")
+
+        def on_cancelled():
+            dialog.close()
+            messagebox.showinfo("导出已取消", "导出已取消，未写入文件。")
+
+        job = self.jobs.submit(work, db_path=self.db_path, on_success=on_success, on_error=on_error,
+                               on_progress=dialog.update, on_cancelled=on_cancelled)
+        dialog.attach(job)
+
+    def export_to_excel_incremental(self):
+        """
+        Appends what changed since the last export to a running workbook (all
+        dates; the first export to a file writes it completely).
+        """
+        if not self.conn:
+            messagebox.showerror("数据库错误", "数据库连接丢失，无法导出。")
+            return
+        save_path = filedialog.asksaveasfilename(
+            initialdir=os.path.dirname(os.path.abspath(self.db_path)),
+            initialfile=services.export_filename(),
+            defaultextension=".xlsx",
+            filetypes=[("Excel 文件", "*.xlsx")],
+            confirmoverwrite=False # The file is updated, not replaced
+        )
+        if not save_path: # User cancelled
+            return
+
+        cogs_method = self._selected_cogs_method()
+        dialog = ProgressDialog(self.root, "增量导出到 Excel", "正在导出...")
+
+        def work(job):
+            return services.export_excel_incremental(job.conn, save_path, cogs_method, progress=job.progress)
+
+        def on_success(result):
+            dialog.close()
+            mode, applied = result
+            if mode == 'full':
+                messagebox.showinfo("导出成功", f"数据已完整导出到:\n{save_path}\n之后的增量导出只写入变更的记录。")
+            else:
+                messagebox.showinfo("导出成功", f"已将 {applied} 条变更写入:\n{save_path}")
+
+        def on_error(e):
+            dialog.close()
+            if isinstance(e, sqlite3.Error):
+                messagebox.showerror("数据库错误", f"读取数据以供导出时出错: {e}")
+            elif isinstance(e, ImportError):
+                messagebox.showerror("缺少库", "导出 Excel 需要 'openpyxl' 库。\n请确保它已安装: pip install openpyxl")
+            else:
+                messagebox.showerror("导出失败", f"导出到 Excel 时发生错误: {e}")
+
+        def on_cancelled():
+            dialog.close()
+            messagebox.showinfo("导出已取消", "导出已取消，文件未改动。")
+
+        job = self.jobs.submit(work, db_path=self.db_path, on_success=on_success, on_error=on_error,
+                               on_progress=dialog.update, on_cancelled=on_cancelled)
+        dialog.attach(job)
+
+    def export_to_parquet(self):
+        """Exports inventory, sales and the monthly summary as month-partitioned Parquet datasets (all dates)."""
+        if not self.conn:
+            messagebox.showerror("数据库错误", "数据库连接丢失，无法导出。")
+            return
+        out_dir = filedialog.askdirectory(
+            initialdir=os.path.dirname(os.path.abspath(self.db_path)),
+            title="选择导出目录（将写入 inventory、sales、sales_summary 子目录）"
+        )
+        if not out_dir: # User cancelled
+            return
+
+        cogs_method = self._selected_cogs_method()
+        dialog = ProgressDialog(self.root, "导出为 Parquet", "正在导出...")
+
+        def work(job):
+            return services.export_columnar(job.conn, out_dir, cogs_method=cogs_method, progress=job.progress)
+
+        def on_success(result):
+            dialog.close()
+            months = max((partitions for _, partitions in result.values()), default=0)
+            messagebox.showinfo("导出成功", f"数据已导出到:\n{out_dir}\n共 {months} 个月份分区。")
+
+        def on_error(e):
+            dialog.close()
+            if isinstance(e, sqlite3.Error):
+                messagebox.showerror("数据库错误", f"读取数据以供导出时出错: {e}")
+            elif isinstance(e, ImportError):
+                messagebox.showerror("缺少库", "导出 Parquet 需要 'pyarrow' 库。\n请确保它已安装: pip install pyarrow")
+            else:
+                messagebox.showerror("导出失败", f"导出为 Parquet 时发生错误: {e}")
+
+        def on_cancelled():
+            dialog.close()
+            messagebox.showinfo("导出已取消", "导出已取消，未完成的数据集未写入。")
+
+        job = self.jobs.submit(work, db_path=self.db_path, on_success=on_success, on_error=on_error,
+                               on_progress=dialog.update, on_cancelled=on_cancelled)
+        dialog.attach(job)
+
+    def import_from_file(self):
+        """Bulk-imports inventory and sales from an xlsx (模版.xlsx layout) or CSV file."""
+        if not self.conn:
+            messagebox.showerror("数据库错误", "数据库连接丢失，无法导入。")
+            return
+        import_path = filedialog.askopenfilename(
+            initialdir=APP_DIR,
+            title="选择要导入的文件（格式同 模版.xlsx）",
+            filetypes=[("Excel 文件", "*.xlsx"), ("CSV 文件", "*.csv"), ("All Files", "*.*")]
+        )
+        if not import_path:
+            return
+
+        dialog = ProgressDialog(self.root, "导入数据", "正在导入...")
+
+        def work(job):
+            return services.import_file(job.conn, import_path, progress=job.progress)
+
+        def on_success(result):
+            dialog.close()
+            report, report_path = result
+            self.refresh_all_views()
+            message = f"导入完成。\n\n{report.summary()}"
+            if report_path:
+                message += f"\n\n错误明细已保存到:\n{report_path}"
+                messagebox.showwarning("导入完成（有错误）", message)
+            else:
+                messagebox.showinfo("导入成功", message)
+
+        def on_error(e):
+            dialog.close()
+            if isinstance(e, sqlite3.Error):
+                messagebox.showerror("数据库错误", f"导入时出错，已撤销全部导入: {e}")
+            elif isinstance(e, ImportError):
+                messagebox.showerror("缺少库", "导入 Excel 需要 'openpyxl' 库。\n请确保它已安装: pip install openpyxl")
+            else:
+                messagebox.showerror("导入失败", f"{e}")
+
+        def on_cancelled():
+            dialog.close()
+            messagebox.showinfo("导入已取消", "导入已取消，未写入任何数据。")
+
+        job = self.jobs.submit(work, db_path=self.db_path, on_success=on_success, on_error=on_error,
+                               on_progress=dialog.update, on_cancelled=on_cancelled)
+        dialog.attach(job)
 
     def open_database_file(self):
         """Opens an existing database file."""
@@ -358,59 +487,182 @@ class DieselInventoryApp:
 
         if open_path and open_path != self.db_path:
             print(f"Attempting to open database: {open_path}")
-            # Close current connection if open
-            if self.conn:
-                try:
-                    self.conn.close()
-                    print(f"Closed connection to: {self.db_path}")
-                    self.conn = None
-                except sqlite3.Error as e:
-                    messagebox.showerror("关闭连接错误", f"无法关闭当前数据库连接: {e}")
-                    # Proceed with caution, might leave old connection dangling
+            # Verify/initialize (and migrate) the new file on the worker thread first;
+            # the current connection stays open until that has succeeded.
+            dialog = ProgressDialog(self.root, "打开数据库", f"正在检查数据库:\n{os.path.basename(open_path)}")
+
+            def work(job):
+                database.initialize_database(job.conn) # Might raise Error
+                job.check_cancelled()
+
+            def on_success(result):
+                dialog.close()
+                self._switch_database(open_path)
+
+            def on_error(e):
+                dialog.close()
+                if isinstance(e, sqlite3.Error):
+                    messagebox.showerror("打开失败", f"无法连接或初始化选定的数据库文件:\n{open_path}\n错误: {e}")
+                else:
+                    messagebox.showerror("错误", f"打开数据库时发生意外错误: {e}")
 
-            # Attempt to connect to the new database
+            job = self.jobs.submit(work, db_path=open_path, on_success=on_success, on_error=on_error,
+                                   on_progress=dialog.update, on_cancelled=dialog.close)
+            dialog.attach(job)
+
+    def _switch_database(self, open_path):
+        """Replaces the app's connection with one to open_path (already initialized) and refreshes."""
+        # Close current connection if open
+        if self.conn:
             try:
-                new_conn = database.create_connection(open_path) # Might raise Error
-                self.conn = new_conn
-                self.db_path = open_path
-                print(f"Successfully connected to: {self.db_path}")
+                self.conn.close()
+                print(f"Closed connection to: {self.db_path}")
+                self.conn = None
+            except sqlite3.Error as e:
+                messagebox.showerror("关闭连接错误", f"无法关闭当前数据库连接: {e}")
+                # Proceed with caution, might leave old connection dangling
 
-                # Verify/initialize tables in the new database
-                database.initialize_database(self.conn) # Might raise Error
+        # Attempt to connect to the new database
+        try:
+            new_conn = database.create_connection(open_path) # Might raise Error
+            self.conn = new_conn
+            self.db_path = open_path
+            print(f"Successfully connected to: {self.db_path}")
 
-                # Refresh all UI elements
-                self.refresh_all_views()
-                # Update window title
-                self.root.title(f"柴油库存管理系统 - [{os.path.basename(self.db_path)}]")
-                messagebox.showinfo("打开成功", f"已成功打开数据库:\n{self.db_path}")
+            # Refresh all UI elements
+            self.refresh_all_views()
+            # Update window title
+            self.root.title(f"柴油库存管理系统 - [{os.path.basename(self.db_path)}]")
+            messagebox.showinfo("打开成功", f"已成功打开数据库:\n{self.db_path}")
 
-            except sqlite3.Error as e:
-                messagebox.showerror("打开失败", f"无法连接或初始化选定的数据库文件:\n{open_path}\n错误: {e}\n\n将尝试重新连接到原始数据库。")
-                self.conn = None # Ensure conn is None before trying to reconnect
-                # Attempt to reconnect to the original database
-                try:
-                    self.conn = database.create_connection(self.db_path) # Use the original self.db_path
-                    database.initialize_database(self.conn)
-                    self.refresh_all_views() # Refresh with original data
-                    self.root.title("柴油库存管理系统") # Reset title
-                except sqlite3.Error as final_e:
-                    messagebox.showerror("严重错误", f"无法重新连接到原始数据库！请重启应用程序。\n错误: {final_e}")
-                    self.root.quit()
-            except Exception as e: # Catch other potential errors during refresh etc.
-                traceback.print_exc()
-                messagebox.showerror("错误", f"打开数据库后发生意外错误: {e}")
+        except sqlite3.Error as e:
+            messagebox.showerror("打开失败", f"无法连接或初始化选定的数据库文件:\n{open_path}\n错误: {e}\n\n将尝试重新连接到原始数据库。")
+            self.conn = None # Ensure conn is None before trying to reconnect
+            # Attempt to reconnect to the original database
+            try:
+                self.conn = database.create_connection(self.db_path) # Use the original self.db_path
+                database.initialize_database(self.conn)
+                self.refresh_all_views() # Refresh with original data
+                self.root.title("柴油库存管理系统") # Reset title
+            except sqlite3.Error as final_e:
+                messagebox.showerror("严重错误", f"无法重新连接到原始数据库！请重启应用程序。\n错误: {final_e}")
+                self.root.quit()
+        except Exception as e: # Catch other potential errors during refresh etc.
+            traceback.print_exc()
+            messagebox.showerror("错误", f"打开数据库后发生意外错误: {e}")
 
 
     def refresh_all_views(self):
         """Refreshes all data-displaying widgets in the application."""
         print("Refreshing all views...")
-        self.refresh_table()
-        self.refresh_customer_list()
-        self.refresh_sales_list()
-        self.refresh_customer_names() # Includes updating comboboxes
-        self.refresh_statistics()
-        self.update_remaining_liters()
-        print("All views refreshed.")
+        self.stats_cache.clear() # Views may now show a different database file
+        # Start consuming the change log from its current end; tree views reload fully
+        self._view_change_seqs = {}
+        try:
+            self._change_seq = database.latest_change_seq(self.conn) if self.conn else 0
+        except sqlite3.Error as e:
+            print(f"Error reading change log position: {e}")
+            self._change_seq = 0
+        self.refresh.mark_all_dirty() # Reloaded together on the next idle cycle
+
+    # Views to mark dirty per changed table (a renamed customer shows in the sales list)
+    CHANGE_VIEWS = {
+        'inventory': ('inventory', 'stock', 'statistics'),
+        'sales': ('sales', 'stock', 'statistics'),
+        'customers': ('customers', 'customer_names', 'stats_customers', 'sales'),
+    }
+    CHANGE_POLL_MS = 2000 # How often writes by other terminals are looked for
+    VIEW_DELTA_LIMIT = 500 # More changed rows than this: reload instead of patching
+
+    def _poll_changes(self):
+        try:
+            self.process_changes()
+        except Exception: # Keep polling whatever happened
+            traceback.print_exc()
+        self.root.after(self.CHANGE_POLL_MS, self._poll_changes)
+
+    def process_changes(self):
+        """
+        Applies the change log entries written since the last call, by this
+        window or anyone else: invalidates the statistics and order number
+        caches for what changed and marks the affected views dirty. The tree
+        views then patch only the changed rows (see _catch_up_tree_view).
+        """
+        if not self.conn:
+            return
+        try:
+            latest = database.latest_change_seq(self.conn)
+            if latest <= self._change_seq:
+                return # Nothing written (the common case for the poll)
+            changes = database.changes_since(self.conn, self._change_seq, latest)
+            if changes is None:
+                print("Change log was pruned past this window's position; reloading all views.")
+                self.refresh_all_views()
+                return
+            sales_changes = changes.get('sales', {})
+            if sales_changes:
+                self._apply_order_number_changes(sales_changes)
+        except sqlite3.Error as e:
+            print(f"Error reading change log: {e}")
+            return
+        self._change_seq = latest
+        dirty = []
+        for table, rows in changes.items():
+            if not rows:
+                continue
+            if table in ('inventory', 'sales'):
+                self.stats_cache.invalidate(table)
+            dirty.extend(view for view in self.CHANGE_VIEWS[table] if view not in dirty)
+        if dirty:
+            self.refresh.mark_dirty(*dirty)
+
+    def _apply_order_number_changes(self, sales_changes):
+        """Keeps the last order number per customer current for changed sales."""
+        if len(sales_changes) > self.VIEW_DELTA_LIMIT or 'D' in sales_changes.values():
+            # A deleted sale's customer is unknown now; re-read everything lazily
+            self.order_numbers.forget()
+            return
+        ids = sorted(sales_changes)
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT customer_id, id, order_number FROM sales WHERE id IN ({','.join('?' * len(ids))}) ORDER BY id", ids)
+        for customer_id, sale_id, order_number in cursor.fetchall():
+            if sales_changes[sale_id] == 'I':
+                self.order_numbers.record(customer_id, order_number) # Newest sale is now the last one
+            else:
+                self.order_numbers.forget(customer_id) # May or may not be the customer's last sale
+
+    def _catch_up_tree_view(self, table, view, fetch_rows, reload):
+        """
+        Brings a tree view up to date with the change log: removes deleted
+        rows, updates edited ones and appends new ones. Falls back to reload()
+        on first use, after pruning, for large batches and (for sales) when a
+        customer was renamed.
+
+        :param fetch_rows: fetch_rows(ids) -> list rows (id first) ordered by id
+        """
+        since = self._view_change_seqs.get(table)
+        latest = database.latest_change_seq(self.conn)
+        changes = None
+        if since is not None:
+            tables = (table, 'customers') if table == 'sales' else (table,)
+            changes = database.changes_since(self.conn, since, latest, tables)
+        rows = changes.get(table, {}) if changes is not None else {}
+        if (changes is None or len(rows) > self.VIEW_DELTA_LIMIT
+                or (table == 'sales' and 'U' in changes.get('customers', {}).values())):
+            reload()
+            self._view_change_seqs[table] = latest
+            return
+        for row_id, op in rows.items():
+            if op == 'D':
+                view.remove_row(row_id)
+        # Edited rows that are not loaded (older pages) are left for scrolling to fetch
+        ids = sorted(row_id for row_id, op in rows.items()
+                     if op == 'I' or (op == 'U' and view.tree.exists(str(row_id))))
+        if ids:
+            for row in fetch_rows(ids):
+                # Scroll to new rows like a local add; edits keep the current position
+                view.upsert_row(row, select=(rows[row[0]] == 'I'))
+        self._view_change_seqs[table] = latest
 
     # --- End Menu Command Methods ---
 
@@ -433,8 +685,6 @@ class DieselInventoryApp:
 
         self.create_inventory_table(self.inventory_tab) # Row 2 (will expand)
 
-        # Load initial data
-        self.refresh_table()
 
     def create_customer_tab(self):
         # Create Customer Management tab
@@ -479,8 +729,6 @@ class DieselInventoryApp:
         self.customer_tree.configure(yscrollcommand=customer_scrollbar.set)
         customer_scrollbar.grid(row=0, column=1, sticky="ns")
 
-        self.refresh_customer_list()
-
     def delete_customer(self):
         selected = self.customer_tree.selection()
         if not selected:
@@ -505,9 +753,8 @@ class DieselInventoryApp:
                             return
                         # Delete using the actual database ID (db_id)
                         cursor.execute("DELETE FROM customers WHERE id = ?", (db_id,))
-                    self.refresh_customer_list() # Refresh to renumber display IDs
-                    self.refresh_customer_names() # Update names in sales tab dropdown/search
-                    self.update_stats_customer_combobox() # Update stats tab combobox too
+                    # Renumber display IDs, update names in the sales and stats comboboxes
+                    self.process_changes()
                 except sqlite3.Error as e:
                     messagebox.showerror("数据库错误", f"删除客户时出错: {e}")
             else:
@@ -559,10 +806,8 @@ class DieselInventoryApp:
                         # Update using the actual database ID (db_id)
                         cursor.execute("UPDATE customers SET name = ? WHERE id = ?", (new_name, db_id))
                     edit_dialog.destroy()
-                    self.refresh_customer_list() # Refresh to show changes and renumber
-                    self.refresh_customer_names() # Update names list used elsewhere
-                    self.refresh_sales_list() # Refresh sales list to show updated name
-                    self.update_stats_customer_combobox() # Update stats tab combobox
+                    # Show the new name in the list, both comboboxes and the sales list
+                    self.process_changes()
                 except sqlite3.Error as e:
                     messagebox.showerror("数据库错误", f"无法更新客户: {e}", parent=edit_dialog)
             else:
@@ -594,7 +839,8 @@ class DieselInventoryApp:
         ttk.Label(input_frame, text="客户搜索:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
         self.sales_customer_search_entry = ttk.Entry(input_frame)
         self.sales_customer_search_entry.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
-        self.sales_customer_search_entry.bind("<KeyRelease>", self.update_customer_combobox_filter)
+        self._customer_filter_after = None # Pending debounced filter
+        self.sales_customer_search_entry.bind("<KeyRelease>", self.schedule_customer_combobox_filter)
 
         # Row 1: Customer Selection Combobox
         ttk.Label(input_frame, text="选择客户:").grid(row=1, column=0, padx=5, pady=5, sticky="e")
@@ -673,9 +919,18 @@ class DieselInventoryApp:
 
         # Scrollbar
         sales_scrollbar = ttk.Scrollbar(list_frame, orient="vertical", command=self.sales_tree.yview)
-        self.sales_tree.configure(yscrollcommand=sales_scrollbar.set)
         sales_scrollbar.grid(row=0, column=1, sticky="ns")
 
+        # Only a window of sales is kept in the tree; pages are fetched by sales.id on scroll
+        # (PagedTreeView takes over the tree's yscrollcommand)
+        self.sales_view = PagedTreeView(
+            self.sales_tree, sales_scrollbar,
+            fetch_after=self._fetch_sales_after,
+            fetch_before=self._fetch_sales_before,
+            count_rows=self._count_sales,
+            format_row=self._format_sales_row,
+        )
+
         # --- Edit/Delete Buttons Frame (Row 3) ---
         edit_delete_frame = ttk.Frame(self.sales_tab)
         edit_delete_frame.grid(row=3, column=0, padx=10, pady=5, sticky="e")
@@ -683,17 +938,19 @@ class DieselInventoryApp:
         ttk.Button(edit_delete_frame, text="编辑选中记录", command=self.edit_sales_record).pack(side="left", padx=5)
         ttk.Button(edit_delete_frame, text="删除选中记录", command=self.delete_sales_record).pack(side="left", padx=5)
 
-        # Initialize customer data and lists (already done in __init__)
-        # self.customer_data = {} # Dictionary to store {name: id}
-        # self.refresh_customer_names() # Populate combobox and data dict
-        self.refresh_sales_list()
-        self.update_remaining_liters()
+        # Lists and customer data are loaded by the initial refresh in __init__
 
-    def update_customer_combobox_filter(self, event):
-        """Filters the customer combobox based on the search entry."""
-        search_term = self.sales_customer_search_entry.get().lower()
-        # Use self.customer_data which stores {name: id}
-        filtered_names = sorted([name for name in self.customer_data if search_term in name.lower()])
+    def schedule_customer_combobox_filter(self, event=None):
+        """Debounces search keystrokes: filters once typing pauses for SEARCH_DEBOUNCE_MS."""
+        if self._customer_filter_after is not None:
+            self.root.after_cancel(self._customer_filter_after)
+        self._customer_filter_after = self.root.after(SEARCH_DEBOUNCE_MS, self.update_customer_combobox_filter)
+
+    def update_customer_combobox_filter(self, event=None):
+        """Filters the customer combobox based on the search entry (name or pinyin initials)."""
+        self._customer_filter_after = None
+        # Indexed lookup, narrowed from the previous result while the term keeps growing
+        filtered_names = self.customer_index.search(self.sales_customer_search_entry.get())
 
         current_selection = self.sales_customer_combobox.get() # Store current selection
 
@@ -717,63 +974,54 @@ class DieselInventoryApp:
             # Also clear order number if no customer is selected
             self._update_next_sales_order_number(None)
 
+    def load_order_numbers(self):
+        """Reloads the per-customer last order numbers (one grouped query)."""
+        self.order_numbers.clear()
+        if self.conn:
+            try:
+                self.order_numbers.load(self.conn)
+            except sqlite3.Error as e:
+                print(f"Error loading last order numbers: {e}") # Retried on the next suggestion
+
     def _update_next_sales_order_number(self, customer_id):
         """
-        Fetches the last order number. If numeric: increments it.
-        If the original numeric number started with '0', ensures the result also
-        starts with '0', potentially increasing the total length (e.g., 09999 -> 010000).
-        Otherwise (non-numeric, no record, or original numeric didn't start with '0'),
-        defaults to '01'.
+        Fills in the suggested next order number for the customer (see
+        order_numbers.increment_order_number), from the per-customer cache.
         """
-        next_order_number = "01" # Default value
+        next_order_number = DEFAULT_ORDER_NUMBER
 
+        if customer_id and self.sync:
+            self._suggest_order_number_from_server(customer_id)
+            return
         if customer_id and self.conn:
             try:
-                with self.conn:
-                    cursor = self.conn.cursor()
-                    cursor.execute("SELECT order_number FROM sales WHERE customer_id = ? ORDER BY id DESC LIMIT 1", (customer_id,))
-                    last_order_result = cursor.fetchone()
-
-                    if last_order_result and last_order_result[0]:
-                        last_order_num_str = last_order_result[0]
-                        # Check if the last order number is purely numeric
-                        if last_order_num_str.isdigit():
-                            started_with_zero = last_order_num_str.startswith('0')
-                            try:
-                                original_length = len(last_order_num_str)
-                                next_num = int(last_order_num_str) + 1
-                                next_num_str = str(next_num)
-
-                                if started_with_zero:
-                                    # First, pad to at least the original length
-                                    padded_to_original = next_num_str.zfill(original_length)
-                                    # If, after padding, it *still* doesn't start with '0'
-                                    # (e.g., 09->10, 09999->10000), prepend an extra '0'.
-                                    if not padded_to_original.startswith('0'):
-                                         next_order_number = '0' + padded_to_original # Force leading zero
-                                    else:
-                                         next_order_number = padded_to_original
-                                else:
-                                    # Original didn't start with '0', just use the incremented number directly
-                                    next_order_number = next_num_str
-                            except ValueError:
-                                # Should not happen if isdigit() is true, but as fallback
-                                print(f"Error converting supposedly numeric '{last_order_num_str}' to int.")
-                                next_order_number = "01" # Default back
-                        else:
-                            # Last order number was not purely numeric, use default
-                            print(f"Last order number '{last_order_num_str}' is not numeric. Defaulting to '01'.")
-                            next_order_number = "01"
-                    # else: No last record found, default "01" is already set
-
+                next_order_number = self.order_numbers.suggest(self.conn, customer_id)
             except sqlite3.Error as e:
                 print(f"Error fetching last order number: {e}")
-                next_order_number = "01" # Default on DB error
+                next_order_number = DEFAULT_ORDER_NUMBER # Default on DB error
 
         # Update the entry field
+        self._suggested_order_number = next_order_number
         self.sales_order_number_entry.delete(0, tk.END)
         self.sales_order_number_entry.insert(0, next_order_number)
 
+    def _suggest_order_number_from_server(self, customer_id):
+        """Client mode: asks the server (read-cached) for the next number, filled in when it arrives."""
+        self._suggested_order_number = None
+        self.sales_order_number_entry.delete(0, tk.END)
+
+        def on_success(next_order_number):
+            # Skip if another customer was selected or a number was typed meanwhile
+            if self.selected_customer_id != customer_id or self.sales_order_number_entry.get().strip():
+                return
+            self._suggested_order_number = next_order_number
+            self.sales_order_number_entry.insert(0, next_order_number)
+
+        def on_error(e):
+            print(f"Error fetching next order number from server: {e}")
+
+        self.jobs.submit(lambda job: self.sync.next_order_number(customer_id), on_success=on_success, on_error=on_error)
+
     def on_customer_selected(self, event):
         """Updates selected_customer_id and triggers order number update."""
         selected_name = self.sales_customer_combobox.get()
@@ -866,38 +1114,19 @@ class DieselInventoryApp:
                 if new_price_per_liter <= 0: raise ValueError("单价必须大于0")
                 if new_quantity_liter <= 0: raise ValueError("数量必须大于0")
 
-                new_total_price = new_price_per_liter * new_quantity_liter
-
-                quantity_change = new_quantity_liter - original_quantity_liter
-                current_remaining = self.calculate_remaining_liters()
-
-                # Check if enough stock for the *increase* only
-                if quantity_change > 0 and quantity_change > current_remaining:
-                     messagebox.showwarning("库存不足", f"编辑后增加的数量 ({quantity_change:.2f} 升) 超过当前剩余库存 ({current_remaining:.2f} 升)。", parent=edit_dialog)
-                     return
-
                 if self.conn: # Add check
-                    with self.conn:
-                        cursor = self.conn.cursor()
-                        # Check for duplicate sales order number (excluding current record, using db_id)
-                        cursor.execute("SELECT id FROM sales WHERE order_number = ? AND id != ?", (new_order_number, db_id))
-                        if cursor.fetchone():
-                            messagebox.showerror("错误", f"销售单号 '{new_order_number}' 已存在", parent=edit_dialog)
-                            return
-
-                        cursor.execute('''
-                            UPDATE sales SET
-                                sale_date = ?,
-                                order_number = ?,
-                                price_per_liter = ?,
-                                quantity_liter = ?,
-                                total_price = ?
-                            WHERE id = ?
-                        ''', (new_sale_date, new_order_number, new_price_per_liter, new_quantity_liter, new_total_price, db_id)) # Use db_id here
+                    # Checks the stock for the *increase* only, in the same transaction as the update
+                    try:
+                        new_total_price = services.update_sale(self.conn, db_id, new_sale_date, new_order_number,
+                                                               new_price_per_liter, new_quantity_liter)
+                    except services.InsufficientStockError as e:
+                        messagebox.showwarning("库存不足", str(e), parent=edit_dialog)
+                        return
+                    except services.DuplicateOrderNumberError as e:
+                        messagebox.showerror("错误", str(e), parent=edit_dialog)
+                        return
                     edit_dialog.destroy()
-                    self.refresh_sales_list() # Handles auto-scroll and renumbering
-                    self.update_remaining_liters()
-                    self.refresh_statistics() # Refresh stats after editing sale
+                    self.process_changes() # Updates the row, stock and stats after editing sale
                     # Removed success messagebox
                 else:
                     messagebox.showerror("数据库错误", "数据库连接丢失", parent=edit_dialog)
@@ -933,9 +1162,7 @@ class DieselInventoryApp:
                         cursor = self.conn.cursor()
                         # Delete using the actual database ID (db_id)
                         cursor.execute("DELETE FROM sales WHERE id = ?", (db_id,))
-                    self.refresh_sales_list() # Refresh to renumber display IDs
-                    self.update_remaining_liters()
-                    self.refresh_statistics() # Refresh stats after deleting sale
+                    self.process_changes() # Removes the row, refreshes stock and stats after deleting sale
                 except sqlite3.Error as e:
                     messagebox.showerror("数据库错误", f"删除销售记录时出错: {e}")
             else:
@@ -972,6 +1199,14 @@ class DieselInventoryApp:
         refresh_button = ttk.Button(filter_frame, text="刷新统计", command=self.refresh_statistics)
         refresh_button.grid(row=0, column=6, padx=10, pady=5)
 
+        # Shown only while statistics are being computed in the background
+        self.stats_progressbar = ttk.Progressbar(filter_frame, mode="indeterminate", length=100)
+        self.stats_progressbar.grid(row=0, column=7, padx=5, pady=5)
+        self.stats_cancel_button = ttk.Button(filter_frame, text="取消", command=self._cancel_statistics_job)
+        self.stats_cancel_button.grid(row=0, column=8, padx=5, pady=5)
+        self.stats_progressbar.grid_remove()
+        self.stats_cancel_button.grid_remove()
+
         # --- Results Frame ---
         results_frame = ttk.Frame(self.statistics_tab)
         results_frame.grid(row=1, column=0, padx=10, pady=10, sticky="nsew")
@@ -1009,7 +1244,7 @@ class DieselInventoryApp:
         self.sales_stats_revenue_label.grid(row=3, column=0, columnspan=2, padx=5, pady=2, sticky="w")
 
         # --- Profit Stats Frame ---
-        profit_stats_frame = ttk.LabelFrame(results_frame, text="利润统计 (估算*)")
+        profit_stats_frame = ttk.LabelFrame(results_frame, text="利润统计")
         profit_stats_frame.grid(row=0, column=2, rowspan=2, padx=5, pady=5, sticky="nsew") # Span 2 rows
         profit_stats_frame.columnconfigure(1, weight=1)
         profit_stats_frame.rowconfigure(4, weight=1) # Allow treeview to expand
@@ -1020,10 +1255,16 @@ class DieselInventoryApp:
         self.profit_stats_avg_liter_label.grid(row=1, column=0, columnspan=2, padx=5, pady=2, sticky="w")
         self.profit_stats_avg_ton_label = ttk.Label(profit_stats_frame, text="每吨平均利润 (元): 0.00")
         self.profit_stats_avg_ton_label.grid(row=2, column=0, columnspan=2, padx=5, pady=2, sticky="w")
-        ttk.Label(profit_stats_frame, text="*基于全部库存的平均成本估算").grid(row=3, column=0, columnspan=2, padx=5, pady=0, sticky="w")
+        # Costing method: sales are matched against inventory lots in date order
+        ttk.Label(profit_stats_frame, text="成本计算方法:").grid(row=3, column=0, padx=5, pady=0, sticky="w")
+        self.cogs_method_combobox = ttk.Combobox(profit_stats_frame, state="readonly", width=16,
+                                                 values=list(cogs.METHOD_LABELS.values()))
+        self.cogs_method_combobox.set(cogs.METHOD_LABELS[cogs.DEFAULT_METHOD])
+        self.cogs_method_combobox.grid(row=3, column=1, padx=5, pady=0, sticky="w")
+        self.cogs_method_combobox.bind("<<ComboboxSelected>>", lambda event: self.refresh_statistics())
 
         # Monthly Profit Treeview
-        monthly_profit_frame = ttk.LabelFrame(profit_stats_frame, text="月度利润 (估算)")
+        monthly_profit_frame = ttk.LabelFrame(profit_stats_frame, text="月度利润")
         monthly_profit_frame.grid(row=4, column=0, columnspan=2, padx=5, pady=5, sticky="nsew")
         monthly_profit_frame.columnconfigure(0, weight=1)
         monthly_profit_frame.rowconfigure(0, weight=1)
@@ -1033,9 +1274,9 @@ class DieselInventoryApp:
         self.monthly_profit_tree.column("month", width=80, anchor="center")
         self.monthly_profit_tree.heading("revenue", text="销售额")
         self.monthly_profit_tree.column("revenue", width=80, anchor="e")
-        self.monthly_profit_tree.heading("cost", text="估算成本")
+        self.monthly_profit_tree.heading("cost", text="销售成本")
         self.monthly_profit_tree.column("cost", width=80, anchor="e")
-        self.monthly_profit_tree.heading("profit", text="估算利润")
+        self.monthly_profit_tree.heading("profit", text="毛利")
         self.monthly_profit_tree.column("profit", width=80, anchor="e")
         self.monthly_profit_tree.grid(row=0, column=0, sticky="nsew")
 
@@ -1066,20 +1307,144 @@ class DieselInventoryApp:
              self.stats_customer_combobox.set('') # Clear if no customers
 
     def refresh_statistics(self):
-        """Calculates and displays all statistics based on filters."""
+        """Calculates and displays all statistics based on filters.
+
+        Cached aggregates are rendered immediately; anything missing is computed
+        on the job worker thread with its own connection and rendered when ready.
+        """
         if not self.conn:
             messagebox.showerror("错误", "数据库连接丢失，无法刷新统计数据")
             return
 
+        filters = self._read_statistics_filters()
+        if filters is None: # Invalid input, error already shown
+            return
+        start_date, end_date, stats_customer_id = filters
+        cogs_method = self._selected_cogs_method()
+
+        # --- Look up what is already cached ---
+        missing = StatisticsCache.MISSING
+        inv_totals = self.stats_cache.peek('inventory_totals', ())
+        min_sale_date = self.stats_cache.peek('min_sale_date', ()) if start_date is None else None
+        query_start_date = start_date if start_date is not None else min_sale_date
+        sales_rollup = cogs_totals = missing
+        if query_start_date is not missing:
+            sales_rollup = self.stats_cache.peek('sales_rollup', (query_start_date, end_date, stats_customer_id))
+            cogs_totals = self.stats_cache.peek('cogs', (query_start_date, end_date, stats_customer_id, cogs_method))
+
+        if missing not in (inv_totals, min_sale_date, sales_rollup, cogs_totals):
+            self._cancel_statistics_job()
+            self._render_statistics(inv_totals, start_date is None, query_start_date, sales_rollup, cogs_totals)
+            return
+
+        # --- Compute the missing parts off the UI thread ---
+        cache_version = self.stats_cache.version
+
+        def work(job):
+            results = {}
+            if inv_totals is missing:
+                results['inventory_totals'] = services.query_inventory_totals(job.conn)
+                job.progress(None, "入库统计")
+            job_start_date = query_start_date
+            if job_start_date is missing:
+                job_start_date = results['min_sale_date'] = services.query_min_sale_date(job.conn)
+            job.check_cancelled()
+            filter_key = (job_start_date, end_date, stats_customer_id)
+            results['sales_rollup'] = (filter_key, sales_rollup if sales_rollup is not missing
+                                       else database.query_sales_rollup(job.conn, *filter_key))
+            if cogs_totals is missing:
+                # Replays only what changed since the last update (usually nothing or a few sales)
+                results['cogs'] = services.query_cogs(job.conn, cogs_method, *filter_key, progress=job.progress)
+            return results
+
+        def on_success(results):
+            if job is not self._stats_job: # Superseded by a newer refresh
+                return
+            self._set_statistics_busy(False)
+            self._stats_job = None
+            if self.stats_cache.version == cache_version: # No write happened meanwhile
+                if 'inventory_totals' in results:
+                    self.stats_cache.put('inventory_totals', (), ('inventory',), results['inventory_totals'])
+                if 'min_sale_date' in results:
+                    self.stats_cache.put('min_sale_date', (), ('sales',), results['min_sale_date'])
+                filter_key, rollup = results['sales_rollup']
+                self.stats_cache.put('sales_rollup', filter_key, ('sales',), rollup)
+                if 'cogs' in results:
+                    self.stats_cache.put('cogs', filter_key + (cogs_method,), ('inventory', 'sales'), results['cogs'])
+            filter_key, rollup = results['sales_rollup']
+            self._render_statistics(results.get('inventory_totals', inv_totals), start_date is None, filter_key[0], rollup,
+                                    results.get('cogs', cogs_totals))
+
+        def on_error(e):
+            if job is not self._stats_job:
+                return
+            self._set_statistics_busy(False)
+            self._stats_job = None
+            if isinstance(e, sqlite3.Error):
+                messagebox.showerror("数据库错误", f"统计查询失败: {e}")
+            else:
+                messagebox.showerror("错误", f"计算统计数据时发生意外错误: {e}")
+
+        def on_cancelled():
+            if job is self._stats_job:
+                self._set_statistics_busy(False)
+                self._stats_job = None
+
+        self._cancel_statistics_job() # Only the newest refresh matters
+        job = self.jobs.submit(work, db_path=self.db_path, on_success=on_success,
+                               on_error=on_error, on_cancelled=on_cancelled)
+        self._stats_job = job
+        self._set_statistics_busy(True)
+
+    def _read_statistics_filters(self):
+        """Validates the statistics filters.
+
+        :return: (start_date or None for "from the earliest sale", end_date or None, customer_id or None),
+                 or None if a date is invalid (an error has been shown)
+        """
+        start_date_str = self.stats_start_date_entry.get().strip()
+        end_date_str = self.stats_end_date_entry.get().strip()
+        selected_customer_name = self.stats_customer_combobox.get()
+
+        if start_date_str:
+            try:
+                datetime.strptime(start_date_str, "%Y-%m-%d")
+            except ValueError:
+                messagebox.showerror("日期错误", "开始日期格式无效，请使用 YYYY-MM-DD")
+                return None
+
+        if end_date_str:
+            try:
+                datetime.strptime(end_date_str, "%Y-%m-%d")
+            except ValueError:
+                messagebox.showerror("日期错误", "结束日期格式无效，请使用 YYYY-MM-DD")
+                return None
+        # If end_date is empty, no upper bound is applied
+
+        # Customer filtering
+        stats_customer_id = None
+        if selected_customer_name and selected_customer_name != "所有客户":
+            stats_customer_id = self.customer_data.get(selected_customer_name)
+            if not stats_customer_id:
+                # Should not happen if combobox is populated correctly
+                print(f"Warning: Could not find ID for customer '{selected_customer_name}'")
+
+        return start_date_str or None, end_date_str or None, stats_customer_id
+
+    def _selected_cogs_method(self):
+        """The costing method chosen in the profit frame (cogs.FIFO or cogs.AVERAGE)."""
+        selected_label = self.cogs_method_combobox.get()
+        for method, label in cogs.METHOD_LABELS.items():
+            if label == selected_label:
+                return method
+        return cogs.DEFAULT_METHOD
+
+    def _render_statistics(self, inv_totals, fill_start_date, start_date, sales_rollup, cogs_totals):
+        """Writes computed statistics into the labels and the monthly profit tree."""
         try:
             # --- 1. Inventory Statistics (Always Full History) ---
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT COUNT(*), SUM(quantity_ton), SUM(total_liters) FROM inventory")
-            inv_count, inv_tons, inv_liters = cursor.fetchone()
-            inv_count = inv_count or 0
-            inv_tons = inv_tons or 0.0
-            inv_liters = inv_liters or 0.0
-            remaining_liters = self.calculate_remaining_liters() # Use existing method
+            inv_count, inv_tons, inv_liters, total_inv_cost, avg_density = inv_totals
+            remaining_liters = self.calculate_remaining_liters() # O(1) stock balance read
 
             self.inv_stats_count_label.config(text=f"入库次数: {inv_count}")
             self.inv_stats_tons_label.config(text=f"总入库量 (吨): {inv_tons:.2f}")
@@ -1087,123 +1452,21 @@ class DieselInventoryApp:
             self.inv_stats_remaining_label.config(text=f"当前库存余量 (升): {remaining_liters:.2f}")
 
             # --- 2. Sales Statistics (Based on Filters) ---
-            start_date_str = self.stats_start_date_entry.get().strip()
-            end_date_str = self.stats_end_date_entry.get().strip()
-            selected_customer_name = self.stats_customer_combobox.get()
-
-            # Build WHERE clause and parameters
-            where_clauses = []
-            params = []
-
-            # Date filtering
-            # Set default start date if empty
-            if not start_date_str:
-                 # Find the earliest sale date if start date is empty
-                 cursor.execute("SELECT MIN(sale_date) FROM sales")
-                 min_date_result = cursor.fetchone()
-                 start_date_str = min_date_result[0] if min_date_result and min_date_result[0] else None
-                 if start_date_str:
-                     self.stats_start_date_entry.delete(0, tk.END)
-                     self.stats_start_date_entry.insert(0, start_date_str)
-                     # Add to where clause only if a valid date was found
-                     where_clauses.append("s.sale_date >= ?")
-                     params.append(start_date_str)
-                 # No need to add to where_clauses if it remains None
-
-            elif start_date_str:
-                try:
-                    datetime.strptime(start_date_str, "%Y-%m-%d")
-                    where_clauses.append("s.sale_date >= ?")
-                    params.append(start_date_str)
-                except ValueError:
-                    messagebox.showerror("日期错误", "开始日期格式无效，请使用 YYYY-MM-DD")
-                    return
+            if fill_start_date and start_date:
+                # Start date was empty: show the earliest sale date that was used
+                self.stats_start_date_entry.delete(0, tk.END)
+                self.stats_start_date_entry.insert(0, start_date)
 
-            if end_date_str:
-                try:
-                    datetime.strptime(end_date_str, "%Y-%m-%d")
-                    where_clauses.append("s.sale_date <= ?")
-                    params.append(end_date_str)
-                except ValueError:
-                    messagebox.showerror("日期错误", "结束日期格式无效，请使用 YYYY-MM-DD")
-                    return
-            # If end_date is empty, no upper bound is applied
-
-            # Customer filtering
-            stats_customer_id = None
-            if selected_customer_name and selected_customer_name != "所有客户":
-                stats_customer_id = self.customer_data.get(selected_customer_name)
-                if stats_customer_id:
-                    where_clauses.append("s.customer_id = ?")
-                    params.append(stats_customer_id)
-                else:
-                    # Should not happen if combobox is populated correctly
-                    print(f"Warning: Could not find ID for customer '{selected_customer_name}'")
-
-            where_sql = " AND ".join(where_clauses) if where_clauses else "1=1" # Use 1=1 if no filters
-
-            # Query for sales stats
-            sales_query = f"""
-                SELECT
-                    COUNT(s.id),
-                    AVG(s.price_per_liter),
-                    SUM(s.quantity_liter),
-                    SUM(s.total_price)
-                FROM sales s
-                WHERE {where_sql}
-            """
-            cursor.execute(sales_query, params)
-            sales_count, sales_avg_price, sales_liters, sales_revenue = cursor.fetchone()
-            sales_count = sales_count or 0
-            sales_avg_price = sales_avg_price or 0.0
-            sales_liters = sales_liters or 0.0
-            sales_revenue = sales_revenue or 0.0
+            sales_totals, monthly_data = sales_rollup
+            sales_count, sales_avg_price, sales_liters, sales_revenue = sales_totals
 
             self.sales_stats_count_label.config(text=f"交易次数: {sales_count}")
             self.sales_stats_avg_price_label.config(text=f"平均单价 (元/升): {sales_avg_price:.2f}")
             self.sales_stats_liters_label.config(text=f"总销售量 (升): {sales_liters:.2f}")
             self.sales_stats_revenue_label.config(text=f"总销售额 (元): {sales_revenue:.2f}")
 
-            # --- 3. Profit Statistics (Estimation) ---
-            total_profit = 0.0
-            avg_profit_liter = 0.0
-            avg_profit_ton = 0.0
-
-            # Calculate overall average cost per liter from ALL inventory
-            cursor.execute("""
-                SELECT SUM(price_per_ton * quantity_ton), SUM(total_liters)
-                FROM inventory
-            """)
-            total_inv_cost_result, total_inv_liters_result = cursor.fetchone()
-            total_inv_cost = total_inv_cost_result or 0.0
-            total_inv_liters = total_inv_liters_result or 0.0
-
-            overall_avg_cost_liter = 0.0
-            if total_inv_liters > 0:
-                 # Cost is price_per_ton * quantity_ton. We need cost per liter.
-                 # Total cost = SUM(price_per_ton * quantity_ton)
-                 # Total liters = SUM(total_liters)
-                 # Avg cost per liter = Total cost / Total liters
-                 # However, price_per_ton is in Yuan/Ton. total_liters is in Liters.
-                 # We need cost in Yuan. SUM(price_per_ton * quantity_ton) gives total Yuan cost.
-                 overall_avg_cost_liter = total_inv_cost / total_inv_liters
-
-            # Calculate estimated profit for the filtered period
-            if sales_count > 0:
-                estimated_cogs = sales_liters * overall_avg_cost_liter
-                total_profit = sales_revenue - estimated_cogs
-                if sales_liters > 0:
-                    avg_profit_liter = total_profit / sales_liters
-
-                # Estimate average density to convert sales liters to tons for avg profit/ton
-                cursor.execute("SELECT AVG(density) FROM inventory")
-                avg_density_result = cursor.fetchone()
-                avg_density = avg_density_result[0] if avg_density_result and avg_density_result[0] else 0.84 # Default if no inventory
-                if avg_density > 0:
-                    sales_tons_estimated = (sales_liters / 1000) * avg_density
-                    if sales_tons_estimated > 0:
-                        avg_profit_ton = total_profit / sales_tons_estimated
-
+            # --- 3. Profit Statistics (cost of each sale from the FIFO / moving-average lot matching) ---
+            total_profit, avg_profit_liter, avg_profit_ton = services.profit_summary(sales_totals, cogs_totals, avg_density)
             self.profit_stats_total_label.config(text=f"总利润 (元): {total_profit:.2f}")
             self.profit_stats_avg_liter_label.config(text=f"每升平均利润 (元): {avg_profit_liter:.2f}")
             self.profit_stats_avg_ton_label.config(text=f"每吨平均利润 (元): {avg_profit_ton:.2f}")
@@ -1213,38 +1476,72 @@ class DieselInventoryApp:
             for item in self.monthly_profit_tree.get_children():
                 self.monthly_profit_tree.delete(item)
 
-            # Query monthly sales data based on filters
-            monthly_query = f"""
-                SELECT
-                    strftime('%Y-%m', s.sale_date) as sale_month,
-                    SUM(s.total_price) as monthly_revenue,
-                    SUM(s.quantity_liter) as monthly_liters
-                FROM sales s
-                WHERE {where_sql}
-                GROUP BY sale_month
-                ORDER BY sale_month ASC
-            """
-            cursor.execute(monthly_query, params)
-            monthly_data = cursor.fetchall()
-
-            for month, monthly_revenue, monthly_liters in monthly_data:
-                monthly_revenue = monthly_revenue or 0.0
-                monthly_liters = monthly_liters or 0.0
-                monthly_estimated_cogs = monthly_liters * overall_avg_cost_liter
-                monthly_profit = monthly_revenue - monthly_estimated_cogs
+            # Monthly sales data (from the rollup read above), costs from sale_cogs
+            for month, monthly_revenue, monthly_cost, monthly_profit in services.monthly_profit_rows(monthly_data, cogs_totals):
                 self.monthly_profit_tree.insert("", "end", values=(
                     month,
                     f"{monthly_revenue:.2f}",
-                    f"{monthly_estimated_cogs:.2f}",
+                    f"{monthly_cost:.2f}",
                     f"{monthly_profit:.2f}"
                 ))
 
-        except sqlite3.Error as e:
-            messagebox.showerror("数据库错误", f"统计查询失败: {e}")
         except Exception as e:
              # Print detailed error for debugging
              traceback.print_exc()
              messagebox.showerror("错误", f"计算统计数据时发生意外错误: {e}")
+
+    def _set_statistics_busy(self, busy):
+        """Shows/hides the statistics progress bar and cancel button."""
+        if busy:
+            self.stats_progressbar.grid()
+            self.stats_cancel_button.grid()
+            self.stats_progressbar.start(10)
+        else:
+            self.stats_progressbar.stop()
+            self.stats_progressbar.grid_remove()
+            self.stats_cancel_button.grid_remove()
+
+    def _cancel_statistics_job(self):
+        if self._stats_job is not None:
+            self._stats_job.cancel()
+            self._stats_job = None
+            self._set_statistics_busy(False)
+
+    def rebuild_sales_rollups(self):
+        """Recomputes the daily/monthly sales rollup tables from the sales ledger."""
+        if not self.conn:
+            messagebox.showerror("数据库错误", "数据库连接丢失，无法重建。")
+            return
+        try:
+            database.rebuild_sales_rollups(self.conn)
+            self.stats_cache.invalidate('sales')
+            self.refresh.mark_dirty('statistics')
+            messagebox.showinfo("重建完成", "销售汇总表已根据销售记录重建。")
+        except sqlite3.Error as e:
+            messagebox.showerror("数据库错误", f"重建销售汇总表时出错: {e}")
+
+    def rebuild_cogs(self):
+        """Recomputes the per-sale cost of goods (both methods) from scratch, in the background."""
+        if not self.conn:
+            messagebox.showerror("数据库错误", "数据库连接丢失，无法重新计算。")
+            return
+        dialog = ProgressDialog(self.root, "重新计算销售成本", "正在计算...")
+
+        def on_success(result):
+            dialog.close()
+            self.stats_cache.invalidate('sales')
+            self.refresh.mark_dirty('statistics')
+            messagebox.showinfo("计算完成", "销售成本已根据入库和销售记录重新计算。")
+
+        def on_error(e):
+            dialog.close()
+            messagebox.showerror("数据库错误", f"重新计算销售成本时出错: {e}")
+
+        job = self.jobs.submit(lambda job: cogs.rebuild_cogs(job.conn, progress=job.progress), db_path=self.db_path,
+                               on_success=on_success, on_error=on_error, on_progress=dialog.update,
+                               on_cancelled=dialog.close)
+        dialog.attach(job)
+
     # --- End Statistics Tab Methods ---
 
 
@@ -1262,9 +1559,8 @@ class DieselInventoryApp:
                             return
                         cursor.execute("INSERT INTO customers (name) VALUES (?)", (name,))
                     self.customer_name_entry.delete(0, tk.END)
-                    self.refresh_customer_list() # Refresh to show new customer and renumber
-                    self.refresh_customer_names() # Update combobox in sales tab
-                    self.update_stats_customer_combobox() # Update stats tab combobox too
+                    # Show the new customer (renumbered) in the list and both comboboxes
+                    self.process_changes()
                 except sqlite3.Error as e:
                     messagebox.showerror("数据库错误", f"保存客户时出错: {e}")
             else:
@@ -1308,58 +1604,61 @@ class DieselInventoryApp:
 
 
     def refresh_sales_list(self):
-        # Clear list
-        for row in self.sales_tree.get_children():
-            self.sales_tree.delete(row)
-
-        # Reload using JOIN to get customer name
-        last_inserted_iid = None
+        # Apply the sales changes since the last refresh; a full reload (newest
+        # page, older pages fetched on scroll) handles renumbering and auto-scroll
         if self.conn: # Add check
             try:
-                with self.conn:
-                    cursor = self.conn.cursor()
-                    # Order by sales id ASC for sequential display ID
-                    cursor.execute('''
-                        SELECT s.id, c.name, s.sale_date, s.order_number, s.price_per_liter, s.quantity_liter, s.total_price
-                        FROM sales s
-                        LEFT JOIN customers c ON s.customer_id = c.id
-                        ORDER BY s.id ASC
-                    ''')
-                    rows = cursor.fetchall()
-                    # Use enumerate to generate display ID (starts from 1)
-                    for display_id, row in enumerate(rows, start=1):
-                        db_id, cust_name, sale_date, order_num, price, qty, total = row
-                        # Initialize list with string representation of display_id
-                        formatted_row = [str(display_id)]
-                        formatted_row.append(str(cust_name) if cust_name else "未知客户")
-                        formatted_row.append(str(sale_date))
-                        formatted_row.append(str(order_num))
-                        # Format numbers for display (already strings)
-                        formatted_row.append(f"{price:.2f}" if price is not None else "0.00")
-                        formatted_row.append(f"{qty:.2f}" if qty is not None else "0.00")
-                        formatted_row.append(f"{total:.2f}" if total is not None else "0.00")
-
-                        # Use the database ID (db_id) as the item ID (iid) in the treeview
-                        item_iid = str(db_id)
-                        self.sales_tree.insert("", "end", iid=item_iid, values=tuple(formatted_row))
-                        last_inserted_iid = item_iid # Keep track of the last one
-
-                    # --- Auto-scroll Sales Table to Bottom ---
-                    if last_inserted_iid:
-                        try:
-                            # Select the last inserted item
-                            self.sales_tree.selection_set(last_inserted_iid)
-                            # Scroll to make the last inserted item visible (at the bottom)
-                            self.sales_tree.see(last_inserted_iid)
-                        except Exception as e:
-                            print(f"Error auto-scrolling sales table: {e}")
-                    # --- End Auto-scroll ---
-
+                self._catch_up_tree_view('sales', self.sales_view, self._fetch_sales_rows, self.sales_view.reload)
             except sqlite3.Error as e:
                 messagebox.showerror("数据库错误", f"无法加载销售列表: {e}")
         else:
             messagebox.showerror("数据库错误", "无法加载销售列表，数据库连接丢失")
 
+    # --- Sales list paging helpers (used by self.sales_view) ---
+    SALES_LIST_SELECT = '''
+        SELECT s.id, c.name, s.sale_date, s.order_number, s.price_per_liter, s.quantity_liter, s.total_price
+        FROM sales s
+        LEFT JOIN customers c ON s.customer_id = c.id
+    '''
+
+    def _fetch_sales_after(self, after_id, limit):
+        """Returns up to `limit` sales rows with id > after_id, oldest first."""
+        cursor = self.conn.cursor()
+        cursor.execute(self.SALES_LIST_SELECT + " WHERE s.id > ? ORDER BY s.id ASC LIMIT ?", (after_id, limit))
+        return cursor.fetchall()
+
+    def _fetch_sales_before(self, before_id, limit):
+        """Returns up to `limit` sales rows with id < before_id (newest rows if None), newest first."""
+        cursor = self.conn.cursor()
+        if before_id is None:
+            cursor.execute(self.SALES_LIST_SELECT + " ORDER BY s.id DESC LIMIT ?", (limit,))
+        else:
+            cursor.execute(self.SALES_LIST_SELECT + " WHERE s.id < ? ORDER BY s.id DESC LIMIT ?", (before_id, limit))
+        return cursor.fetchall()
+
+    def _fetch_sales_rows(self, ids):
+        """Returns the sales rows with the given ids, oldest first."""
+        cursor = self.conn.cursor()
+        cursor.execute(self.SALES_LIST_SELECT + f" WHERE s.id IN ({','.join('?' * len(ids))}) ORDER BY s.id ASC", ids)
+        return cursor.fetchall()
+
+    def _count_sales(self):
+        return database.get_sales_count(self.conn) # Trigger-maintained, no table scan
+
+    @staticmethod
+    def _format_sales_row(display_id, row):
+        db_id, cust_name, sale_date, order_num, price, qty, total = row
+        # Initialize list with string representation of display_id
+        formatted_row = [str(display_id)]
+        formatted_row.append(str(cust_name) if cust_name else "未知客户")
+        formatted_row.append(str(sale_date))
+        formatted_row.append(str(order_num))
+        # Format numbers for display (already strings)
+        formatted_row.append(f"{price:.2f}" if price is not None else "0.00")
+        formatted_row.append(f"{qty:.2f}" if qty is not None else "0.00")
+        formatted_row.append(f"{total:.2f}" if total is not None else "0.00")
+        return tuple(formatted_row)
+
     def refresh_customer_names(self):
         # Refreshes the customer data dictionary and the combobox
         self.customer_data = {}
@@ -1382,10 +1681,13 @@ class DieselInventoryApp:
             self.customer_data = {}
             customer_names_list = []
 
+        # Names arrive sorted, so index positions are already display order
+        self.customer_index = CustomerSearchIndex(customer_names_list)
+
         # Update sales tab combobox values and selection
-        current_search = self.sales_customer_search_entry.get().lower()
+        current_search = self.sales_customer_search_entry.get()
         if current_search: # If there's a search term, filter based on it
-             filtered_names = sorted([name for name in customer_names_list if current_search in name.lower()])
+             filtered_names = self.customer_index.search(current_search)
              self.sales_customer_combobox['values'] = filtered_names
              if filtered_names:
                  self.sales_customer_combobox.set(filtered_names[0])
@@ -1411,9 +1713,7 @@ class DieselInventoryApp:
         final_selected_name = self.sales_customer_combobox.get()
         self.selected_customer_id = self.customer_data.get(final_selected_name)
         self._update_next_sales_order_number(self.selected_customer_id)
-
-        # Update stats tab combobox as well, after sales tab is updated
-        self.update_stats_customer_combobox()
+        # The stats tab combobox is its own view ('stats_customers'), refreshed right after this one
 
 
     def add_sales_record(self):
@@ -1449,39 +1749,27 @@ class DieselInventoryApp:
             if price_per_liter <= 0: raise ValueError("单价必须大于0")
             if quantity_liter <= 0: raise ValueError("数量必须大于0")
 
-            total_price = price_per_liter * quantity_liter
-
-            current_remaining = self.calculate_remaining_liters()
-            if quantity_liter > current_remaining:
-                messagebox.showwarning("库存不足", f"当前剩余库存 {current_remaining:.2f} 升，不足以销售 {quantity_liter:.2f} 升。")
+            if self.sync:
+                # The server checks stock and the order number in one transaction
+                self._send_sale_to_server(customer_id, sale_date,
+                                          None if order_number == self._suggested_order_number else order_number,
+                                          price_per_liter, quantity_liter)
                 return
 
             if self.conn: # Add check
-                with self.conn:
-                    cursor = self.conn.cursor()
-                    # Check for duplicate sales order number before inserting
-                    cursor.execute("SELECT id FROM sales WHERE order_number = ?", (order_number,))
-                    if cursor.fetchone():
-                        messagebox.showerror("错误", f"销售单号 '{order_number}' 已存在")
-                        return
-
-                    cursor.execute('''
-                        INSERT INTO sales (customer_id, sale_date, order_number, price_per_liter, quantity_liter, total_price)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    ''', (customer_id, sale_date, order_number, price_per_liter, quantity_liter, total_price))
-
-                # Clear specific input fields after successful insertion
-                self.sales_order_number_entry.delete(0, tk.END)
-                # self.sales_price_entry.delete(0, tk.END) # Keep price
-                self.sales_quantity_entry.delete(0, tk.END)
-                # Keep customer, date, and price
-
-                # Auto-fill next order number for the *same* customer after adding
-                self._update_next_sales_order_number(customer_id) # Use current customer_id
-
-                self.refresh_sales_list() # This now handles auto-scroll
-                self.update_remaining_liters()
-                self.refresh_statistics() # Refresh stats after adding sale
+                # Stock check, order number and insert in one write transaction. An
+                # auto-filled number is re-reserved there (another terminal may have used it)
+                try:
+                    _, order_number, _ = services.add_sale(
+                        self.conn, customer_id, sale_date, None if order_number == self._suggested_order_number else order_number,
+                        price_per_liter, quantity_liter)
+                except services.InsufficientStockError as e:
+                    messagebox.showwarning("库存不足", str(e))
+                    return
+                except services.DuplicateOrderNumberError as e:
+                    messagebox.showerror("错误", str(e))
+                    return
+                self._after_sale_added(customer_id, order_number)
             else:
                 messagebox.showerror("数据库错误", "无法添加销售记录，数据库连接丢失")
                 return
@@ -1492,6 +1780,54 @@ class DieselInventoryApp:
             messagebox.showerror("数据库错误", f"添加销售记录时出错: {e}")
 
 
+    def _send_sale_to_server(self, customer_id, sale_date, order_number, price_per_liter, quantity_liter):
+        """
+        Client mode: posts the sale on the worker thread, so a slow or
+        unreachable server does not freeze the window.
+
+        :param order_number: or None for the customer's next free number
+        """
+        if self._sync_sale_job is not None:
+            print("Previous sale is still being sent; ignoring repeated add.")
+            return
+
+        def work(job):
+            return self.sync.add_sale(customer_id, sale_date, order_number, price_per_liter, quantity_liter)
+
+        def on_success(result):
+            self._sync_sale_job = None
+            _, written_order_number, _ = result
+            self._after_sale_added(customer_id, written_order_number)
+
+        def on_error(e):
+            self._sync_sale_job = None
+            if not isinstance(e, SyncError):
+                messagebox.showerror("同步服务器错误", f"销售记录未保存: {e}")
+            elif e.code == 'insufficient_stock':
+                messagebox.showwarning("库存不足", e.message)
+            elif e.code in ('duplicate_order_number', 'invalid_request'):
+                messagebox.showerror("错误", e.message)
+            else:
+                messagebox.showerror("同步服务器错误", f"销售记录未保存: {e.message}")
+
+        self._sync_sale_job = self.jobs.submit(work, on_success=on_success, on_error=on_error)
+
+    def _after_sale_added(self, customer_id, order_number):
+        """Updates the entry fields and views after a sale was written (locally or by the sync server)."""
+        self.order_numbers.record(customer_id, order_number)
+
+        # Clear specific input fields after successful insertion
+        self.sales_order_number_entry.delete(0, tk.END)
+        # self.sales_price_entry.delete(0, tk.END) # Keep price
+        self.sales_quantity_entry.delete(0, tk.END)
+        # Keep customer, date, and price
+
+        # Auto-fill next order number for the *same* customer after adding
+        self._update_next_sales_order_number(customer_id) # Use current customer_id
+
+        # Appends the new row (auto-scroll), refreshes stock and stats after adding sale
+        self.process_changes()
+
     def create_input_fields(self, parent):
         frame = ttk.LabelFrame(parent, text="新入库记录")
         frame.grid(row=0, column=0, padx=10, pady=10, sticky="ew")
@@ -1571,6 +1907,9 @@ class DieselInventoryApp:
         self.tree.configure(yscrollcommand=scrollbar.set)
         scrollbar.grid(row=0, column=1, sticky="ns")
 
+        # Single-record changes are applied to the tree row by row
+        self.inventory_view = IncrementalTreeView(self.tree, self._format_inventory_row)
+
     def add_record(self, event=None):
         entry_date_str = self.entry_date.get().strip()
         order_num = self.order_number.get().strip()
@@ -1625,9 +1964,8 @@ class DieselInventoryApp:
                 self.density.delete(0, tk.END)
                 self.order_number.focus_set() # Focus next logical field
 
-                self.refresh_table() # This now handles auto-scroll and renumbering
-                self.update_remaining_liters()
-                self.refresh_statistics() # Refresh stats after adding inventory
+                # Appends the new row (auto-scroll), refreshes stock and stats after adding inventory
+                self.process_changes()
                 # Removed success messagebox
 
             else:
@@ -1724,9 +2062,7 @@ class DieselInventoryApp:
                         ''', (new_date, new_order, new_price, new_quantity, new_density, new_total_liters, db_id)) # Use db_id here
 
                     edit_dialog.destroy()
-                    self.refresh_table() # Refresh to show changes and renumber
-                    self.update_remaining_liters()
-                    self.refresh_statistics() # Refresh stats after editing inventory
+                    self.process_changes() # Updates the row, stock and stats after editing inventory
                     # Removed success messagebox for edit as well
                 else:
                     messagebox.showerror("数据库错误", "无法更新记录，数据库连接丢失", parent=edit_dialog)
@@ -1762,61 +2098,51 @@ class DieselInventoryApp:
                         cursor = self.conn.cursor()
                         # Delete using the actual database ID (db_id)
                         cursor.execute("DELETE FROM inventory WHERE id = ?", (db_id,))
-                    self.refresh_table() # Refresh to renumber display IDs
-                    self.update_remaining_liters()
-                    self.refresh_statistics() # Refresh stats after deleting inventory
+                    self.process_changes() # Removes the row, refreshes stock and stats after deleting inventory
                 except sqlite3.Error as e:
                     messagebox.showerror("数据库错误", f"删除入库记录时出错: {e}")
             else:
                 messagebox.showerror("数据库错误", "无法删除记录，数据库连接丢失")
                 return
 
-    def refresh_table(self):
-        # Clear existing items
-        for item in self.tree.get_children():
-            self.tree.delete(item)
+    INVENTORY_LIST_SELECT = "SELECT id, entry_date, order_number, price_per_ton, quantity_ton, density, total_liters FROM inventory"
 
-        # Reload from database
-        last_inserted_iid = None
+    def refresh_table(self):
+        # Apply the inventory changes since the last refresh (full load the first time)
         if self.conn: # Add check
             try:
-                with self.conn:
-                    cursor = self.conn.cursor()
-                    # Order by id ASC for sequential display ID
-                    cursor.execute("SELECT id, entry_date, order_number, price_per_ton, quantity_ton, density, total_liters FROM inventory ORDER BY id ASC")
-                    rows = cursor.fetchall()
-                    # Use enumerate to generate display ID (starts from 1)
-                    for display_id, row in enumerate(rows, start=1):
-                        db_id, entry_date, order_num, price, qty, density_val, total_liters = row
-                        # Initialize list with string representation of display_id
-                        formatted_row = [str(display_id)]
-                        formatted_row.append(str(entry_date))
-                        formatted_row.append(str(order_num))
-                        # Format numbers for display (already strings)
-                        formatted_row.append(f"{price:.2f}" if price is not None else "0.00")
-                        formatted_row.append(f"{qty:.2f}" if qty is not None else "0.00")
-                        formatted_row.append(f"{density_val:.3f}" if density_val is not None else "0.000")
-                        formatted_row.append(f"{total_liters:.2f}" if total_liters is not None else "0.00")
-
-                        # Use database ID as item ID (iid)
-                        item_iid = str(db_id)
-                        self.tree.insert("", "end", iid=item_iid, values=tuple(formatted_row))
-                        last_inserted_iid = item_iid # Keep track of the last one
-
-                    # --- Auto-scroll Inventory Table to Bottom ---
-                    if last_inserted_iid:
-                        try:
-                            self.tree.selection_set(last_inserted_iid)
-                            self.tree.see(last_inserted_iid)
-                        except Exception as e:
-                            print(f"Error auto-scrolling inventory table: {e}")
-                    # --- End Auto-scroll ---
-
+                self._catch_up_tree_view('inventory', self.inventory_view, self._fetch_inventory_rows, self._reload_inventory)
             except sqlite3.Error as e:
                 messagebox.showerror("数据库错误", f"无法加载库存列表: {e}")
         else:
             messagebox.showerror("数据库错误", "无法加载库存列表，数据库连接丢失")
 
+    def _reload_inventory(self):
+        cursor = self.conn.cursor()
+        # Order by id ASC for sequential display ID
+        cursor.execute(self.INVENTORY_LIST_SELECT + " ORDER BY id ASC")
+        # Renumbers display IDs and auto-scrolls to the bottom
+        self.inventory_view.load_rows(cursor.fetchall())
+
+    def _fetch_inventory_rows(self, ids):
+        cursor = self.conn.cursor()
+        cursor.execute(self.INVENTORY_LIST_SELECT + f" WHERE id IN ({','.join('?' * len(ids))}) ORDER BY id", ids)
+        return cursor.fetchall()
+
+    @staticmethod
+    def _format_inventory_row(display_id, row):
+        db_id, entry_date, order_num, price, qty, density_val, total_liters = row
+        # Initialize list with string representation of display_id
+        formatted_row = [str(display_id)]
+        formatted_row.append(str(entry_date))
+        formatted_row.append(str(order_num))
+        # Format numbers for display (already strings)
+        formatted_row.append(f"{price:.2f}" if price is not None else "0.00")
+        formatted_row.append(f"{qty:.2f}" if qty is not None else "0.00")
+        formatted_row.append(f"{density_val:.3f}" if density_val is not None else "0.000")
+        formatted_row.append(f"{total_liters:.2f}" if total_liters is not None else "0.00")
+        return tuple(formatted_row)
+
 
     def calculate_liters(self, quantity_ton, density):
         if density == 0:
@@ -1825,26 +2151,39 @@ class DieselInventoryApp:
         return (quantity_ton / density) * 1000
 
     def update_remaining_liters(self):
+        if self.sync:
+            self._update_remaining_liters_from_server()
+            return
         remaining_liters = self.calculate_remaining_liters()
         self.remaining_liters_label.config(text=f"剩余升数: {remaining_liters:.2f}")
 
+    def _update_remaining_liters_from_server(self):
+        """Client mode: reads the stock from the server (read-cached) on the worker thread."""
+        if self._stock_job is not None:
+            self._stock_refresh_again = True # Re-read once the current request is done
+            return
+
+        def done():
+            self._stock_job = None
+            if self._stock_refresh_again:
+                self._stock_refresh_again = False
+                self._update_remaining_liters_from_server()
+
+        def on_success(remaining_liters):
+            self.remaining_liters_label.config(text=f"剩余升数: {remaining_liters:.2f}")
+            done()
+
+        def on_error(e):
+            print(f"Error reading remaining liters from server: {e}")
+            done()
+
+        self._stock_job = self.jobs.submit(lambda job: self.sync.remaining_liters(), on_success=on_success, on_error=on_error)
+
     def calculate_remaining_liters(self):
-        total_in = 0
-        total_out = 0
         if self.conn: # Add check
             try:
-                with self.conn:
-                    cursor = self.conn.cursor()
-                    cursor.execute("SELECT SUM(total_liters) FROM inventory")
-                    result_in = cursor.fetchone()
-                    if result_in and result_in[0] is not None:
-                        total_in = result_in[0]
-
-                    cursor.execute("SELECT SUM(quantity_liter) FROM sales")
-                    result_out = cursor.fetchone()
-                    if result_out and result_out[0] is not None:
-                        total_out = result_out[0]
-                return total_in - total_out
+                # O(1) read of the trigger-maintained stock balance
+                return database.get_remaining_liters(self.conn)
             except sqlite3.Error as e:
                 messagebox.showerror("数据库错误", f"计算剩余升数时出错: {e}")
                 return 0
@@ -1854,11 +2193,31 @@ class DieselInventoryApp:
             print("无法计算剩余升数，数据库连接丢失")
             return 0
 
+    def verify_stock_balance(self):
+        """Checks the materialized stock balance against the ledger and offers to rebuild it."""
+        if not self.conn:
+            messagebox.showerror("数据库错误", "数据库连接丢失，无法校验。")
+            return
+        try:
+            is_consistent, stored, ledger = database.verify_stock_balance(self.conn)
+            if is_consistent:
+                messagebox.showinfo("校验通过", f"库存余额与出入库记录一致。\n剩余升数: {ledger:.2f}")
+                return
+            stored_text = f"{stored:.2f}" if stored is not None else "无"
+            if messagebox.askyesno("校验不一致", f"库存余额与出入库记录不一致！\n记录余额: {stored_text} 升\n实际余额: {ledger:.2f} 升\n\n是否根据出入库记录重建？", icon='warning'):
+                database.rebuild_stock_balance(self.conn)
+                self.stats_cache.clear()
+                self.refresh.mark_dirty('stock', 'statistics')
+                messagebox.showinfo("重建完成", "库存余额已根据出入库记录重建。")
+        except sqlite3.Error as e:
+            messagebox.showerror("数据库错误", f"校验库存余额时出错: {e}")
+
     selected_customer_id = None
 
 if __name__ == "__main__":
     os.chdir(APP_DIR)
     root = tk.Tk()
+    STARTUP_TIMELINE.mark("Tk root created")
     style = ttk.Style(root)
     tcl_version = tuple(int(part) for part in root.tk.call('info', 'patchlevel').split('.')[:2])
     if tcl_version < (8, 6):
@@ -1874,6 +2233,8 @@ if __name__ == "__main__":
         except tk.TclError:
             continue
 
-    app = DieselInventoryApp(root)
+    app = DieselInventoryApp(root, STARTUP_TIMELINE, server_url=server_url_requested())
     root.update_idletasks()
+    STARTUP_TIMELINE.mark("window laid out")
+    STARTUP_TIMELINE.report() # Hidden tabs (statistics included) load when first selected
     root.mainloop()
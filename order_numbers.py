@@ -0,0 +1,121 @@
+DEFAULT_ORDER_NUMBER = "01"
+
+# Last order number of every customer that has sales: the order number of its highest sale id
+_LAST_ORDER_NUMBERS_SQL = """
+    SELECT s.customer_id, s.order_number
+    FROM sales s
+    JOIN (SELECT customer_id, MAX(id) AS max_id FROM sales GROUP BY customer_id) last ON s.id = last.max_id
+"""
+
+
+def increment_order_number(last_order_number):
+    """
+    Next order number after last_order_number. If numeric: increments it.
+    If the original numeric number started with '0', ensures the result also
+    starts with '0', potentially increasing the total length (e.g., 09999 -> 010000).
+    Otherwise (non-numeric, no record, or original numeric didn't start with '0'),
+    defaults to '01'.
+    """
+    if not last_order_number:
+        return DEFAULT_ORDER_NUMBER # No last record
+    if not last_order_number.isdigit():
+        print(f"Last order number '{last_order_number}' is not numeric. Defaulting to '{DEFAULT_ORDER_NUMBER}'.")
+        return DEFAULT_ORDER_NUMBER
+    try:
+        next_num_str = str(int(last_order_number) + 1)
+    except ValueError:
+        # isdigit() accepts e.g. superscripts that int() rejects
+        print(f"Error converting supposedly numeric '{last_order_number}' to int.")
+        return DEFAULT_ORDER_NUMBER
+    if not last_order_number.startswith('0'):
+        # Original didn't start with '0', just use the incremented number directly
+        return next_num_str
+    # First, pad to at least the original length
+    padded_to_original = next_num_str.zfill(len(last_order_number))
+    # If, after padding, it *still* doesn't start with '0'
+    # (e.g., 09->10, 09999->10000), prepend an extra '0'.
+    if not padded_to_original.startswith('0'):
+        return '0' + padded_to_original
+    return padded_to_original
+
+
+class OrderNumberCache:
+    """
+    Last sales order number per customer, so suggesting the next number on
+    every combobox selection or search keystroke needs no query.
+
+    load() fills it with one grouped query; the write path keeps it current
+    with record() (new sale) and forget() (a customer's sale was edited or
+    deleted, re-read on the next suggestion). It is only a suggestion: the
+    number actually written is taken by reserve_order_number().
+    """
+
+    # Marks a customer whose last order number has to be re-read
+    _UNKNOWN = object()
+
+    def __init__(self):
+        self._last = {} # customer_id -> last order number (customers without sales are absent)
+        self._loaded = False
+
+    def load(self, conn):
+        """Replaces the cache with the last order number of every customer (one query)."""
+        cursor = conn.cursor()
+        cursor.execute(_LAST_ORDER_NUMBERS_SQL)
+        self._last = dict(cursor.fetchall())
+        self._loaded = True
+
+    def clear(self):
+        self._last = {}
+        self._loaded = False
+
+    def suggest(self, conn, customer_id):
+        """
+        Next order number for a customer.
+
+        :raises: sqlite3.Error if the customer's number has to be (re)read and that fails
+        """
+        if not self._loaded:
+            self.load(conn)
+        last = self._last.get(customer_id)
+        if last is self._UNKNOWN:
+            last = last_order_number(conn.cursor(), customer_id)
+            self.record(customer_id, last)
+        return increment_order_number(last)
+
+    def record(self, customer_id, order_number):
+        """Stores the order number of a sale just written for the customer."""
+        if order_number is None:
+            self._last.pop(customer_id, None)
+        else:
+            self._last[customer_id] = order_number
+
+    def forget(self, customer_id=None):
+        """Marks one customer (or, with None, the whole cache) to be re-read on the next suggestion."""
+        if customer_id is None:
+            self.clear()
+        else:
+            self._last[customer_id] = self._UNKNOWN
+
+
+def last_order_number(cursor, customer_id):
+    """Order number of the customer's latest sale, or None."""
+    cursor.execute("SELECT order_number FROM sales WHERE customer_id = ? ORDER BY id DESC LIMIT 1", (customer_id,))
+    row = cursor.fetchone()
+    return row[0] if row and row[0] else None
+
+
+def reserve_order_number(cursor, customer_id):
+    """
+    Next free order number for a customer, read from the database itself.
+
+    Must run inside the write transaction (BEGIN IMMEDIATE) that inserts the
+    sale: the write lock keeps other terminals from taking the number before
+    the commit. Numbers already used by any sale (order_number is unique
+    across customers) are skipped.
+    """
+    order_number = increment_order_number(last_order_number(cursor, customer_id))
+    while True:
+        cursor.execute("SELECT 1 FROM sales WHERE order_number = ?", (order_number,))
+        if cursor.fetchone() is None:
+            return order_number
+        order_number = increment_order_number(order_number)
@@ -0,0 +1,81 @@
+import traceback
+from collections import OrderedDict
+
+
+class RefreshCoordinator:
+    """
+    Coalesces view refreshes.
+
+    Views are registered by name with the method that reloads them. Callers
+    only mark views dirty; all dirty views are refreshed once each, in
+    registration order, on the next Tk idle cycle (or right away via flush()).
+    So a mutation that affects four views, or several mutations in a row,
+    cost one query per affected view.
+
+    A view registered with a notebook tab is only refreshed while that tab is
+    shown; while hidden it just stays dirty (stale) and is refreshed when
+    set_visible_tab() reports the tab as shown again.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._views = OrderedDict() # name -> refresh callable
+        self._tabs = {} # name -> tab id, for views that live on one notebook tab
+        self._visible_tab = None # None until set_visible_tab: everything counts as visible
+        self._dirty = set()
+        self._after_id = None
+
+    def register(self, name, refresh, tab=None):
+        """
+        :param refresh: callable reloading the view
+        :param tab: notebook tab id (str of the tab frame) the view lives on, or None for always visible
+        """
+        self._views[name] = refresh
+        if tab is not None:
+            self._tabs[name] = str(tab)
+
+    def mark_dirty(self, *names):
+        """Schedules the named views for the next idle pass (hidden ones wait for their tab)."""
+        for name in names:
+            if name not in self._views:
+                raise KeyError(f"Unknown view: {name}")
+        self._dirty.update(names)
+        if any(self._is_visible(name) for name in names) and self._after_id is None:
+            self._after_id = self.root.after_idle(self._on_idle)
+
+    def mark_all_dirty(self):
+        self.mark_dirty(*self._views)
+
+    def set_visible_tab(self, tab):
+        """
+        Call from <<NotebookTabChanged>> with notebook.select(). Views of the
+        newly shown tab that went stale while it was hidden are refreshed right
+        away, before the tab is drawn.
+        """
+        self._visible_tab = str(tab)
+        if any(self._is_visible(name) for name in self._dirty):
+            self.flush()
+
+    def flush(self):
+        """Refreshes every dirty visible view now (once each, in registration order)."""
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
+        pending = [name for name in self._views if name in self._dirty and self._is_visible(name)]
+        self._dirty.difference_update(pending)
+        for name in pending:
+            try:
+                self._views[name]()
+            except Exception as e:
+                # One failing view must not keep the others stale
+                traceback.print_exc()
+                print(f"Error refreshing view '{name}': {e}")
+        # Views marked dirty by the refreshes themselves wait for the next idle pass
+
+    def _is_visible(self, name):
+        tab = self._tabs.get(name)
+        return tab is None or self._visible_tab is None or tab == self._visible_tab
+
+    def _on_idle(self):
+        self._after_id = None
+        self.flush()
@@ -0,0 +1,362 @@
+"""
+Query and report logic shared by the Tk app (main.py) and the command line (cli.py).
+
+Nothing here imports tkinter: functions take a connection, return plain
+values and raise sqlite3.Error / ValueError, and the caller decides how to
+show them (message boxes or stdout).
+"""
+import sqlite3
+from datetime import datetime
+
+import cogs
+import database
+import columnar_export
+import excel_export
+import importer
+import order_numbers
+
+# Used for the per-ton profit when there is no inventory to average
+DEFAULT_DENSITY = 0.84
+
+
+def validate_date(date_str, label="日期"):
+    """Returns date_str (stripped) or None if empty; raises ValueError if it is not YYYY-MM-DD."""
+    date_str = (date_str or '').strip()
+    if not date_str:
+        return None
+    try:
+        datetime.strptime(date_str, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"{label}格式无效，请使用 YYYY-MM-DD")
+    return date_str
+
+
+def find_customer_id(conn, name):
+    """Customer id for an exact name, or None."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM customers WHERE name = ?", (name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# --- Statistics ---
+
+def query_inventory_totals(conn):
+    """Returns (count, tons, liters, total cost, avg density) over ALL inventory."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT COUNT(*), SUM(quantity_ton), SUM(total_liters),
+               SUM(price_per_ton * quantity_ton), AVG(density)
+        FROM inventory
+    """)
+    inv_count, inv_tons, inv_liters, inv_cost, avg_density = cursor.fetchone()
+    return inv_count or 0, inv_tons or 0.0, inv_liters or 0.0, inv_cost or 0.0, avg_density
+
+
+def query_min_sale_date(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT MIN(sale_date) FROM sales")
+    min_date_result = cursor.fetchone()
+    return min_date_result[0] if min_date_result and min_date_result[0] else None
+
+
+def query_cogs(conn, method, start_date=None, end_date=None, customer_id=None, progress=None):
+    """Brings the per-sale costs up to date and returns (total_cost, {month: cost}) for the filter."""
+    cogs.update_cogs(conn, method, progress=progress)
+    return database.query_cogs(conn, method, start_date, end_date, customer_id)
+
+
+def profit_summary(sales_totals, cogs_totals, avg_density):
+    """
+    Profit figures of the statistics tab.
+
+    :param sales_totals: (count, avg_price, liters, revenue) from database.query_sales_rollup
+    :param cogs_totals: (total_cost, {month: cost}) from query_cogs
+    :return: (total_profit, avg_profit_per_liter, avg_profit_per_ton)
+    """
+    sales_count, _, sales_liters, sales_revenue = sales_totals
+    total_cogs = cogs_totals[0]
+    total_profit = 0.0
+    avg_profit_liter = 0.0
+    avg_profit_ton = 0.0
+
+    if sales_count > 0:
+        total_profit = sales_revenue - total_cogs
+        if sales_liters > 0:
+            avg_profit_liter = total_profit / sales_liters
+
+        # Estimate average density to convert sales liters to tons for avg profit/ton
+        avg_density = avg_density or DEFAULT_DENSITY # Default if no inventory
+        if avg_density > 0:
+            sales_tons_estimated = (sales_liters / 1000) * avg_density
+            if sales_tons_estimated > 0:
+                avg_profit_ton = total_profit / sales_tons_estimated
+    return total_profit, avg_profit_liter, avg_profit_ton
+
+
+def monthly_profit_rows(monthly_data, cogs_totals):
+    """[(month, revenue, cost, profit)] for the monthly profit table."""
+    monthly_cogs = cogs_totals[1]
+    rows = []
+    for month, monthly_revenue, monthly_liters in monthly_data:
+        monthly_revenue = monthly_revenue or 0.0
+        monthly_cost = monthly_cogs.get(month, 0.0)
+        rows.append((month, monthly_revenue, monthly_cost, monthly_revenue - monthly_cost))
+    return rows
+
+
+def statistics_report(conn, start_date=None, end_date=None, customer_id=None, cogs_method=cogs.DEFAULT_METHOD):
+    """
+    Everything the statistics tab shows, in one dict (used by the CLI; the GUI
+    computes the same parts separately so it can cache them).
+
+    :param start_date: YYYY-MM-DD or None for "from the earliest sale" (like the GUI)
+    """
+    inv_totals = query_inventory_totals(conn)
+    if start_date is None:
+        start_date = query_min_sale_date(conn)
+    sales_totals, monthly_data = database.query_sales_rollup(conn, start_date, end_date, customer_id)
+    cogs_totals = query_cogs(conn, cogs_method, start_date, end_date, customer_id)
+    return {
+        'start_date': start_date,
+        'end_date': end_date,
+        'inventory_totals': inv_totals,
+        'remaining_liters': database.get_remaining_liters(conn),
+        'sales_totals': sales_totals,
+        'cogs_method': cogs_method,
+        'profit': profit_summary(sales_totals, cogs_totals, inv_totals[4]),
+        'monthly': monthly_profit_rows(monthly_data, cogs_totals),
+    }
+
+
+def format_statistics_report(report):
+    """The statistics tab as text lines (same labels and rounding as the GUI)."""
+    inv_count, inv_tons, inv_liters, _, _ = report['inventory_totals']
+    sales_count, sales_avg_price, sales_liters, sales_revenue = report['sales_totals']
+    total_profit, avg_profit_liter, avg_profit_ton = report['profit']
+    lines = [
+        f"统计区间: {report['start_date'] or '-'} ~ {report['end_date'] or '-'}",
+        "",
+        "[入库统计 (全部)]",
+        f"入库次数: {inv_count}",
+        f"总入库量 (吨): {inv_tons:.2f}",
+        f"总入库量 (升): {inv_liters:.2f}",
+        f"当前库存余量 (升): {report['remaining_liters']:.2f}",
+        "",
+        "[销售统计 (根据筛选)]",
+        f"交易次数: {sales_count}",
+        f"平均单价 (元/升): {sales_avg_price:.2f}",
+        f"总销售量 (升): {sales_liters:.2f}",
+        f"总销售额 (元): {sales_revenue:.2f}",
+        "",
+        f"[利润统计 - {cogs.METHOD_LABELS[report['cogs_method']]}]",
+        f"总利润 (元): {total_profit:.2f}",
+        f"每升平均利润 (元): {avg_profit_liter:.2f}",
+        f"每吨平均利润 (元): {avg_profit_ton:.2f}",
+        "",
+        "[月度利润]",
+        "月份\t销售额\t销售成本\t毛利",
+    ]
+    for month, revenue, cost, profit in report['monthly']:
+        lines.append(f"{month}\t{revenue:.2f}\t{cost:.2f}\t{profit:.2f}")
+    return lines
+
+
+# --- Stock ---
+
+def stock_report(conn):
+    """Returns (remaining_liters, is_consistent, stored_remaining, ledger_remaining)."""
+    is_consistent, stored, ledger = database.verify_stock_balance(conn)
+    return database.get_remaining_liters(conn), is_consistent, stored, ledger
+
+
+# --- Export / import ---
+
+def export_filename(start_date=None, end_date=None):
+    """Default export file name, prefixed with the date range like the GUI suggests."""
+    prefix = ""
+    if start_date and end_date:
+        prefix = f"{start_date.replace('-', '')}-{end_date.replace('-', '')}_"
+    elif start_date:
+        prefix = f"{start_date.replace('-', '')}起_"
+    elif end_date:
+        prefix = f"截至{end_date.replace('-', '')}_"
+    return f"{prefix}柴油销售数据导出.xlsx"
+
+
+def export_excel(conn, save_path, start_date=None, end_date=None, cogs_method=cogs.DEFAULT_METHOD, progress=None):
+    """Writes the Excel export (see excel_export.export_workbook)."""
+    excel_export.export_workbook(conn, save_path, start_date, end_date, progress=progress, cogs_method=cogs_method)
+
+
+def export_excel_incremental(conn, save_path, cogs_method=cogs.DEFAULT_METHOD, progress=None):
+    """
+    Brings a running Excel export up to date (see excel_export.export_workbook_incremental).
+
+    :return: ('full' or 'incremental', number of changed rows applied or None)
+    """
+    return excel_export.export_workbook_incremental(conn, save_path, cogs_method, progress=progress)
+
+
+def export_columnar(conn, out_dir, file_format=columnar_export.PARQUET, cogs_method=cogs.DEFAULT_METHOD, progress=None):
+    """Writes the month-partitioned Parquet/Arrow datasets (see columnar_export.export_dataset)."""
+    return columnar_export.export_dataset(conn, out_dir, file_format, cogs_method, progress=progress)
+
+
+def import_file(conn, import_path, progress=None):
+    """
+    Bulk-imports an xlsx/CSV file and writes the error report next to it if rows were rejected.
+
+    :return: (ImportReport, error report path or None)
+    """
+    report = importer.import_file(conn, import_path, progress=progress)
+    report_path = None
+    if report.errors:
+        report_path = importer.error_report_path(import_path)
+        try:
+            report.write_csv(report_path)
+        except OSError as e:
+            print(f"Could not write import error report: {e}")
+            report_path = None
+    return report, report_path
+
+
+def open_database(db_path):
+    """Connects to and initializes/migrates a database file (raises sqlite3.Error)."""
+    conn = database.create_connection(db_path)
+    try:
+        database.initialize_database(conn)
+    except sqlite3.Error:
+        conn.close()
+        raise
+    return conn
+
+
+# --- Writes ---
+
+class InsufficientStockError(ValueError):
+    """A sale (or the increase of an edited sale) asks for more liters than are in stock."""
+
+    def __init__(self, remaining, requested, message=None):
+        super().__init__(message or f"当前剩余库存 {remaining:.2f} 升，不足以销售 {requested:.2f} 升。")
+        self.remaining = remaining
+        self.requested = requested
+
+
+class DuplicateOrderNumberError(ValueError):
+    """The sales order number is already used (order numbers are unique across customers)."""
+
+    def __init__(self, order_number):
+        super().__init__(f"销售单号 '{order_number}' 已存在")
+        self.order_number = order_number
+
+
+def _is_duplicate_order_number(error):
+    """True if an IntegrityError comes from the UNIQUE index on sales.order_number."""
+    message = str(error)
+    return 'sales.order_number' in message or 'idx_sales_order_number' in message
+
+
+def _validate_sale(sale_date, price_per_liter, quantity_liter):
+    sale_date = validate_date(sale_date, "销售日期")
+    if sale_date is None:
+        raise ValueError("销售日期不能为空")
+    if price_per_liter <= 0:
+        raise ValueError("单价必须大于0")
+    if quantity_liter <= 0:
+        raise ValueError("数量必须大于0")
+    return sale_date
+
+
+def add_sale(conn, customer_id, sale_date, order_number, price_per_liter, quantity_liter):
+    """
+    Inserts a sale, checking the stock and the order number in the same
+    BEGIN IMMEDIATE transaction: no other connection (terminal, sync server,
+    background job) can sell the same liters or take the number in between.
+    A duplicate order number is reported by the UNIQUE index on the INSERT
+    itself, so there is no separate lookup.
+
+    :param order_number: sales order number, or None for the customer's next free number
+    :return: (sale_id, order_number, total_price)
+    :raises: ValueError for invalid input, InsufficientStockError, DuplicateOrderNumberError,
+             sqlite3.Error on database errors (the transaction is rolled back in every case)
+    """
+    sale_date = _validate_sale(sale_date, price_per_liter, quantity_liter)
+    total_price = price_per_liter * quantity_liter
+
+    cursor = conn.cursor()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("SELECT 1 FROM customers WHERE id = ?", (customer_id,))
+        if cursor.fetchone() is None:
+            raise ValueError(f"客户不存在 (ID: {customer_id})")
+        remaining = database.get_remaining_liters(conn)
+        if quantity_liter > remaining:
+            raise InsufficientStockError(remaining, quantity_liter)
+        if not order_number:
+            order_number = order_numbers.reserve_order_number(cursor, customer_id)
+        try:
+            cursor.execute('''
+                INSERT INTO sales (customer_id, sale_date, order_number, price_per_liter, quantity_liter, total_price)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (customer_id, sale_date, order_number, price_per_liter, quantity_liter, total_price))
+        except sqlite3.IntegrityError as e:
+            if _is_duplicate_order_number(e):
+                raise DuplicateOrderNumberError(order_number)
+            raise
+        sale_id = cursor.lastrowid
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return sale_id, order_number, total_price
+
+
+def update_sale(conn, sale_id, sale_date, order_number, price_per_liter, quantity_liter):
+    """
+    Updates a sale (the customer stays). An increase of the quantity is
+    checked against the stock in the same BEGIN IMMEDIATE transaction as the
+    UPDATE; a duplicate order number is reported by the UNIQUE index.
+
+    :return: the new total price
+    :raises: ValueError for invalid input or a missing sale, InsufficientStockError,
+             DuplicateOrderNumberError, sqlite3.Error on database errors (rolled back)
+    """
+    sale_date = _validate_sale(sale_date, price_per_liter, quantity_liter)
+    if not order_number:
+        raise ValueError("单号不能为空")
+    total_price = price_per_liter * quantity_liter
+
+    cursor = conn.cursor()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("SELECT quantity_liter FROM sales WHERE id = ?", (sale_id,))
+        row = cursor.fetchone()
+        if row is None:
+            raise ValueError(f"找不到销售记录 ID: {sale_id}")
+        quantity_change = quantity_liter - row[0]
+        if quantity_change > 0:
+            # Only the increase needs stock
+            remaining = database.get_remaining_liters(conn)
+            if quantity_change > remaining:
+                raise InsufficientStockError(remaining, quantity_change,
+                                             f"编辑后增加的数量 ({quantity_change:.2f} 升) 超过当前剩余库存 ({remaining:.2f} 升)。")
+        try:
+            cursor.execute('''
+                UPDATE sales SET
+                    sale_date = ?,
+                    order_number = ?,
+                    price_per_liter = ?,
+                    quantity_liter = ?,
+                    total_price = ?
+                WHERE id = ?
+            ''', (sale_date, order_number, price_per_liter, quantity_liter, total_price, sale_id))
+        except sqlite3.IntegrityError as e:
+            if _is_duplicate_order_number(e):
+                raise DuplicateOrderNumberError(order_number)
+            raise
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return total_price
@@ -19,7 +19,7 @@ DATA_FILES = [
 # --- py2app Options ---
 OPTIONS = {
     'argv_emulation': True, # Allows dropping files onto the app icon (if needed later)
-    'packages': ['pandas', 'openpyxl', 'tkinter'], # Explicitly include packages
+    'packages': ['openpyxl', 'tkinter'], # Explicitly include packages
     'includes': [], # Add specific modules here if needed later
     'iconfile': None, # No icon specified for now
     'plist': {
@@ -0,0 +1,43 @@
+import os
+import sys
+import time
+
+# Turn on with `python main.py --startup-timeline` or DIESEL_STARTUP_TIMELINE=1
+TIMELINE_FLAG = '--startup-timeline'
+TIMELINE_ENV = 'DIESEL_STARTUP_TIMELINE'
+
+
+def timeline_requested(argv=None):
+    argv = sys.argv if argv is None else argv
+    return TIMELINE_FLAG in argv or bool(os.environ.get(TIMELINE_ENV))
+
+
+class StartupTimeline:
+    """
+    Records how long each startup step takes (imports, DB connect,
+    initialize_database, each tab, first refresh) and prints the timeline
+    once, so a slow import or query shows up as a jump between two steps.
+    Does nothing unless enabled.
+    """
+
+    def __init__(self, start=None, enabled=False):
+        self.enabled = enabled
+        self.start = time.perf_counter() if start is None else start
+        self._marks = [] # (label, perf_counter)
+        self._reported = False
+
+    def mark(self, label):
+        if self.enabled and not self._reported:
+            self._marks.append((label, time.perf_counter()))
+
+    def report(self):
+        """Prints the timeline (only the first call prints)."""
+        if not self.enabled or self._reported:
+            return
+        self._reported = True
+        print("--- Startup timeline ---")
+        previous = self.start
+        for label, stamp in self._marks:
+            print(f"{(stamp - self.start) * 1000:9.1f} ms  (+{(stamp - previous) * 1000:7.1f} ms)  {label}")
+            previous = stamp
+        print("------------------------")
@@ -0,0 +1,50 @@
+from collections import OrderedDict
+
+
+class StatisticsCache:
+    """
+    Memoizes aggregate query results for the statistics tab.
+
+    Each entry is stored under (section, key), where key is usually the
+    (start date, end date, customer id) filter, together with the set of
+    tables it was computed from. Writing to a table only drops the entries
+    that depend on it, so e.g. adding a sale keeps the inventory aggregates.
+    """
+
+    # Returned by peek() on a cache miss (None is a valid cached value)
+    MISSING = object()
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # (section, key) -> (depends_on, value)
+        # Bumped on every invalidation, so results computed in the background
+        # from an older state can be recognized and not stored
+        self.version = 0
+
+    def peek(self, section, key):
+        """Returns the cached value for (section, key), or MISSING."""
+        cache_key = (section, key)
+        if cache_key not in self._entries:
+            return self.MISSING
+        self._entries.move_to_end(cache_key)
+        return self._entries[cache_key][1]
+
+    def put(self, section, key, depends_on, value):
+        """Stores a value computed elsewhere (e.g. on a worker thread)."""
+        self._entries[(section, key)] = (frozenset(depends_on), value)
+        self._entries.move_to_end((section, key))
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False) # Drop the least recently used entry
+
+    def invalidate(self, *tables):
+        """Drops every entry computed from any of the given tables."""
+        tables = set(tables)
+        stale = [cache_key for cache_key, (depends_on, _) in self._entries.items() if depends_on & tables]
+        for cache_key in stale:
+            del self._entries[cache_key]
+        self.version += 1
+
+    def clear(self):
+        """Drops everything (e.g. after opening another database file)."""
+        self._entries.clear()
+        self.version += 1
@@ -0,0 +1,119 @@
+"""
+Client side of sync_server.py, used by the Tk app in client mode.
+
+Client mode is turned on with `python main.py --server http://HOST:PORT` or
+DIESEL_SYNC_SERVER=http://HOST:PORT. Only the standard library is used.
+"""
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+
+SERVER_FLAG = '--server'
+SERVER_ENV = 'DIESEL_SYNC_SERVER'
+
+# Seconds a GET response is reused before asking the server again (0 disables the read cache)
+DEFAULT_CACHE_TTL = 2.0
+DEFAULT_TIMEOUT = 5.0
+
+
+def server_url_requested(argv=None):
+    """Server URL from `--server URL` / `--server=URL` or the environment, or None."""
+    argv = sys.argv if argv is None else argv
+    for i, arg in enumerate(argv):
+        if arg == SERVER_FLAG and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith(SERVER_FLAG + '='):
+            return arg.split('=', 1)[1]
+    return os.environ.get(SERVER_ENV) or None
+
+
+class SyncError(Exception):
+    """
+    A request failed. code is the server's error code (e.g. 'insufficient_stock',
+    'duplicate_order_number') or 'unreachable' if the server could not be reached.
+    """
+
+    def __init__(self, message, code='error', status=None):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+        self.status = status
+
+
+class SyncClient:
+    """
+    JSON calls to the sync server, with a small read cache: GET responses are
+    reused for cache_ttl seconds and every write clears the cache.
+
+    Apart from the health check at startup, the app only calls it from the
+    job worker thread (see main.py), so a slow server never blocks the window. It is used for the stock label and the
+    suggested order number; lists and statistics read the shared database file.
+    """
+
+    def __init__(self, base_url, timeout=DEFAULT_TIMEOUT, cache_ttl=DEFAULT_CACHE_TTL):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self._cache = {} # path -> (expires_at, payload)
+
+    def health(self):
+        return self._get('/health', cached=False)
+
+    def remaining_liters(self):
+        return self._get('/stock')['remaining_liters']
+
+    def next_order_number(self, customer_id):
+        return self._get(f'/next-order-number?customer_id={int(customer_id)}')['order_number']
+
+    def add_sale(self, customer_id, sale_date, order_number, price_per_liter, quantity_liter):
+        """
+        Writes a sale through the server (stock and order number checked atomically there).
+
+        :param order_number: or None for the customer's next free number
+        :return: (sale_id, order_number, total_price)
+        :raises: SyncError
+        """
+        result = self._request('POST', '/sales', {
+            'customer_id': customer_id,
+            'sale_date': sale_date,
+            'order_number': order_number,
+            'price_per_liter': price_per_liter,
+            'quantity_liter': quantity_liter,
+        })
+        self._cache.clear() # Stock and order numbers changed
+        return result['id'], result['order_number'], result['total_price']
+
+    def _get(self, path, cached=True):
+        now = time.monotonic()
+        if cached and self.cache_ttl > 0:
+            entry = self._cache.get(path)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        payload = self._request('GET', path)
+        if cached and self.cache_ttl > 0:
+            self._cache[path] = (now + self.cache_ttl, payload)
+        return payload
+
+    def _request(self, method, path, payload=None):
+        data = None
+        headers = {'Accept': 'application/json'}
+        if payload is not None:
+            data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            headers['Content-Type'] = 'application/json; charset=utf-8'
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            # Error responses carry {"error": code, "message": text}
+            try:
+                body = json.loads(e.read().decode('utf-8'))
+                raise SyncError(body.get('message', str(e)), body.get('error', 'error'), e.code) from None
+            except (ValueError, AttributeError):
+                raise SyncError(f"同步服务器错误: HTTP {e.code}", 'error', e.code) from None
+        except (urllib.error.URLError, OSError) as e:
+            reason = getattr(e, 'reason', e)
+            raise SyncError(f"无法连接同步服务器 {self.base_url}: {reason}", 'unreachable') from None
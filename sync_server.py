@@ -0,0 +1,222 @@
+"""
+Local sync server: owns the database for several terminals and serializes their writes.
+
+    python sync_server.py [--db FILE] [--host 127.0.0.1] [--port 8765]
+
+Terminals run the Tk app as clients (python main.py --server http://HOST:8765,
+or DIESEL_SYNC_SERVER=...). Sales are then written by the server, which
+checks the stock and the order number in the same transaction, so two
+terminals selling at once cannot oversell.
+
+JSON API (UTF-8):
+    GET  /health                          {"ok": true, "schema_version": N}
+    GET  /stock                           {"remaining_liters": x}
+    GET  /customers                       {"customers": [{"id": N, "name": "..."}]}
+    GET  /next-order-number?customer_id=N {"order_number": "..."}
+    POST /sales                           {"customer_id", "sale_date", "order_number" (null: next free),
+                                           "price_per_liter", "quantity_liter"}
+                                       -> 201 {"id", "order_number", "total_price", "remaining_liters"}
+Errors are {"error": code, "message": text} with status 400 (invalid_request),
+404 (not_found), 409 (insufficient_stock, duplicate_order_number) or 500 (database_error).
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import database
+import order_numbers
+import services
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DB_PATH = os.path.join(APP_DIR, 'diesel_sales.db') # Same file the GUI opens
+DEFAULT_HOST = '127.0.0.1' # Use 0.0.0.0 to serve other machines on the LAN
+DEFAULT_PORT = 8765
+
+# Largest request body accepted (bytes); a sale is well under 1 KB
+MAX_BODY_SIZE = 64 * 1024
+
+
+class ApiError(Exception):
+    """Turned into a JSON error response by the request handler."""
+
+    def __init__(self, status, code, message):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+def _customer_id_param(query):
+    try:
+        return int(query.get('customer_id', [''])[0])
+    except ValueError:
+        raise ApiError(400, 'invalid_request', "customer_id 必须是整数")
+
+
+def _number_field(body, name):
+    value = body.get(name)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ApiError(400, 'invalid_request', f"{name} 必须是数字")
+    return float(value)
+
+
+# --- Routes: handler(conn, query, body) -> (status, payload) ---
+
+def get_health(conn, query, body):
+    return 200, {'ok': True, 'schema_version': conn.execute("PRAGMA user_version").fetchone()[0]}
+
+
+def get_stock(conn, query, body):
+    return 200, {'remaining_liters': database.get_remaining_liters(conn)}
+
+
+def get_customers(conn, query, body):
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, name FROM customers ORDER BY name")
+    return 200, {'customers': [{'id': customer_id, 'name': name} for customer_id, name in cursor.fetchall()]}
+
+
+def get_next_order_number(conn, query, body):
+    customer_id = _customer_id_param(query)
+    last = order_numbers.last_order_number(conn.cursor(), customer_id)
+    return 200, {'order_number': order_numbers.increment_order_number(last)}
+
+
+def post_sale(conn, query, body):
+    try:
+        customer_id = int(body.get('customer_id'))
+    except (TypeError, ValueError):
+        raise ApiError(400, 'invalid_request', "customer_id 必须是整数")
+    order_number = body.get('order_number')
+    if order_number is not None and not isinstance(order_number, str):
+        raise ApiError(400, 'invalid_request', "order_number 必须是字符串或 null")
+    try:
+        sale_id, order_number, total_price = services.add_sale(
+            conn, customer_id, body.get('sale_date'), (order_number or '').strip() or None,
+            _number_field(body, 'price_per_liter'), _number_field(body, 'quantity_liter'))
+    except services.InsufficientStockError as e:
+        raise ApiError(409, 'insufficient_stock', str(e))
+    except services.DuplicateOrderNumberError as e:
+        raise ApiError(409, 'duplicate_order_number', str(e))
+    except ValueError as e:
+        raise ApiError(400, 'invalid_request', str(e))
+    print(f"Sale {sale_id} ({order_number}) written for customer {customer_id}")
+    return 201, {'id': sale_id, 'order_number': order_number, 'total_price': total_price,
+                 'remaining_liters': database.get_remaining_liters(conn)}
+
+
+GET_ROUTES = {
+    '/health': get_health,
+    '/stock': get_stock,
+    '/customers': get_customers,
+    '/next-order-number': get_next_order_number,
+}
+POST_ROUTES = {
+    '/sales': post_sale,
+}
+
+
+class SyncRequestHandler(BaseHTTPRequestHandler):
+    server_version = "DieselSync/1.0"
+
+    def do_GET(self):
+        self._dispatch(GET_ROUTES, None)
+
+    def do_POST(self):
+        try:
+            body = self._read_json_body()
+        except ApiError as e:
+            self._send_json(e.status, {'error': e.code, 'message': e.message})
+            return
+        self._dispatch(POST_ROUTES, body)
+
+    def _read_json_body(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            raise ApiError(400, 'invalid_request', "Content-Length 无效")
+        if length > MAX_BODY_SIZE:
+            raise ApiError(400, 'invalid_request', "请求内容过大")
+        try:
+            body = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            raise ApiError(400, 'invalid_request', "请求内容不是有效的 JSON")
+        if not isinstance(body, dict):
+            raise ApiError(400, 'invalid_request', "请求内容必须是 JSON 对象")
+        return body
+
+    def _dispatch(self, routes, body):
+        url = urlparse(self.path)
+        handler = routes.get(url.path)
+        try:
+            if handler is None:
+                raise ApiError(404, 'not_found', f"未知的接口: {url.path}")
+            status, payload = handler(self.server.conn, parse_qs(url.query), body)
+        except ApiError as e:
+            status, payload = e.status, {'error': e.code, 'message': e.message}
+        except sqlite3.Error as e:
+            print(f"Database error handling {self.command} {url.path}: {e}")
+            status, payload = 500, {'error': 'database_error', 'message': f"数据库错误: {e}"}
+        self._send_json(status, payload)
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class SyncServer(HTTPServer):
+    """
+    Serves one request at a time over a single connection, so writes from all
+    terminals are serialized here (and BEGIN IMMEDIATE inside add_sale also
+    guards against any other process writing the file directly).
+    """
+
+    def __init__(self, db_path, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.db_path = db_path
+        services.open_database(db_path).close() # Migrate the schema once, up front
+        self.conn = None # Opened on the thread that serves requests
+        super().__init__((host, port), SyncRequestHandler)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.conn = database.create_connection(self.db_path)
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self.conn.close()
+            self.conn = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="sync_server.py", description="柴油库存管理系统 - 多终端同步服务器")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help=f"数据库文件 (默认: {DEFAULT_DB_PATH})")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"监听地址 (默认: {DEFAULT_HOST})")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"端口 (默认: {DEFAULT_PORT})")
+    args = parser.parse_args(argv)
+    try:
+        server = SyncServer(args.db, args.host, args.port)
+    except sqlite3.Error as e:
+        print(f"数据库错误: 无法连接或初始化数据库 '{args.db}': {e}", file=sys.stderr)
+        return 1
+    except OSError as e:
+        print(f"无法监听 {args.host}:{args.port}: {e}", file=sys.stderr)
+        return 1
+    print(f"Sync server for '{args.db}' listening on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
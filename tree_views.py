@@ -0,0 +1,245 @@
+from tkinter import ttk
+
+
+class IncrementalTreeView:
+    """
+    Applies single-record changes to a ttk.Treeview without reloading it.
+
+    Rows use iid = str(db_id) and the first column holds the display number
+    (序号). Inserts, updates and removals touch only the affected item; the
+    display numbers after a removal are rewritten lazily on the next idle
+    cycle, so a burst of deletes renumbers only once.
+
+    :param tree: the Treeview to manage
+    :param format_row: callable(display_id, row) -> tuple of display values;
+                       row[0] must be the database id
+    """
+
+    def __init__(self, tree: ttk.Treeview, format_row):
+        self.tree = tree
+        self.format_row = format_row
+        self.first_pos = 1 # Display number (序号) of the first row in the tree
+        self._renumber_pending = False
+
+    def load_rows(self, rows):
+        """Replaces the whole content of the tree with rows (used for full reloads)."""
+        self.tree.delete(*self.tree.get_children())
+        self.first_pos = 1
+        for display_id, row in enumerate(rows, start=1):
+            self._insert_row("end", display_id, row)
+        self._select_last()
+
+    def upsert_row(self, row, select=True):
+        """
+        Updates the item for row[0] in place, or appends it as the newest row.
+
+        :param select: select the row and scroll to it
+        """
+        iid = str(row[0])
+        if self.tree.exists(iid):
+            # Keep the current display number, only the data columns change
+            display_id = self.tree.item(iid, 'values')[0]
+            self.tree.item(iid, values=self.format_row(display_id, row))
+        else:
+            if not self._accepts_new_row(row):
+                return
+            display_id = self.first_pos + len(self.tree.get_children())
+            self._insert_row("end", display_id, row)
+            self._after_append()
+        if not select:
+            return
+        try:
+            self.tree.selection_set(iid)
+            self.tree.see(iid)
+        except Exception as e:
+            print(f"Error selecting updated row: {e}")
+
+    def remove_row(self, db_id):
+        """Removes the item for db_id and schedules renumbering of the rows after it."""
+        iid = str(db_id)
+        if self.tree.exists(iid):
+            self.tree.delete(iid)
+            self._schedule_renumber()
+
+    def _accepts_new_row(self, row):
+        return True
+
+    def _after_append(self):
+        pass
+
+    def _insert_row(self, index, display_id, row):
+        self.tree.insert("", index, iid=str(row[0]), values=self.format_row(display_id, row))
+
+    def _select_last(self):
+        children = self.tree.get_children()
+        if children:
+            try:
+                self.tree.selection_set(children[-1])
+                self.tree.see(children[-1])
+            except Exception as e:
+                print(f"Error auto-scrolling table: {e}")
+
+    # --- Lazy renumbering of 序号 ---
+
+    def _schedule_renumber(self):
+        if not self._renumber_pending:
+            self._renumber_pending = True
+            self.tree.after_idle(self._renumber)
+
+    def _renumber(self):
+        self._renumber_pending = False
+        for offset, iid in enumerate(self.tree.get_children()):
+            values = list(self.tree.item(iid, 'values'))
+            display_id = str(self.first_pos + offset)
+            if values and values[0] != display_id:
+                values[0] = display_id
+                self.tree.item(iid, values=values)
+
+
+class PagedTreeView(IncrementalTreeView):
+    """
+    Shows a large table in a ttk.Treeview without loading every row.
+
+    Only a bounded window of rows is kept in the widget. Further pages are
+    fetched with keyset pagination on the database id when the user scrolls
+    to the top or bottom edge, and rows far outside the view are dropped.
+    The item iid is always str(db_id), so code that reads the selection keeps
+    working unchanged.
+
+    :param tree: the Treeview to manage (first column must be the display number)
+    :param scrollbar: the vertical Scrollbar attached to the tree
+    :param fetch_after: callable(after_id, limit) -> rows with id > after_id, ascending
+    :param fetch_before: callable(before_id, limit) -> rows with id < before_id
+                         (or the newest rows if before_id is None), descending
+    :param count_rows: callable() -> total number of rows in the table
+    :param format_row: callable(display_id, row) -> tuple of display values;
+                       row[0] must be the database id
+    """
+
+    def __init__(self, tree: ttk.Treeview, scrollbar: ttk.Scrollbar,
+                 fetch_after, fetch_before, count_rows, format_row,
+                 page_size=200, max_rows=600):
+        super().__init__(tree, format_row)
+        self.scrollbar = scrollbar
+        self.fetch_after = fetch_after
+        self.fetch_before = fetch_before
+        self.count_rows = count_rows
+        self.page_size = page_size
+        self.max_rows = max(max_rows, page_size * 2)
+
+        self.at_start = True # Oldest row of the table is loaded
+        self.at_end = True # Newest row of the table is loaded
+        self._loading = False
+        self._edge_check_pending = False
+
+        self.tree.configure(yscrollcommand=self._on_yscroll)
+
+    # --- Loading ---
+
+    def reload(self):
+        """Drops the current window and loads the newest page (tail of the table)."""
+        self._loading = True
+        try:
+            self.tree.delete(*self.tree.get_children())
+            rows = list(reversed(self.fetch_before(None, self.page_size)))
+            total = self.count_rows()
+            self.first_pos = max(total - len(rows) + 1, 1)
+            self.at_start = self.first_pos == 1
+            self.at_end = True
+            for offset, row in enumerate(rows):
+                self._insert_row("end", self.first_pos + offset, row)
+            self._select_last() # Auto-scroll to the newest row, like the full list did
+        finally:
+            self._loading = False
+
+    def load_next_page(self):
+        """Appends the page after the last loaded row and trims the top if needed."""
+        children = self.tree.get_children()
+        if self.at_end or not children:
+            return
+        self._loading = True
+        try:
+            last_pos = self.first_pos + len(children) - 1
+            rows = self.fetch_after(int(children[-1]), self.page_size)
+            for offset, row in enumerate(rows, start=1):
+                self._insert_row("end", last_pos + offset, row)
+            if len(rows) < self.page_size:
+                self.at_end = True
+
+            self._trim_top()
+        finally:
+            self._loading = False
+
+    def load_previous_page(self):
+        """Prepends the page before the first loaded row and trims the bottom if needed."""
+        children = self.tree.get_children()
+        if self.at_start or not children:
+            return
+        self._loading = True
+        try:
+            anchor = children[0]
+            rows = self.fetch_before(int(anchor), self.page_size) # Descending
+            for offset, row in enumerate(rows, start=1):
+                self._insert_row(0, self.first_pos - offset, row)
+            self.first_pos -= len(rows)
+            if len(rows) < self.page_size or self.first_pos <= 1:
+                self.at_start = True
+                self.first_pos = max(self.first_pos, 1)
+
+            # Keep the window bounded: drop rows from the bottom
+            children = self.tree.get_children()
+            overflow = len(children) - self.max_rows
+            if overflow > 0:
+                self.tree.delete(*children[-overflow:])
+                self.at_end = False
+
+            # Keep the previously first row in view so the list does not jump
+            self.tree.see(anchor)
+        finally:
+            self._loading = False
+
+    def _trim_top(self):
+        """Keeps the window bounded by dropping rows from the top."""
+        children = self.tree.get_children()
+        overflow = len(children) - self.max_rows
+        if overflow > 0:
+            self.tree.delete(*children[:overflow])
+            self.first_pos += overflow
+            self.at_start = False
+
+    # --- Single-record changes ---
+
+    def _accepts_new_row(self, row):
+        # A new row is only shown if the newest page is loaded; otherwise it
+        # will be fetched when the user scrolls down to it.
+        return self.at_end
+
+    def _after_append(self):
+        self._trim_top()
+
+    def remove_row(self, db_id):
+        """Removes db_id from the window, shifting display numbers if it lay before it."""
+        children = self.tree.get_children()
+        if not self.tree.exists(str(db_id)) and children and int(db_id) < int(children[0]):
+            # Row was above the loaded window: every loaded row moves up by one
+            self.first_pos = max(self.first_pos - 1, 1)
+            self._schedule_renumber()
+            return
+        super().remove_row(db_id)
+
+    # --- Scroll handling ---
+
+    def _on_yscroll(self, first, last):
+        self.scrollbar.set(first, last)
+        if not self._loading and not self._edge_check_pending:
+            self._edge_check_pending = True
+            self.tree.after_idle(self._check_edges)
+
+    def _check_edges(self):
+        """Loads another page when the view touches an edge of the loaded window."""
+        self._edge_check_pending = False
+        first, last = self.tree.yview()
+        if last >= 0.999 and not self.at_end:
+            self.load_next_page()
+        elif first <= 0.001 and not self.at_start:
+            self.load_previous_page()